@@ -39,12 +39,15 @@ if "bpy" in locals():
         imp.reload(import_fbx)
     if "export_fbx" in locals():
         imp.reload(export_fbx)
+    if "export_lemma" in locals():
+        imp.reload(export_lemma)
 
 
 import bpy
 from bpy.props import (StringProperty,
                        BoolProperty,
                        FloatProperty,
+                       IntProperty,
                        EnumProperty,
                        )
 
@@ -214,6 +217,159 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
             name="Include Edges",
             default=False,
             )
+    use_atomic_write = BoolProperty(
+            name="Atomic Write",
+            description="Write to a temporary file, only replacing the "
+                        "target file once the export succeeded",
+            default=True,
+            )
+    use_deterministic = BoolProperty(
+            name="Deterministic",
+            description="Give the same file for the same data (no timestamp "
+                        "or version), write a .sha1 sidecar, and leave the "
+                        "file untouched when its content did not change",
+            default=False,
+            )
+    use_section_index = BoolProperty(
+            name="Section Index",
+            description="Write a .idx file listing the byte offset and size "
+                        "of every model, deformer, pose and take block",
+            default=True,
+            )
+    use_compact_props = BoolProperty(
+            name="Compact Properties",
+            description="Leave out object and bone properties whose value "
+                        "is the FBX default",
+            default=False,
+            )
+    use_numpy = BoolProperty(
+            name="Vectorized Export",
+            description="Process mesh data in bulk using NumPy when it is "
+                        "available (same output, faster on big meshes)",
+            default=True,
+            )
+    mesh_chunk_size = IntProperty(
+            name="Chunk Size",
+            description="Format and write mesh arrays by slices of this "
+                        "many values instead of as one big string (arrays "
+                        "are still read whole, into compact buffers), 0 to "
+                        "format arrays whole",
+            min=0,
+            soft_min=0, soft_max=4194304,
+            default=0,
+            )
+    use_mesh_normals_indexed = BoolProperty(
+            name="Indexed Normals",
+            description="Write each distinct split normal only once, "
+                        "with per-corner indices (smaller files)",
+            default=False,
+            )
+    mesh_normals_tolerance = FloatProperty(
+            name="Normals Tolerance",
+            description="Normals closer than this are merged when writing "
+                        "indexed normals (0 to only merge identical ones)",
+            min=0.0, max=0.1,
+            soft_min=0.0, soft_max=0.01,
+            default=0.0,
+            precision=4,
+            )
+    mesh_weld_type = EnumProperty(
+            name="Welding",
+            items=(('OFF', "Off", "Always write normals, UVs and colors "
+                                  "per polygon corner"),
+                   ('CONSTANT', "Per Vertex", "Write normals, UVs and colors "
+                                              "per vertex when they do not "
+                                              "vary around it"),
+                   ('SPLIT', "Split Vertices", "Split vertices where normals, "
+                                               "UVs or colors vary, and write "
+                                               "them all per vertex"),
+                   ),
+            default='OFF',
+            )
+    use_mesh_triangulate = BoolProperty(
+            name="Triangulate",
+            description="Triangulate a copy of exported meshes",
+            default=False,
+            )
+    use_mesh_tangents = BoolProperty(
+            name="Tangent Space",
+            description="Write tangents and binormals of the active UV "
+                        "layer (implies Triangulate)",
+            default=False,
+            )
+    use_mesh_cache_optimize = BoolProperty(
+            name="Optimize Vertex Cache",
+            description="Reorder polygons for GPU vertex cache locality and "
+                        "vertices for fetch locality (slow on big meshes)",
+            default=False,
+            )
+    use_mesh_split = BoolProperty(
+            name="Split for 16 bit Indices",
+            description="Split meshes needing more than 65535 vertices into "
+                        "several meshes, grouping polygons by material and "
+                        "location (for XNA Reach profile)",
+            default=False,
+            )
+    float_format = EnumProperty(
+            name="Float Format",
+            items=(('FIXED', "Fixed", "Write floats with the precision "
+                                      "chosen for each kind of data"),
+                   ('SHORTEST', "Shortest", "Write mesh floats with as few "
+                                            "digits as possible without losing "
+                                            "(32 bits) precision, transforms "
+                                            "and keys keeping their precision"),
+                   ),
+            default='FIXED',
+            )
+    precision_position = IntProperty(
+            name="Positions Precision",
+            description="Number of decimals of vertex and shape key positions",
+            min=0, max=17,
+            default=6,
+            )
+    precision_normal = IntProperty(
+            name="Normals Precision",
+            description="Number of decimals of normals",
+            min=0, max=17,
+            default=6,
+            )
+    precision_uv = IntProperty(
+            name="UVs Precision",
+            description="Number of decimals of UV coordinates",
+            min=0, max=17,
+            default=6,
+            )
+    precision_color = IntProperty(
+            name="Colors Precision",
+            description="Number of decimals of vertex colors",
+            min=0, max=17,
+            default=6,
+            )
+    precision_weight = IntProperty(
+            name="Weights Precision",
+            description="Number of decimals of skinning weights",
+            min=0, max=17,
+            default=8,
+            )
+    precision_matrix = IntProperty(
+            name="Matrices Precision",
+            description="Number of decimals of transforms and bind matrices",
+            min=0, max=17,
+            default=15,
+            )
+    precision_key = IntProperty(
+            name="Keys Precision",
+            description="Number of decimals of animation keys",
+            min=0, max=17,
+            default=15,
+            )
+    use_float_report = BoolProperty(
+            name="Report Float Sizes",
+            description="Print the size of each kind of floats written, and "
+                        "what the default precision would have taken (slower, "
+                        "floats are formatted twice)",
+            default=False,
+            )
     use_armature_deform_only = BoolProperty(
             name="Only Deform Bones",
             description="Only write deforming bones",
@@ -237,6 +393,20 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
                          "start/end frames"),
             default=True
             )
+    use_anim_take_files = BoolProperty(
+            name="Separate Take Files",
+            description=("Write each action's take to its own animation "
+                         "only file (<file>_<take>.fbx) holding the "
+                         "skeleton, instead of into the model file"),
+            default=False,
+            )
+    use_anim_only = BoolProperty(
+            name="Animation Only",
+            description=("Only write armatures (including the ones of "
+                         "exported meshes), their bind pose and takes, "
+                         "skipping geometry, materials and deformers"),
+            default=False,
+            )
     use_anim_optimize = BoolProperty(
             name="Optimize Keyframes",
             description="Remove double keyframes",
@@ -250,6 +420,31 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
             soft_min=1.0, soft_max=16.0,
             default=6.0,  # default: 10^-4 frames.
             )
+    anim_fit_error = FloatProperty(
+            name="Curve Fit Error",
+            description=("Write cubic keys fitted within this maximum error of "
+                         "each frame, in the channel's local units (degrees "
+                         "for rotations), 0 to write linear keys"),
+            min=0.0, max=10.0,
+            soft_min=0.0, soft_max=1.0,
+            default=0.0,
+            )
+    use_anim_quaternion = BoolProperty(
+            name="Quaternion Rotations",
+            description=("Flag rotations to be interpolated as quaternions. "
+                         "FBX 6.1 has no quaternion curves: keys stay XYZ "
+                         "eulers, all axes keyed at the same frames, reduced "
+                         "on whole rotations instead of single axes"),
+            default=False,
+            )
+    use_anim_numpy = BoolProperty(
+            name="Vectorized Animation",
+            description=("Solve the channels of all animated objects at "
+                         "once using NumPy, with Vectorized Export (double "
+                         "precision math, last digits and kept keys may "
+                         "differ slightly)"),
+            default=False,
+            )
     path_mode = path_reference_mode
     batch_mode = EnumProperty(
             name="Batch Mode",
@@ -289,20 +484,133 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
                                             "global_scale",
                                             "check_existing",
                                             "filter_glob",
+                                            "float_format",
+                                            "precision_position",
+                                            "precision_normal",
+                                            "precision_uv",
+                                            "precision_color",
+                                            "precision_weight",
+                                            "precision_matrix",
+                                            "precision_key",
                                             ))
 
         keywords["global_matrix"] = global_matrix
 
+        # None means shortest round-trip formatting, only used for mesh data.
+        float_precision = {}
+        for category in ("position", "normal", "uv", "color", "weight", "matrix", "key"):
+            if self.float_format == 'SHORTEST' and category not in {"matrix", "key"}:
+                float_precision[category] = None
+            else:
+                float_precision[category] = getattr(self, "precision_" + category)
+        keywords["float_precision"] = float_precision
+
         from . import export_fbx
         return export_fbx.save(self, context, **keywords)
 
 
+class ExportLemma(bpy.types.Operator, ExportHelper):
+    """Selection to a Lemma native model container"""
+    bl_idname = "export_scene.lemma_model"
+    bl_label = "Export Lemma Model"
+    bl_options = {'UNDO', 'PRESET'}
+
+    filename_ext = ".lmdl"
+    filter_glob = StringProperty(default="*.lmdl", options={'HIDDEN'})
+
+    use_selection = BoolProperty(
+            name="Selected Objects",
+            description="Export selected objects on visible layers",
+            default=False,
+            )
+    global_scale = FloatProperty(
+            name="Scale",
+            description="Scale all data",
+            min=0.001, max=1000.0,
+            soft_min=0.01, soft_max=1000.0,
+            default=1.0,
+            )
+    axis_forward = EnumProperty(
+            name="Forward",
+            items=(('X', "X Forward", ""),
+                   ('Y', "Y Forward", ""),
+                   ('Z', "Z Forward", ""),
+                   ('-X', "-X Forward", ""),
+                   ('-Y', "-Y Forward", ""),
+                   ('-Z', "-Z Forward", ""),
+                   ),
+            default='-Z',
+            )
+    axis_up = EnumProperty(
+            name="Up",
+            items=(('X', "X Up", ""),
+                   ('Y', "Y Up", ""),
+                   ('Z', "Z Up", ""),
+                   ('-X', "-X Up", ""),
+                   ('-Y', "-Y Up", ""),
+                   ('-Z', "-Z Up", ""),
+                   ),
+            default='Y',
+            )
+    use_mesh_modifiers = BoolProperty(
+            name="Apply Modifiers",
+            description="Apply modifiers to mesh objects",
+            default=True,
+            )
+    use_tangents = BoolProperty(
+            name="Tangents",
+            description="Write tangents (with the binormal sign) computed "
+                        "for the active UV layer",
+            default=True,
+            )
+    use_quantize = BoolProperty(
+            name="Quantize",
+            description="Write half float UVs, packed 10 bits normals and "
+                        "tangents, and 8 bits bone indices and weights",
+            default=False,
+            )
+    use_anim = BoolProperty(
+            name="Animation",
+            description="Write the armature's actions as animation clips",
+            default=True,
+            )
+    use_anim_action_all = BoolProperty(
+            name="All Actions",
+            description=("Write all actions compatible with the armature, "
+                         "not only its current one"),
+            default=True,
+            )
+
+    def execute(self, context):
+        from mathutils import Matrix
+        if not self.filepath:
+            raise Exception("filepath not set")
+
+        global_matrix = (Matrix.Scale(self.global_scale, 4) *
+                         axis_conversion(to_forward=self.axis_forward,
+                                         to_up=self.axis_up,
+                                         ).to_4x4())
+
+        keywords = self.as_keywords(ignore=("axis_forward",
+                                            "axis_up",
+                                            "global_scale",
+                                            "check_existing",
+                                            "filter_glob",
+                                            ))
+
+        keywords["global_matrix"] = global_matrix
+
+        from . import export_lemma
+        return export_lemma.save(self, context, **keywords)
+
+
 def menu_func_import(self, context):
     self.layout.operator(ImportFBX.bl_idname, text="Autodesk FBX (.fbx)")
 
 
 def menu_func_export(self, context):
     self.layout.operator(ExportFBX.bl_idname, text="Autodesk FBX (.fbx)")
+    self.layout.operator(ExportLemma.bl_idname, text="Lemma Model (.lmdl)")
 
 
 def register():
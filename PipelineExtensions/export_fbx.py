@@ -22,35 +22,598 @@
 
 
 import os
+import re
+import hashlib
 import time
 import math  # math.pi
 
-import bpy
-from mathutils import Vector, Matrix
+# Only missing outside of Blender, where just the helpers not touching Blender data can be used (see tests).
+try:
+    import bpy
+    from mathutils import Vector, Matrix
+except ImportError:
+    bpy = Vector = Matrix = None
+
+# Optional, only used to speed up processing of big mesh arrays.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Default precision of each category of written floats, None meaning shortest round-trip formatting.
+FLOAT_PRECISION_DEFAULTS = {'position': 6,
+                            'normal': 6,
+                            'uv': 6,
+                            'color': 6,
+                            'weight': 8,
+                            'matrix': 15,
+                            'key': 15,
+                            }
+
+# Categories of mesh data, which XNA keeps as 32 bits floats: the only ones shortest round-trip formatting applies to.
+FLOAT_CATEGORIES_MESH = {'position', 'normal', 'uv', 'color', 'weight'}
+
+
+def float32_shortest_strs(values):
+    """
+    Return the list of the shortest strings reading back as the same 32 bits floats as values
+    (XNA only keeps 32 bits floats anyway).
+    """
+    if numpy is not None:
+        strs = numpy.asarray(values, dtype=numpy.float32).astype(str).tolist()
+        # numpy switches to exponent notation with other rules than python, use python's ones.
+        return [repr(float(s)) if 'e' in s else s for s in strs]
+    import struct
+    f32 = struct.Struct('f')
+    strs = []
+    for v in values:
+        v = f32.unpack(f32.pack(v))[0]
+        for p in range(1, 10):
+            s = '%.*g' % (p, v)
+            if f32.unpack(f32.pack(float(s)))[0] == v:
+                break
+        # Same output as numpy.
+        strs.append(repr(float(s)))
+    return strs
+
+
+def floats_to_str(values, precision):
+    """
+    Comma separated values, formatted with given precision, or shortest round-trip if precision is None.
+    """
+    if precision is None:
+        return ','.join(float32_shortest_strs(values))
+    return ','.join(('%%.%df' % precision,) * len(values)) % tuple(values)
+
+
+# Printf formats of each array value kind.
+ARRAY_KIND_FORMATS = {'i': '%i', 'b': '%d', 'f': '%%.%df'}
+
+
+def array_item_fmt(kind, precision=6, suffix=""):
+    """
+    Format string of one array item, kind giving the kind of each of its values: 'i' for ints, 'b' for bools,
+    'f' for floats (written with given precision, or shortest round-trip if precision is None, in which case floats
+    must be given as strings, see shortest_float_values()).
+    E.g. array_item_fmt('ff') == '%.6f,%.6f' for an UV.
+    """
+    if precision is None:
+        return ','.join('%s' if k == 'f' else ARRAY_KIND_FORMATS[k] for k in kind) + suffix
+    return ','.join(ARRAY_KIND_FORMATS[k] % precision if k == 'f' else ARRAY_KIND_FORMATS[k] for k in kind) + suffix
+
+
+def shortest_float_values(values, kind):
+    """
+    Return values with the float ones (as given by kind, see array_item_fmt()) replaced by their shortest
+    round-trip strings.
+    """
+    if kind == 'f' * len(kind):
+        return float32_shortest_strs(values)
+    values = values.tolist() if hasattr(values, "tolist") else list(values)
+    width = len(kind)
+    for k, c in enumerate(kind):
+        if c == 'f':
+            values[k::width] = float32_shortest_strs(values[k::width])
+    return values
+
+
+def array_to_str(values, fmt, chunk_size, sep, width=1):
+    """
+    Format a whole flat sequence at once, chunk_size items per line, lines being joined by sep.
+    Each item is made of width values, which fmt must consume (e.g. '%.6f,%.6f' for UVs).
+
+    With width=1, gives exactly the same string as:
+    sep.join(','.join(fmt % v for v in values[i:i + chunk_size]) for i in range(0, len(values), chunk_size))
+
+    but builds a single format string and applies it in one go, which is much faster on big arrays.
+    values may be any sequence, including numpy arrays.
+    """
+    if hasattr(values, "tolist"):
+        values = values.tolist()
+    values = tuple(values)
+    if not values:
+        return ""
+    nbr_lines, rest = divmod(len(values) // width, chunk_size)
+    lines = [','.join((fmt,) * chunk_size)] * nbr_lines
+    if rest:
+        lines.append(','.join((fmt,) * rest))
+    return sep.join(lines) % values
+
+
+def write_array(fw, values, kind, chunk_size, sep, precision=6, suffix="", slice_size=0):
+    """
+    Write a whole array block, values being a flat sequence (list, array.array, numpy array or iterator) of items
+    made of len(kind) values each (see array_item_fmt()), chunk_size items per line, lines being joined by sep.
+    precision None means shortest round-trip formatting of floats.
+
+    Everything is formatted in one go and written in a single call, unless slice_size is non-zero, in which case
+    values are formatted and written about slice_size values at a time (rounded to whole lines), so that memory used
+    by the formatting stays bounded whatever the size of values.
+    """
+    fmt = array_item_fmt(kind, precision, suffix)
+    width = len(kind)
+    shortest = precision is None and 'f' in kind
+    if not slice_size:
+        if shortest:
+            values = shortest_float_values(values, kind)
+        fw(array_to_str(values, fmt, chunk_size, sep, width))
+        return
+    step = max(1, slice_size // (chunk_size * width)) * chunk_size * width
+    if hasattr(values, "__getitem__"):
+        slices = (values[i:i + step] for i in range(0, len(values), step))
+    else:
+        import itertools
+        it = iter(values)
+        slices = iter(lambda: tuple(itertools.islice(it, step)), ())
+    for i, vals in enumerate(slices):
+        if i:
+            fw(sep)
+        if shortest:
+            vals = shortest_float_values(vals, kind)
+        fw(array_to_str(vals, fmt, chunk_size, sep, width))
+
+
+# array module typecodes matching RNA raw types, there is no bool one.
+ARRAY_TYPECODES = {"float32": 'f', "int32": 'i'}
+
+
+def foreach_get_array(seq, attr, size, dtype, use_numpy, use_compact=False):
+    """
+    Return the attr values of all items in seq, as a flat typed numpy array of given dtype (e.g. "float32")
+    if use_numpy is set, else as a compact array.array if use_compact is set (and dtype is supported),
+    else as a plain list.
+    """
+    if use_numpy:
+        arr = numpy.empty(size, dtype=dtype)
+    elif use_compact and dtype in ARRAY_TYPECODES:
+        import array
+        arr = array.array(ARRAY_TYPECODES[dtype], (0,)) * size
+    else:
+        arr = [None] * size
+    seq.foreach_get(attr, arr)
+    return arr
+
+def dedup_items(values, width, use_numpy, tolerance=0.0):
+    """
+    Deduplicate the items (made of width values each) of flat sequence values, as needed by IndexToDirect layers.
+
+    Returns a (unique, indices) tuple, unique being the flat sequence of the unique items' values, in order of first
+    occurrence, and indices giving for each item of values its index in unique. Results do not depend on hashing
+    order, so they are the same for every export of the same data, and the same with or without numpy.
+
+    If tolerance is non-zero, values are compared once snapped to a grid of that size, and the first item of each
+    group is the one kept in unique.
+    """
+    if use_numpy:
+        arr = numpy.asarray(values).reshape(-1, width)
+        if not len(arr):
+            return arr.reshape(-1), numpy.empty(0, dtype=numpy.int32)
+        if tolerance:
+            keys = numpy.floor(arr.astype(numpy.float64) / tolerance + 0.5).astype(numpy.int64)
+        else:
+            # Compare raw bits, with -0.0 turned into 0.0 so that they match like they do in python.
+            keys = numpy.ascontiguousarray(arr + arr.dtype.type(0))
+            keys = keys.view(numpy.dtype("u%d" % keys.dtype.itemsize))
+        first, indices = numpy.unique(keys, axis=0, return_index=True, return_inverse=True)[1:]
+        order = numpy.argsort(first)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+        return arr[first[order]].reshape(-1), rank[indices.reshape(-1)]
+    else:
+        import array
+        item2idx = {}
+        unique = []
+
+        def item_index(item):
+            key = tuple(math.floor(v / tolerance + 0.5) for v in item) if tolerance else item
+            idx = item2idx.get(key)
+            if idx is None:
+                idx = item2idx[key] = len(item2idx)
+                unique.extend(item)
+            return idx
+        indices = array.array('i', map(item_index, zip(*[iter(values)] * width)))
+        return unique, indices
+
+def unique_pairs(t_a, t_b, size_b, use_numpy):
+    """
+    Find the distinct (a, b) pairs of two same-sized arrays of small non-negative ints (b < size_b), t_b being None
+    meaning all zero.
+
+    Returns a (pairs, indices) tuple, pairs being a list of (a, b) tuples, and indices giving for each element the
+    index of its pair in pairs. Used e.g. to only resolve (material, image) once per distinct polygon combination.
+    """
+    if use_numpy:
+        codes = numpy.asarray(t_a, dtype=numpy.int64) * size_b
+        if t_b is not None:
+            codes += numpy.asarray(t_b)
+        codes, indices = numpy.unique(codes, return_inverse=True)
+        return [divmod(c, size_b) for c in codes.tolist()], indices.reshape(-1)
+    else:
+        import array
+        code2idx = {}
+        pairs = []
+
+        def pair_index(a, b):
+            idx = code2idx.get((a, b))
+            if idx is None:
+                idx = code2idx[a, b] = len(pairs)
+                pairs.append((a, b))
+            return idx
+        if t_b is None:
+            t_b = [0] * len(t_a)
+        indices = array.array('i', map(pair_index, t_a, t_b))
+        return pairs, indices
+
+def take_items(values, indices, width, use_numpy):
+    """
+    Return the flat sequence of the items (made of width values each) of flat sequence values at given indices.
+    """
+    if use_numpy:
+        return numpy.asarray(values).reshape(-1, width)[numpy.asarray(indices, dtype=numpy.intp)].reshape(-1)
+    elif width == 1:
+        return [values[i] for i in indices]
+    else:
+        return [v for i in indices for v in values[i * width:(i + 1) * width]]
+
+def weld_vertices(nbr_verts, t_vi, layers_ids, use_numpy, use_split=True):
+    """
+    Turn per loop layers into per control point (i.e. vertex) ones, as needed by ByVertice mapping.
+
+    t_vi gives the vertex of each loop, and layers_ids for each layer the per loop indices of its (deduplicated)
+    items. If use_split is set, vertices are split until all layers are constant per vertex, the first copy of each
+    vertex keeping its index, extra ones being appended after the original vertices. Else, only layers that already
+    are constant per vertex are converted, and vertices are left untouched.
+
+    Returns a (vert_map, t_vi, cp_ids) tuple, vert_map giving the original vertex of each written one (None if no
+    vertex was split), t_vi the loops' new vertices, and cp_ids for each layer the per vertex indices of its items
+    (None if the layer could not be converted). Vertices used by no loop get item 0.
+    """
+    if not use_split:
+        cp_ids = []
+        for ids in layers_ids:
+            vert_map, _t_vi, (ids,) = weld_vertices(nbr_verts, t_vi, (ids,), use_numpy)
+            cp_ids.append(ids if vert_map is None else None)
+        return None, t_vi, cp_ids
+
+    width = len(layers_ids) + 1
+    if use_numpy:
+        rows = numpy.stack([numpy.asarray(t_vi, dtype=numpy.int64)] +
+                           [numpy.asarray(ids, dtype=numpy.int64) for ids in layers_ids], axis=1)
+        rows, row_ids = dedup_items(rows.reshape(-1), width, True)
+        rows = rows.reshape(-1, width)
+        verts = rows[:, 0]
+        is_extra = numpy.ones(len(rows), dtype=bool)
+        is_extra[numpy.unique(verts, return_index=True)[1]] = False
+        extra = verts[is_extra]
+        new_idx = verts.copy()
+        new_idx[is_extra] = numpy.arange(nbr_verts, nbr_verts + len(extra))
+        vert_map = numpy.concatenate((numpy.arange(nbr_verts), extra)) if len(extra) else None
+        cp_ids = []
+        for l in range(1, width):
+            ids = numpy.zeros(nbr_verts + len(extra), dtype=numpy.int64)
+            ids[new_idx] = rows[:, l]
+            cp_ids.append(ids)
+        return vert_map, new_idx[row_ids], cp_ids
+    else:
+        rows, row_ids = dedup_items([v for row in zip(t_vi, *layers_ids) for v in row], width, False)
+        seen = set()
+        extra = []
+        new_idx = []
+        for v in rows[::width]:
+            if v in seen:
+                new_idx.append(nbr_verts + len(extra))
+                extra.append(v)
+            else:
+                seen.add(v)
+                new_idx.append(v)
+        vert_map = list(range(nbr_verts)) + extra if extra else None
+        cp_ids = []
+        for l in range(1, width):
+            ids = [0] * (nbr_verts + len(extra))
+            for v, i in zip(new_idx, rows[l::width]):
+                ids[v] = i
+            cp_ids.append(ids)
+        return vert_map, [new_idx[i] for i in row_ids], cp_ids
+
+def loop_binormals(t_vn, t_tn, t_bs, use_numpy):
+    """
+    Return the flat per loop binormals matching given flat loop normals, tangents and bitangent signs, the same way
+    MikkTSpace defines them (sign * cross(normal, tangent)).
+    """
+    if use_numpy:
+        t_bn = numpy.cross(numpy.asarray(t_vn).reshape(-1, 3), numpy.asarray(t_tn).reshape(-1, 3))
+        t_bn *= numpy.asarray(t_bs).reshape(-1, 1)
+        return t_bn.reshape(-1)
+    else:
+        return [c for (nx, ny, nz), (tx, ty, tz), s in zip(zip(*[iter(t_vn)] * 3), zip(*[iter(t_tn)] * 3), t_bs)
+                for c in (s * (ny * tz - nz * ty), s * (nz * tx - nx * tz), s * (nx * ty - ny * tx))]
+
+# Size of the post-transform vertex cache polygons are ordered for (and ACMR is measured with).
+VERTEX_CACHE_SIZE = 32
+
+
+def cache_optimize_polygons(t_vi, t_ls, nbr_verts, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Return the order in which to write polygons for post-transform vertex cache locality, following Tom Forsyth's
+    "Linear-Speed Vertex Cache Optimisation" (with an LRU cache model, polygons being handled like triangles).
+    """
+    import heapq
+    t_vi = t_vi.tolist() if hasattr(t_vi, "tolist") else list(t_vi)
+    t_ls = t_ls.tolist() if hasattr(t_ls, "tolist") else list(t_ls)
+    nbr_polys = len(t_ls)
+    poly_verts = [t_vi[ls:le] for ls, le in zip(t_ls, t_ls[1:] + [len(t_vi)])]
+    vert_polys = [[] for i in range(nbr_verts)]
+    for p, verts in enumerate(poly_verts):
+        for v in verts:
+            vert_polys[v].append(p)
+
+    # Score bonus of vertices by cache position, the ones of the last polygon all getting the same one.
+    cache_scores = [0.75] * 3 + [(1.0 - (pos - 3) / (cache_size - 3)) ** 1.5 for pos in range(3, cache_size)]
+
+    def vert_score(v, pos=-1):
+        nbr_left = len(vert_polys[v])
+        if not nbr_left:
+            return -1.0
+        # Favor vertices with few polygons left, so that they get done with.
+        score = 2.0 / math.sqrt(nbr_left)
+        if pos >= 0:
+            score += cache_scores[pos]
+        return score
+
+    def poly_score_uncached(p):
+        return sum(vert_score(v) for v in poly_verts[p])
+
+    vert_scores = [vert_score(v) for v in range(nbr_verts)]
+    poly_done = [False] * nbr_polys
+    order = []
+    cache = []
+    # Scores of polygons as if none of their vertices were cached, to restart from when the cache has no polygon
+    # left around it. Entries are pushed again each time a score changes, outdated ones being skipped when popped.
+    poly_heap = [(-poly_score_uncached(p), p) for p in range(nbr_polys)]
+    heapq.heapify(poly_heap)
+    best = -1
+    while len(order) < nbr_polys:
+        while best < 0:
+            # Start again from the best scoring remaining polygon (none of them has cached vertices by now).
+            score, p = heapq.heappop(poly_heap)
+            if not poly_done[p] and -score == poly_score_uncached(p):
+                best = p
+        order.append(best)
+        poly_done[best] = True
+        verts = poly_verts[best]
+        for v in verts:
+            vert_polys[v].remove(best)
+        for v in verts:
+            for p in vert_polys[v]:
+                heapq.heappush(poly_heap, (-poly_score_uncached(p), p))
+
+        # Move the polygon's vertices to the front of the cache.
+        verts_set = set(verts)
+        new_cache = verts + [v for v in cache if v not in verts_set]
+        cache = new_cache[:cache_size]
+        for v in new_cache[cache_size:]:
+            vert_scores[v] = vert_score(v)
+        for pos, v in enumerate(cache):
+            vert_scores[v] = vert_score(v, pos)
+
+        # Next polygon is the best scoring one using cached vertices.
+        best = -1
+        best_score = -1.0
+        for v in cache:
+            for p in vert_polys[v]:
+                score = sum(vert_scores[u] for u in poly_verts[p])
+                if score > best_score:
+                    best = p
+                    best_score = score
+    return order
+
+def polygons_loops_order(t_ls, nbr_loops, poly_order, use_numpy):
+    """
+    Return the (loop_start, loop_order) of polygons once written in poly_order, loop_order giving the previous index
+    of each loop.
+    """
+    if use_numpy:
+        t_ls = numpy.asarray(t_ls, dtype=numpy.int64)
+        poly_order = numpy.asarray(poly_order, dtype=numpy.int64)
+        sizes = numpy.diff(numpy.append(t_ls, nbr_loops))[poly_order]
+        new_ls = numpy.zeros(len(sizes), dtype=numpy.int64)
+        numpy.cumsum(sizes[:-1], out=new_ls[1:])
+        loop_order = numpy.repeat(t_ls[poly_order] - new_ls, sizes) + numpy.arange(nbr_loops)
+        return new_ls, loop_order
+    else:
+        ends = list(t_ls[1:]) + [nbr_loops]
+        new_ls = []
+        loop_order = []
+        for p in poly_order:
+            new_ls.append(len(loop_order))
+            loop_order.extend(range(t_ls[p], ends[p]))
+        return new_ls, loop_order
+
+def fetch_optimize_vertices(t_vi, nbr_verts, use_numpy):
+    """
+    Return the (vert_order, vert_remap) of vertices sorted by first use in t_vi for vertex fetch locality (unused ones
+    last), vert_order giving the previous index of each vertex, and vert_remap the new index of each previous one.
+    """
+    if use_numpy:
+        used, first = numpy.unique(t_vi, return_index=True)
+        used = used[numpy.argsort(first)]
+        vert_order = numpy.concatenate((used, numpy.setdiff1d(numpy.arange(nbr_verts), used))).astype(numpy.int64)
+        vert_remap = numpy.empty(nbr_verts, dtype=numpy.int64)
+        vert_remap[vert_order] = numpy.arange(nbr_verts)
+    else:
+        vert_order = []
+        vert_remap = [-1] * nbr_verts
+        for v in list(t_vi) + list(range(nbr_verts)):
+            if vert_remap[v] < 0:
+                vert_remap[v] = len(vert_order)
+                vert_order.append(v)
+    return vert_order, vert_remap
+
+def mesh_acmr(t_vi, t_ls, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Return the average cache miss ratio (transformed vertices per triangle) of polygons drawn in given order through
+    a FIFO post-transform cache of given size.
+    """
+    import collections
+    fifo = collections.deque()
+    cached = set()
+    misses = 0
+    for v in (t_vi.tolist() if hasattr(t_vi, "tolist") else t_vi):
+        if v not in cached:
+            misses += 1
+            cached.add(v)
+            fifo.append(v)
+            if len(fifo) > cache_size:
+                cached.discard(fifo.popleft())
+    nbr_tris = len(t_vi) - 2 * len(t_ls)
+    return misses / nbr_tris if nbr_tris > 0 else 0.0
+
+def mesh_triangulate(me):
+    """
+    Triangulate all polygons of given mesh in place (use on exporter-owned copies only!).
+    """
+    import bmesh
+    bm = bmesh.new()
+    bm.from_mesh(me)
+    bmesh.ops.triangulate(bm, faces=bm.faces)
+    bm.to_mesh(me)
+    bm.free()
+    me.update()
+
 
-def grouper_exact(it, chunk_size):
+# Most vertices a mesh can have to be drawn with 16 bit indices.
+MESH_SPLIT_MAX_VERTS = 0xffff
+
+# bmesh.ops.delete() contexts, ints (DEL_VERTS, DEL_FACES) before 2.80's string enums.
+if bpy is None or bpy.app.version < (2, 80, 0):
+    BMESH_DELETE_VERTS, BMESH_DELETE_FACES = 1, 5
+else:
+    BMESH_DELETE_VERTS, BMESH_DELETE_FACES = 'VERTS', 'FACES'
+
+
+def mesh_render_vertices(me, use_numpy):
     """
-    Grouper-like func, but returns exactly all elements from it:
+    Return the (per loop ids, count) of the vertices a renderer needs for given mesh, one per unique combination of
+    vertex, split normal, UVs and vertex colors.
+    """
+    nbr_loops = len(me.loops)
+    t_vi = foreach_get_array(me.loops, "vertex_index", nbr_loops, "int32", use_numpy)
+    me.calc_normals_split()
+    t_vn = foreach_get_array(me.loops, "normal", nbr_loops * 3, "float32", use_numpy)
+    me.free_normals_split()
+    layers_ids = [dedup_items(t_vn, 3, use_numpy)[1]]
+    del t_vn
+    for uvlayer in me.uv_layers:
+        layers_ids.append(dedup_items(foreach_get_array(uvlayer.data, "uv", nbr_loops * 2, "float32", use_numpy),
+                                      2, use_numpy)[1])
+    for collayer in me.vertex_colors:
+        layers_ids.append(dedup_items(foreach_get_array(collayer.data, "color", nbr_loops * 3, "float32", use_numpy),
+                                      3, use_numpy)[1])
+
+    width = len(layers_ids) + 1
+    if use_numpy:
+        rows = numpy.stack([numpy.asarray(t_vi, dtype=numpy.int64)] +
+                           [numpy.asarray(ids, dtype=numpy.int64) for ids in layers_ids], axis=1).reshape(-1)
+    else:
+        rows = [v for row in zip(t_vi, *layers_ids) for v in row]
+    rows, t_rv = dedup_items(rows, width, use_numpy)
+    return t_rv, len(rows) // width
 
-    >>> for chunk in grouper_exact(range(10), 3): print(e)
-    (0,1,2)
-    (3,4,5)
-    (6,7,8)
-    (9,)
 
-    About 2 times slower than simple zip(*[it] * 3), but does not need to convert iterator to sequence to be sure to
-    get exactly all elements in it (i.e. get a last chunk that may be smaller than chunk_size).
+def morton_spread(v):
     """
-    import itertools
-    i = itertools.zip_longest(*[iter(it)] * chunk_size, fillvalue=...)
-    curr = next(i)
-    for nxt in i:
-        yield curr
-        curr = nxt
-    if ... in curr:
-        yield curr[:curr.index(...)]
+    Spread the 10 low bits of v (int or numpy array) every 3 bits.
+    """
+    v = (v | (v << 16)) & 0x030000ff
+    v = (v | (v << 8)) & 0x0300f00f
+    v = (v | (v << 4)) & 0x030c30c3
+    v = (v | (v << 2)) & 0x09249249
+    return v
+
+
+def split_polygons(t_rv, t_ls, t_mi, t_pc, max_verts, use_numpy):
+    """
+    Return the lists of polygons of the parts a mesh has to be split into so that none uses more than max_verts
+    of the render vertices t_rv (see mesh_render_vertices). Polygons are grouped by material (t_mi), then by spatial
+    locality (Morton order of their centers t_pc), before filling parts in that order.
+    """
+    nbr_polys = len(t_ls)
+    if use_numpy:
+        t_pc = numpy.asarray(t_pc, dtype=numpy.float64).reshape(-1, 3)
+        co_min = t_pc.min(axis=0)
+        co_size = numpy.maximum(t_pc.max(axis=0) - co_min, 1e-9)
+        q = numpy.clip(((t_pc - co_min) / co_size * 1023.0).astype(numpy.int64), 0, 1023)
+        codes = morton_spread(q[:, 0]) | (morton_spread(q[:, 1]) << 1) | (morton_spread(q[:, 2]) << 2)
+        poly_order = numpy.lexsort((codes, numpy.asarray(t_mi))).tolist()
+        t_rv = t_rv.tolist()
+        t_ls = list(t_ls) if not hasattr(t_ls, "tolist") else t_ls.tolist()
     else:
-        yield curr
+        cos = [t_pc[i::3] for i in range(3)]
+        co_min = [min(co) for co in cos]
+        co_size = [max(max(co) - m, 1e-9) for co, m in zip(cos, co_min)]
+        codes = [0] * nbr_polys
+        for i, co in enumerate(zip(*cos)):
+            q = [min(max(int((c - m) / s * 1023.0), 0), 1023) for c, m, s in zip(co, co_min, co_size)]
+            codes[i] = morton_spread(q[0]) | (morton_spread(q[1]) << 1) | (morton_spread(q[2]) << 2)
+        poly_order = sorted(range(nbr_polys), key=lambda p: (t_mi[p], codes[p]))
+        t_ls = list(t_ls)
+
+    ends = t_ls[1:] + [len(t_rv)]
+    parts = []
+    polys = []
+    verts = set()
+    for p in poly_order:
+        poly_verts = set(t_rv[t_ls[p]:ends[p]])
+        if len(verts) + len(poly_verts - verts) > max_verts:
+            parts.append(polys)
+            polys = []
+            verts = set()
+        polys.append(p)
+        verts |= poly_verts
+    if polys:
+        parts.append(polys)
+    return parts
+
+
+def mesh_extract_polygons(me, polys):
+    """
+    Return a (mesh, vert_orig) tuple, mesh being a new mesh made of the given polygons of me (and of their vertices
+    only), and vert_orig the index in me of each of its vertices.
+    """
+    import bmesh
+    bm = bmesh.new()
+    bm.from_mesh(me)
+    keep = set(polys)
+    bmesh.ops.delete(bm, geom=[f for i, f in enumerate(bm.faces) if i not in keep], context=BMESH_DELETE_FACES)
+    bmesh.ops.delete(bm, geom=[v for v in bm.verts if not v.link_faces], context=BMESH_DELETE_VERTS)
+    # Indices are only updated by to_mesh, they still are the ones of me.
+    vert_orig = [v.index for v in bm.verts]
+    part = me.copy()
+    bm.to_mesh(part)
+    bm.free()
+    part.update()
+    return part, vert_orig
 
 # I guess FBX uses degrees instead of radians (Arystan).
 # Call this function just before writing to FBX.
@@ -58,6 +621,370 @@ def grouper_exact(it, chunk_size):
 def tuple_rad_to_deg(eul):
     return eul[0] * 57.295779513, eul[1] * 57.295779513, eul[2] * 57.295779513
 
+
+def matrix_array_to_eulers(mats):
+    """
+    Return the two XYZ euler solutions (in radians) of a (..., 3, 3) numpy array of rotation matrices (which may
+    be scaled), as two (..., 3) arrays, following mathutils' Matrix.to_euler().
+    """
+    mats = mats / numpy.maximum(numpy.linalg.norm(mats, axis=-2), 1e-30)[..., None, :]
+    cy = numpy.hypot(mats[..., 0, 0], mats[..., 1, 0])
+    is_gimbal = cy <= 16.0 * numpy.finfo(numpy.float32).eps
+    eul1 = numpy.stack((numpy.where(is_gimbal, numpy.arctan2(-mats[..., 1, 2], mats[..., 1, 1]),
+                                    numpy.arctan2(mats[..., 2, 1], mats[..., 2, 2])),
+                        numpy.arctan2(-mats[..., 2, 0], cy),
+                        numpy.where(is_gimbal, 0.0, numpy.arctan2(mats[..., 1, 0], mats[..., 0, 0]))), axis=-1)
+    eul2 = numpy.stack((numpy.arctan2(-mats[..., 2, 1], -mats[..., 2, 2]),
+                        numpy.arctan2(-mats[..., 2, 0], -cy),
+                        numpy.arctan2(-mats[..., 1, 0], -mats[..., 0, 0])), axis=-1)
+    eul2[is_gimbal] = eul1[is_gimbal]
+    return eul1, eul2
+
+
+def euler_compatible_array(eul, prev):
+    """
+    Return (N, 3) euler array eul made compatible with (N, 3) euler array prev (no axis jumping by more than half
+    a turn), as mathutils' Euler.make_compatible() does.
+    """
+    pi_x2 = 2.0 * math.pi
+    eul = eul.copy()
+    deul = eul - prev
+    eul -= numpy.where(deul > 5.1, numpy.floor(deul / pi_x2 + 0.5) * pi_x2, 0.0)
+    eul += numpy.where(deul < -5.1, numpy.floor(-deul / pi_x2 + 0.5) * pi_x2, 0.0)
+    deul = numpy.abs(eul - prev)
+    # One axis turned by more than half a turn while the other two barely moved.
+    for i in range(3):
+        is_flip = (deul[:, i] > 3.2) & (deul[:, (i + 1) % 3] < 1.6) & (deul[:, (i + 2) % 3] < 1.6)
+        eul[:, i] -= numpy.where(is_flip, numpy.copysign(pi_x2, eul[:, i] - prev[:, i]), 0.0)
+    return eul
+
+
+def matrix_array_rotation(angle, axes):
+    """
+    Return the (..., 3, 3) numpy array of the rotations of angle (radians) around each of the (..., 3) axes,
+    as Matrix.Rotation() does.
+    """
+    axes = axes / numpy.maximum(numpy.linalg.norm(axes, axis=-1), 1e-30)[..., None]
+    x, y, z = axes[..., 0], axes[..., 1], axes[..., 2]
+    zero = numpy.zeros_like(x)
+    cross = numpy.stack((numpy.stack((zero, -z, y), axis=-1),
+                         numpy.stack((z, zero, -x), axis=-1),
+                         numpy.stack((-y, x, zero), axis=-1)), axis=-2)
+    outer = axes[..., :, None] * axes[..., None, :]
+    return numpy.eye(3) * math.cos(angle) + cross * math.sin(angle) + outer * (1.0 - math.cos(angle))
+
+
+def anim_rel_matrices(world, parents):
+    """
+    Return the parent relative matrices of N objects over F frames, world being an (N, F, 4, 4) numpy array
+    of the matrices of the objects children are animated relative to, and parents the index of each object's
+    parent in it (-1 for none). Each parent's matrices are only inverted once, whatever its children count.
+    """
+    parents = numpy.asarray(parents, dtype=numpy.intp)
+    has_parent = parents >= 0
+    rel = world.copy()
+    if has_parent.any():
+        used = numpy.unique(parents[has_parent])
+        world_inv = numpy.empty_like(world)
+        world_inv[used] = numpy.linalg.inv(world[used])
+        rel[has_parent] = numpy.matmul(world_inv[parents[has_parent]], world[has_parent])
+    return rel
+
+
+def anim_channels_solve(rel, rot, rot_frames=None):
+    """
+    Decompose (N, F, 4, 4) parent relative matrices and their (N, F, 3, 3) rotation matrices (see
+    getAnimParRelMatrixRot()) of N objects over F frames.
+
+    Returns (N, F, 3) numpy arrays of locations, XYZ eulers in degrees and scales, eulers being kept continuous
+    along frames as chained Matrix.to_euler('XYZ', prev_eul) calls would.
+
+    rot_frames, an (N, K) index array, restricts eulers to those frames of each object (the others are left 0),
+    kept continuous from one of them to the next. A frame may be repeated at the end to pad rows to K.
+    """
+    loc = rel[..., :3, 3]
+    scale = numpy.linalg.norm(rel[..., :3, :3], axis=-2)
+
+    if rot_frames is not None:
+        rot_rows = numpy.arange(len(rot))[:, None]
+        rot = rot[rot_rows, rot_frames]
+
+    eul1, eul2 = matrix_array_to_eulers(rot)
+    eul = numpy.empty_like(eul1)
+    # First frame gets the smallest solution, the next ones the closest to their previous frame.
+    eul[:, 0] = numpy.where((numpy.abs(eul1[:, 0]).sum(axis=-1) > numpy.abs(eul2[:, 0]).sum(axis=-1))[:, None],
+                            eul2[:, 0], eul1[:, 0])
+    for f in range(1, eul.shape[1]):
+        prev = eul[:, f - 1]
+        eul_a = euler_compatible_array(eul1[:, f], prev)
+        eul_b = euler_compatible_array(eul2[:, f], prev)
+        is_b = numpy.abs(eul_a - prev).sum(axis=-1) > numpy.abs(eul_b - prev).sum(axis=-1)
+        eul[:, f] = numpy.where(is_b[:, None], eul_b, eul_a)
+
+    if rot_frames is not None:
+        eul_frames, eul = eul, numpy.zeros_like(loc)
+        eul[rot_rows, rot_frames] = eul_frames
+
+    return loc, numpy.degrees(eul), scale
+
+
+def anim_keys_reduce(values, tolerance):
+    """
+    Return the indices of the keys to keep of a linearly interpolated channel (one value per frame), dropping the
+    ones flat or collinear with their neighbours within tolerance.
+
+    Keeps the same keys as deleting them one by one from a list, walking it backwards, did: once a key is dropped,
+    the kept key on its right is checked again against its new neighbours. The kept keys are a stack, each key
+    being pushed and popped at most once, so it runs in linear time.
+    """
+    nbr_keys = len(values)
+    if nbr_keys < 3:
+        return list(range(nbr_keys))
+    # Keys left of j are all there, kept ones right of it are in the stack (top is the one next to j).
+    kept = [nbr_keys - 1]
+    j = cur = nbr_keys - 2
+    while j > 0:
+        prev = j - 1
+        nxt = kept[-1]
+        val_prev, val, val_next = values[prev], values[cur], values[nxt]
+        # co-linear horizontal...
+        if abs(val - val_prev) < tolerance and abs(val - val_next) < tolerance:
+            is_kept = False
+        else:
+            fac = (nxt - cur) / float(nxt - prev)
+            is_kept = abs((val_prev * fac + val_next * (1.0 - fac)) - val) >= tolerance
+        if is_kept:
+            kept.append(cur)
+            j = cur = j - 1
+        elif len(kept) > 1:
+            # Check the key on the right again.
+            cur = kept.pop()
+        else:
+            # ... unless it is the last one.
+            j = cur = j - 1
+    kept.append(0)
+    kept.reverse()
+    return kept
+
+
+def anim_keys_reduce_array(values, tolerance):
+    """
+    Vectorized anim_keys_reduce() of all channels at once, values being a (channels, frames) numpy array.
+
+    Each step moves every channel one key left, or back right onto its last kept key, so all channels are done
+    after at most twice as many steps as there are frames.
+    Returns a (channels, frames) bool numpy array of the keys to keep.
+    """
+    nbr_chans, nbr_keys = values.shape
+    if nbr_keys < 3:
+        return numpy.ones((nbr_chans, nbr_keys), dtype=bool)
+    chans = numpy.arange(nbr_chans)
+    kept = numpy.empty((nbr_chans, nbr_keys), dtype=numpy.int64)
+    kept[:, 0] = nbr_keys - 1
+    nbr_kept = numpy.ones(nbr_chans, dtype=numpy.int64)
+    j = numpy.full(nbr_chans, nbr_keys - 2, dtype=numpy.int64)
+    cur = j.copy()
+    while True:
+        act = numpy.flatnonzero(j > 0)
+        if not len(act):
+            break
+        j_act, cur_act, nbr_kept_act = j[act], cur[act], nbr_kept[act]
+        prev = j_act - 1
+        nxt = kept[act, nbr_kept_act - 1]
+        val_prev, val, val_next = values[act, prev], values[act, cur_act], values[act, nxt]
+        fac = (nxt - cur_act) / (nxt - prev).astype(numpy.float64)
+        is_flat = (numpy.abs(val - val_prev) < tolerance) & (numpy.abs(val - val_next) < tolerance)
+        is_linear = numpy.abs((val_prev * fac + val_next * (1.0 - fac)) - val) < tolerance
+        is_kept = ~(is_flat | is_linear)
+        is_back = ~is_kept & (nbr_kept_act > 1)
+        # Kept keys are pushed, dropped ones make the key on their right current again (unless it is the last one).
+        kept[act[is_kept], nbr_kept_act[is_kept]] = cur_act[is_kept]
+        nbr_kept[act] += is_kept
+        nbr_kept[act] -= is_back
+        cur[act] = numpy.where(is_back, nxt, j_act - 1)
+        j[act] -= ~is_back
+    keep = numpy.zeros((nbr_chans, nbr_keys), dtype=bool)
+    keep[:, 0] = True
+    in_stack = numpy.arange(nbr_keys) < nbr_kept[:, None]
+    keep[numpy.repeat(chans, nbr_kept), kept[in_stack]] = True
+    return keep
+
+
+def anim_keys_slopes(values):
+    """
+    Return the slopes (value change per frame) of a sampled channel at each of its frames: central differences,
+    one sided ones on first and last frames.
+    """
+    nbr_keys = len(values)
+    if nbr_keys < 2:
+        return [0.0] * nbr_keys
+    return ([values[1] - values[0]] +
+            [(values[j + 1] - values[j - 1]) * 0.5 for j in range(1, nbr_keys - 1)] +
+            [values[-1] - values[-2]])
+
+
+def anim_keys_fit(values, max_error, use_numpy):
+    """
+    Fit cubic (hermite) keys on a sampled channel (one value per frame), so that the curve is within max_error
+    of every sample.
+
+    Each segment between two keys uses either the sampled slopes of its ends (see anim_keys_slopes()), or the one
+    sided ones (which keep corners sharp), whichever fits best. Segments whose worst sample is still off by more
+    than max_error are split at that sample, until none is.
+    Returns the list of (frame index, right slope, next key's left slope) of the keys, slopes in value per frame.
+    """
+    nbr_keys = len(values)
+    slopes = anim_keys_slopes(values)
+    if nbr_keys < 3:
+        return [(j, slopes[j], slopes[j + 1] if j + 1 < nbr_keys else slopes[j]) for j in range(nbr_keys)]
+    if use_numpy:
+        values_arr = numpy.asarray(values, dtype=numpy.float64)
+
+    def segment_error(a, b, s0, s1):
+        # (index of the worst sample, its error) of the a -> b segment.
+        h = float(b - a)
+        v0, v1 = values[a], values[b]
+        s0 *= h
+        s1 *= h
+        if use_numpy:
+            t = numpy.arange(1, b - a) / h
+            t2 = t * t
+            t3 = t2 * t
+            curve = ((2.0 * t3 - 3.0 * t2 + 1.0) * v0 + (t3 - 2.0 * t2 + t) * s0 +
+                     (3.0 * t2 - 2.0 * t3) * v1 + (t3 - t2) * s1)
+            errors = numpy.abs(curve - values_arr[a + 1:b])
+            k = int(numpy.argmax(errors))
+            return a + 1 + k, float(errors[k])
+        worst = (a + 1, -1.0)
+        for j in range(a + 1, b):
+            t = (j - a) / h
+            t2 = t * t
+            t3 = t2 * t
+            curve = ((2.0 * t3 - 3.0 * t2 + 1.0) * v0 + (t3 - 2.0 * t2 + t) * s0 +
+                     (3.0 * t2 - 2.0 * t3) * v1 + (t3 - t2) * s1)
+            error = abs(curve - values[j])
+            if error > worst[1]:
+                worst = (j, error)
+        return worst
+
+    keys = {}
+    segments = [(0, nbr_keys - 1)]
+    while segments:
+        a, b = segments.pop()
+        fit = (slopes[a], slopes[b])
+        if b - a > 1:
+            j, error = segment_error(a, b, *fit)
+            if error > max_error:
+                fit_sharp = (values[a + 1] - values[a], values[b] - values[b - 1])
+                j_sharp, error_sharp = segment_error(a, b, *fit_sharp)
+                if error_sharp < error:
+                    fit, j, error = fit_sharp, j_sharp, error_sharp
+            if error > max_error:
+                segments.append((j, b))
+                segments.append((a, j))
+                continue
+        keys[a] = (a,) + fit
+    keys[nbr_keys - 1] = (nbr_keys - 1, slopes[-1], slopes[-1])
+    return [keys[j] for j in sorted(keys)]
+
+
+def matrix_array_to_quats(mats):
+    """
+    Return the (..., 4) numpy array of the (w, x, y, z) unit quaternions of a (..., 3, 3) numpy array of rotation
+    matrices (which may be scaled), as Matrix.to_quaternion() does.
+
+    Like mathutils, each quaternion is solved from its largest component (found on the diagonal), the others
+    following from the off diagonal terms, which stays accurate close to half turns.
+    """
+    mats = mats / numpy.maximum(numpy.linalg.norm(mats, axis=-2), 1e-30)[..., None, :]
+    m00, m11, m22 = mats[..., 0, 0], mats[..., 1, 1], mats[..., 2, 2]
+    w_x = mats[..., 2, 1] - mats[..., 1, 2]
+    w_y = mats[..., 0, 2] - mats[..., 2, 0]
+    w_z = mats[..., 1, 0] - mats[..., 0, 1]
+    x_y = mats[..., 0, 1] + mats[..., 1, 0]
+    x_z = mats[..., 0, 2] + mats[..., 2, 0]
+    y_z = mats[..., 1, 2] + mats[..., 2, 1]
+    # 4 * q * q[k] for each k, the diagonal being 4 * q[k] ** 2.
+    quats_k = numpy.stack((numpy.stack((1.0 + m00 + m11 + m22, w_x, w_y, w_z), axis=-1),
+                           numpy.stack((w_x, 1.0 + m00 - m11 - m22, x_y, x_z), axis=-1),
+                           numpy.stack((w_y, x_y, 1.0 - m00 + m11 - m22, y_z), axis=-1),
+                           numpy.stack((w_z, x_z, y_z, 1.0 - m00 - m11 + m22), axis=-1)), axis=-2)
+    k = numpy.argmax(numpy.diagonal(quats_k, axis1=-2, axis2=-1), axis=-1)
+    quats = (quats_k * (numpy.arange(4) == k[..., None])[..., None]).sum(axis=-2)
+    return quats / numpy.linalg.norm(quats, axis=-1)[..., None]
+
+
+def quat_keys_reduce(quats, tolerance):
+    """
+    Return the indices of the keys to keep of a sampled rotation channel (one (w, x, y, z) unit quaternion per
+    frame), dropping the ones within tolerance (in degrees) of the spherical interpolation (along the shortest path,
+    like QuaternionInterpolate does) of the previous key and the last kept one.
+
+    Single backward pass comparing each key with the previous one and the last kept one, keys being whole rotations
+    instead of single euler axes.
+    """
+    nbr_keys = len(quats)
+    if nbr_keys < 3:
+        return list(range(nbr_keys))
+    cos_min = math.cos(math.radians(tolerance) * 0.5)
+    kept = [nbr_keys - 1]
+    j_next = nbr_keys - 1
+    q_next = quats[j_next]
+    for j in range(nbr_keys - 2, 0, -1):
+        q_prev = quats[j - 1]
+        t = 1.0 / (j_next - j + 1)
+        dot = sum(a * b for a, b in zip(q_prev, q_next))
+        sign = 1.0 if dot >= 0.0 else -1.0
+        dot = min(abs(dot), 1.0)
+        theta = math.acos(dot)
+        if theta < 1e-6:
+            w_prev, w_next = 1.0 - t, t
+        else:
+            w_prev = math.sin((1.0 - t) * theta) / math.sin(theta)
+            w_next = math.sin(t * theta) / math.sin(theta)
+        w_next *= sign
+        q = [a * w_prev + b * w_next for a, b in zip(q_prev, q_next)]
+        dot = sum(a * b for a, b in zip(q, quats[j])) / math.sqrt(sum(a * a for a in q))
+        if abs(dot) > cos_min:
+            continue
+        kept.append(j)
+        j_next = j
+        q_next = quats[j]
+    kept.append(0)
+    kept.reverse()
+    return kept
+
+
+def quat_keys_reduce_array(quats, tolerance):
+    """
+    Vectorized quat_keys_reduce() of all rotation channels at once, quats being a (channels, frames, 4) numpy array.
+
+    Returns a (channels, frames) bool numpy array of the keys to keep.
+    """
+    nbr_chans, nbr_keys = quats.shape[:2]
+    keep = numpy.ones((nbr_chans, nbr_keys), dtype=bool)
+    cos_min = math.cos(math.radians(tolerance) * 0.5)
+    j_next = numpy.full(nbr_chans, nbr_keys - 1, dtype=numpy.int64)
+    q_next = quats[:, -1].copy()
+    for j in range(nbr_keys - 2, 0, -1):
+        q_prev = quats[:, j - 1]
+        t = 1.0 / (j_next - j + 1.0)
+        dot = (q_prev * q_next).sum(axis=-1)
+        sign = numpy.where(dot >= 0.0, 1.0, -1.0)
+        theta = numpy.arccos(numpy.minimum(numpy.abs(dot), 1.0))
+        is_small = theta < 1e-6
+        sin_theta = numpy.where(is_small, 1.0, numpy.sin(theta))
+        w_prev = numpy.where(is_small, 1.0 - t, numpy.sin((1.0 - t) * theta) / sin_theta)
+        w_next = numpy.where(is_small, t, numpy.sin(t * theta) / sin_theta) * sign
+        q = q_prev * w_prev[:, None] + q_next * w_next[:, None]
+        dot = (q * quats[:, j]).sum(axis=-1) / numpy.linalg.norm(q, axis=-1)
+        is_kept = numpy.abs(dot) <= cos_min
+        keep[:, j] = is_kept
+        j_next[is_kept] = j
+        q_next[is_kept] = quats[is_kept, j]
+    return keep
+
+
 # Used to add the scene name into the filepath without using odd chars
 sane_name_mapping_ob = {}
 sane_name_mapping_ob_unique = set()
@@ -66,9 +993,26 @@ sane_name_mapping_tex = {}
 sane_name_mapping_take = {}
 sane_name_mapping_group = {}
 
-# Make sure reserved names are not used
-sane_name_mapping_ob['Scene'] = 'Scene_'
-sane_name_mapping_ob_unique.add('Scene_')
+
+def sane_name_mappings_reset():
+    """
+    Forget all names given so far, so that each export names things the same way, whatever happened before
+    (previous exports, or one that failed half way).
+    """
+    for mapping in (sane_name_mapping_ob,
+                    sane_name_mapping_ob_unique,
+                    sane_name_mapping_mat,
+                    sane_name_mapping_tex,
+                    sane_name_mapping_take,
+                    sane_name_mapping_group,
+                    ):
+        mapping.clear()
+
+    # Make sure reserved names are not used
+    sane_name_mapping_ob['Scene'] = 'Scene_'
+    sane_name_mapping_ob_unique.add('Scene_')
+
+sane_name_mappings_reset()
 
 
 def increment_string(t):
@@ -150,13 +1094,195 @@ def sane_groupname(data):
     return sane_name(data, sane_name_mapping_group)
 
 
-def mat4x4str(mat):
+def mat4x4_values(mat):
     # blender matrix is row major, fbx is col major so transpose on write
-    return ("%.15f,%.15f,%.15f,%.15f,"
-            "%.15f,%.15f,%.15f,%.15f,"
-            "%.15f,%.15f,%.15f,%.15f,"
-            "%.15f,%.15f,%.15f,%.15f" %
-            tuple([f for v in mat.transposed() for f in v]))
+    return [f for v in mat.transposed() for f in v]
+
+
+# Properties60 of Model objects and bones, as (name, type, flags, values) tuples, values being None for the ones
+# that vary per object (transforms and constraint limits) or per export (rotations interpolation).
+OBJECT_PROPS = (("QuaternionInterpolate", "bool", "", None),
+                ("Visibility", "Visibility", "A+", (1,)),
+                ("Lcl Translation", "Lcl Translation", "A+", None),
+                ("Lcl Rotation", "Lcl Rotation", "A+", None),
+                ("Lcl Scaling", "Lcl Scaling", "A+", None),
+                ("RotationOffset", "Vector3D", "", (0, 0, 0)),
+                ("RotationPivot", "Vector3D", "", (0, 0, 0)),
+                ("ScalingOffset", "Vector3D", "", (0, 0, 0)),
+                ("ScalingPivot", "Vector3D", "", (0, 0, 0)),
+                ("TranslationActive", "bool", "", (0,)),
+                ("TranslationMin", "Vector3D", "", None),
+                ("TranslationMax", "Vector3D", "", None),
+                ("TranslationMinX", "bool", "", None),
+                ("TranslationMinY", "bool", "", None),
+                ("TranslationMinZ", "bool", "", None),
+                ("TranslationMaxX", "bool", "", None),
+                ("TranslationMaxY", "bool", "", None),
+                ("TranslationMaxZ", "bool", "", None),
+                ("RotationOrder", "enum", "", (0,)),
+                ("RotationSpaceForLimitOnly", "bool", "", (0,)),
+                ("AxisLen", "double", "", (10,)),
+                ("PreRotation", "Vector3D", "", (0, 0, 0)),
+                ("PostRotation", "Vector3D", "", (0, 0, 0)),
+                ("RotationActive", "bool", "", (0,)),
+                ("RotationMin", "Vector3D", "", None),
+                ("RotationMax", "Vector3D", "", None),
+                ("RotationMinX", "bool", "", None),
+                ("RotationMinY", "bool", "", None),
+                ("RotationMinZ", "bool", "", None),
+                ("RotationMaxX", "bool", "", None),
+                ("RotationMaxY", "bool", "", None),
+                ("RotationMaxZ", "bool", "", None),
+                ("RotationStiffnessX", "double", "", (0,)),
+                ("RotationStiffnessY", "double", "", (0,)),
+                ("RotationStiffnessZ", "double", "", (0,)),
+                ("MinDampRangeX", "double", "", (0,)),
+                ("MinDampRangeY", "double", "", (0,)),
+                ("MinDampRangeZ", "double", "", (0,)),
+                ("MaxDampRangeX", "double", "", (0,)),
+                ("MaxDampRangeY", "double", "", (0,)),
+                ("MaxDampRangeZ", "double", "", (0,)),
+                ("MinDampStrengthX", "double", "", (0,)),
+                ("MinDampStrengthY", "double", "", (0,)),
+                ("MinDampStrengthZ", "double", "", (0,)),
+                ("MaxDampStrengthX", "double", "", (0,)),
+                ("MaxDampStrengthY", "double", "", (0,)),
+                ("MaxDampStrengthZ", "double", "", (0,)),
+                ("PreferedAngleX", "double", "", (0,)),
+                ("PreferedAngleY", "double", "", (0,)),
+                ("PreferedAngleZ", "double", "", (0,)),
+                ("InheritType", "enum", "", (0,)),
+                ("ScalingActive", "bool", "", (0,)),
+                ("ScalingMin", "Vector3D", "", None),
+                ("ScalingMax", "Vector3D", "", None),
+                ("ScalingMinX", "bool", "", None),
+                ("ScalingMinY", "bool", "", None),
+                ("ScalingMinZ", "bool", "", None),
+                ("ScalingMaxX", "bool", "", None),
+                ("ScalingMaxY", "bool", "", None),
+                ("ScalingMaxZ", "bool", "", None),
+                ("GeometricTranslation", "Vector3D", "", (0, 0, 0)),
+                ("GeometricRotation", "Vector3D", "", (0, 0, 0)),
+                ("GeometricScaling", "Vector3D", "", (1, 1, 1)),
+                ("LookAtProperty", "object", "", ()),
+                ("UpVectorProperty", "object", "", ()),
+                ("Show", "bool", "", (1,)),
+                ("NegativePercentShapeSupport", "bool", "", (1,)),
+                ("DefaultAttributeIndex", "int", "", (0,)),
+                )
+
+# Extra Properties60 of Model objects (not bones).
+OBJECT_PROPS_EXTRA = (("Color", "Color", "A", (0.8, 0.8, 0.8)),
+                      ("Size", "double", "", (100,)),
+                      ("Look", "enum", "", (1,)),
+                      )
+
+# Values FBX readers use for missing Model properties, the ones left out in compact mode.
+OBJECT_PROPS_DEFAULTS = {"QuaternionInterpolate": (0,),
+                         "Visibility": (1,),
+                         "Lcl Translation": (0.0, 0.0, 0.0),
+                         "Lcl Rotation": (0.0, 0.0, 0.0),
+                         "Lcl Scaling": (1.0, 1.0, 1.0),
+                         "RotationOffset": (0, 0, 0),
+                         "RotationPivot": (0, 0, 0),
+                         "ScalingOffset": (0, 0, 0),
+                         "ScalingPivot": (0, 0, 0),
+                         "TranslationActive": (0,),
+                         "TranslationMin": (0.0, 0.0, 0.0),
+                         "TranslationMax": (0.0, 0.0, 0.0),
+                         "RotationOrder": (0,),
+                         "RotationSpaceForLimitOnly": (0,),
+                         "AxisLen": (10,),
+                         "PreRotation": (0, 0, 0),
+                         "PostRotation": (0, 0, 0),
+                         "RotationActive": (0,),
+                         "RotationMin": (0.0, 0.0, 0.0),
+                         "RotationMax": (0.0, 0.0, 0.0),
+                         "InheritType": (0,),
+                         "ScalingActive": (0,),
+                         "GeometricTranslation": (0, 0, 0),
+                         "GeometricRotation": (0, 0, 0),
+                         "GeometricScaling": (1, 1, 1),
+                         "LookAtProperty": (),
+                         "UpVectorProperty": (),
+                         "Show": (1,),
+                         "NegativePercentShapeSupport": (1,),
+                         "Color": (0.8, 0.8, 0.8),
+                         "Size": (100,),
+                         "Look": (1,),
+                         }
+for _axis in "XYZ":
+    for _prop in ("TranslationMin%s", "TranslationMax%s", "RotationMin%s", "RotationMax%s",
+                  "ScalingMin%s", "ScalingMax%s", "RotationStiffness%s", "MinDampRange%s", "MaxDampRange%s",
+                  "MinDampStrength%s", "MaxDampStrength%s", "PreferedAngle%s"):
+        OBJECT_PROPS_DEFAULTS[_prop % _axis] = (0,)
+del _axis, _prop
+
+
+def props_values_str(values):
+    return ",".join("%.15g" % v for v in values)
+
+
+def compile_props(props, fixed, defaults=None):
+    """
+    Return the template of Properties60 props (see OBJECT_PROPS): a list of constant text chunks, and of
+    (name, line start, default values) tuples for the variable properties, the ones without values in props nor
+    in the fixed dict.
+
+    If defaults is given, constant properties equal to their default are left out, and the default of variable ones
+    is given in their tuple (else None) for the writer to leave them out too.
+    """
+    template = []
+    text = []
+    for name, ptype, flags, values in props:
+        line = '\n\t\t\tProperty: "%s", "%s", "%s"' % (name, ptype, flags)
+        if values is None:
+            values = fixed.get(name)
+        default = defaults.get(name) if defaults else None
+        if values is None:
+            if text:
+                template.append("".join(text))
+                text = []
+            template.append((name, line + ",", default))
+        elif default is None or tuple(values) != default:
+            text.append(line + ("," + props_values_str(values) if values else ""))
+    if text:
+        template.append("".join(text))
+    return template
+
+
+# Limit constraints settings of objects and bones without any.
+CONSTRAINTS_DEFAULTS = {"loc_min": (0.0, 0.0, 0.0),
+                        "loc_max": (0.0, 0.0, 0.0),
+                        "loc_limit": (0.0, 0.0, 0.0, 0.0, 0.0, 0.0),
+                        "rot_min": (0.0, 0.0, 0.0),
+                        "rot_max": (0.0, 0.0, 0.0),
+                        "rot_limit": (0.0, 0.0, 0.0),
+                        "sca_min": (1.0, 1.0, 1.0),
+                        "sca_max": (1.0, 1.0, 1.0),
+                        "sca_limit": (0.0, 0.0, 0.0, 0.0, 0.0, 0.0),
+                        }
+
+
+def constraints_props(constraints):
+    """
+    Return the {property name: values} dict of the Properties60 matching constraints settings (see get_constraints).
+    """
+    props = {"TranslationMin": constraints["loc_min"],
+             "TranslationMax": constraints["loc_max"],
+             "RotationMin": constraints["rot_min"],
+             "RotationMax": constraints["rot_max"],
+             "ScalingMin": constraints["sca_min"],
+             "ScalingMax": constraints["sca_max"],
+             }
+    for i, axis in enumerate("XYZ"):
+        props["TranslationMin" + axis] = constraints["loc_limit"][i:i + 1]
+        props["TranslationMax" + axis] = constraints["loc_limit"][i + 3:i + 4]
+        # Blender has a single switch for both rotation limits of an axis.
+        props["RotationMin" + axis] = props["RotationMax" + axis] = constraints["rot_limit"][i:i + 1]
+        props["ScalingMin" + axis] = constraints["sca_limit"][i:i + 1]
+        props["ScalingMax" + axis] = constraints["sca_limit"][i + 3:i + 4]
+    return props
 
 
 def action_bone_names(obj, action):
@@ -179,6 +1305,122 @@ def action_bone_names(obj, action):
     return names
 
 
+# Pose bone transform properties, the only animated ones action_pose_matrices() evaluates.
+POSE_BONE_CHANNELS = ("location", "rotation_quaternion", "rotation_euler", "rotation_axis_angle", "scale")
+
+
+def action_moves_object(action):
+    """
+    True if action animates anything else than pose bones (object transform, properties...).
+    """
+    return any(not fcu.mute and not fcu.data_path.startswith("pose.bones[") for fcu in action.fcurves)
+
+
+def object_is_static(ob):
+    """
+    True if the world matrix of ob does not change with frames: neither it nor its parents have constraints,
+    drivers, NLA tracks or actions animating more than pose bones, and they are parented to objects only.
+    """
+    while ob:
+        anim_data = ob.animation_data
+        if anim_data:
+            if anim_data.drivers or any(not track.mute for track in anim_data.nla_tracks):
+                return False
+            if anim_data.action and action_moves_object(anim_data.action):
+                return False
+        if ob.constraints:
+            return False
+        if ob.parent and ob.parent_type != 'OBJECT':
+            return False
+        ob = ob.parent
+    return True
+
+
+def pose_direct_eval_ok(ob):
+    """
+    True if the pose of armature object ob only depends on its current action, so that it can be evaluated from the
+    action's F-curves without any scene update (see action_pose_matrices()): no constraints, drivers nor NLA,
+    and all bones fully inheriting their parent transform.
+    """
+    anim_data = ob.animation_data
+    if anim_data and (anim_data.action_influence != 1.0 or anim_data.action_blend_type != 'REPLACE'):
+        return False
+    if ob.data.animation_data or ob.data.pose_position != 'POSE':
+        return False
+    for pose_bone in ob.pose.bones:
+        bone = pose_bone.bone
+        if pose_bone.constraints or not (bone.use_inherit_rotation and bone.use_inherit_scale and
+                                         bone.use_local_location):
+            return False
+    return object_is_static(ob)
+
+
+def action_pose_matrices(ob, action, frames):
+    """
+    Return the {bone name: [pose matrix of each frame]} of armature object ob animated by action (may be None),
+    evaluating the action's F-curves and composing the bones' matrices down the hierarchy, as a scene update
+    would (see pose_direct_eval_ok()). Channels without F-curve keep their current value.
+    """
+    from bpy.types import PoseBone
+    from mathutils import Euler, Quaternion
+
+    pose_bones = ob.pose.bones
+    # {bone name: {channel: current values}}, and (bone name, channel, index, fcurve) of animated channels.
+    values = {pose_bone.name: {channel: list(getattr(pose_bone, channel)) for channel in POSE_BONE_CHANNELS}
+              for pose_bone in pose_bones}
+    fcurves = []
+    for fcu in (action.fcurves if action else ()):
+        if fcu.mute:
+            continue
+        channel = fcu.data_path.rpartition('.')[2]
+        if channel not in POSE_BONE_CHANNELS:
+            continue
+        try:
+            prop = ob.path_resolve(fcu.data_path, False)
+        except:
+            prop = None
+        if prop is not None and isinstance(prop.data, PoseBone):
+            fcurves.append((prop.data.name, channel, fcu.array_index, fcu))
+
+    # Bones sorted parents first, with their rest matrix relative to their parent's one.
+    bones = []
+    stack = [bone for bone in ob.data.bones if not bone.parent]
+    while stack:
+        bone = stack.pop()
+        if bone.parent:
+            bones.append((bone.name, bone.parent.name, bone.parent.matrix_local.inverted() * bone.matrix_local))
+        else:
+            bones.append((bone.name, None, bone.matrix_local.copy()))
+        stack.extend(bone.children)
+    rotation_modes = {pose_bone.name: pose_bone.rotation_mode for pose_bone in pose_bones}
+
+    pose_mats = {name: [] for name, parent, offset in bones}
+    for frame in frames:
+        for name, channel, index, fcu in fcurves:
+            values[name][channel][index] = fcu.evaluate(frame)
+        frame_mats = {}
+        for name, parent, offset in bones:
+            bone_values = values[name]
+            rotation_mode = rotation_modes[name]
+            if rotation_mode == 'QUATERNION':
+                rot = Quaternion(bone_values["rotation_quaternion"]).normalized().to_matrix()
+            elif rotation_mode == 'AXIS_ANGLE':
+                angle, x, y, z = bone_values["rotation_axis_angle"]
+                rot = Quaternion((x, y, z), angle).to_matrix()
+            else:
+                rot = Euler(bone_values["rotation_euler"], rotation_mode).to_matrix()
+            sx, sy, sz = bone_values["scale"]
+            basis = (rot * Matrix(((sx, 0.0, 0.0), (0.0, sy, 0.0), (0.0, 0.0, sz)))).to_4x4()
+            basis.translation = bone_values["location"]
+            if parent:
+                mat = frame_mats[parent] * offset * basis
+            else:
+                mat = offset * basis
+            frame_mats[name] = mat
+            pose_mats[name].append(mat)
+    return pose_mats
+
+
 # ob must be OB_MESH
 def BPyMesh_meshWeight2List(ob, me):
     """ Takes a mesh and return its group names and a list of lists, one list per vertex.
@@ -223,6 +1465,95 @@ def meshNormalizedWeights(ob, me):
 
     return groupNames, vWeightList
 
+
+class ObjectGraph(object):
+    """
+    The FBX objects of an export and their "OO" connections, from which the Definitions, Relations and Connections
+    sections are written in a single pass each.
+
+    Nodes are (kind, name, type) tuples, kind being their block ("Model", "Material", "Deformer", ...) and name their
+    full "Class::Name" object name, identified by their index in nodes (Relations order). Edges are (child, parent)
+    node indices (Connections order), SCENE standing for the scene root.
+    """
+    __slots__ = ("nodes",
+                 "edges",
+                 "counts",
+                 )
+
+    SCENE = -1
+
+    def __init__(self):
+        self.nodes = []
+        self.edges = []
+        # Number of nodes per kind, and per (kind, type).
+        self.counts = {}
+
+    def add(self, kind, name, type):
+        counts = self.counts
+        counts[kind] = counts.get(kind, 0) + 1
+        counts[kind, type] = counts.get((kind, type), 0) + 1
+        self.nodes.append((kind, name, type))
+        return len(self.nodes) - 1
+
+    def connect(self, child, parent):
+        self.edges.append((child, parent))
+
+    def count(self, kind, type=None):
+        return self.counts.get(kind if type is None else (kind, type), 0)
+
+    def node_name(self, node):
+        return "Model::Scene" if node == self.SCENE else self.nodes[node][1]
+
+
+# Top level blocks listed in the section index (.idx sidecar), and the sections they are looked for in.
+INDEX_SECTIONS = {"Objects", "Takes"}
+INDEX_BLOCKS = {"Model", "Deformer", "Pose", "Take"}
+
+# Matches section headers, top level block headers and top level block ends of the ASCII output.
+index_re = re.compile(r'\n(?:(\w+):  \{|\t(\w+): "([^"]*)"(?:, "([^"]*)")?|\t\})')
+
+
+def section_index_key(block, names):
+    """
+    Return the (kind, name) index key of a top level block, given its node name and string values,
+    e.g. ("Model", ["Model::Cube", "Mesh"]) -> ("Geometry", "Cube").
+    """
+    name = (names[0].partition("::")[2] or names[0]) if names else ""
+    kind = "Geometry" if block == "Model" and names[1:2] == ["Mesh"] else block
+    return kind, name
+
+
+def write_file(filepath, data, use_atomic_write=True):
+    """
+    Write data (bytes) to filepath, through a temporary file next to it only renamed to it once complete
+    if use_atomic_write is set, so that a failed write never leaves a truncated file behind.
+    """
+    filepath_tmp = filepath + ".tmp" if use_atomic_write else filepath
+    try:
+        with open(filepath_tmp, "wb") as f:
+            f.write(data)
+    except:
+        if use_atomic_write and os.path.exists(filepath_tmp):
+            os.remove(filepath_tmp)
+        raise
+    if use_atomic_write:
+        os.replace(filepath_tmp, filepath)
+
+
+def hash_sidecar_line(filepath, content_hash):
+    """
+    Return the line of the sha1sum format sidecar (filepath + ".sha1") of filepath, given the hash of its content,
+    and whether the existing sidecar holds it already (filepath being still there).
+    """
+    hash_line = "%s  %s\n" % (content_hash.hexdigest(), os.path.basename(filepath))
+    try:
+        with open(filepath + ".sha1", "r", encoding="utf8") as f:
+            is_unchanged = (f.read() == hash_line) and os.path.exists(filepath)
+    except IOError:
+        is_unchanged = False
+    return hash_line, is_unchanged
+
+
 header_comment = \
 '''; FBX 6.1.0 project file
 ; Created by Blender FBX Exporter
@@ -243,16 +1574,66 @@ def save_single(operator, scene, filepath="",
         use_anim=True,
         use_anim_optimize=True,
         anim_optimize_precision=6,
+        anim_fit_error=0.0,
+        use_anim_quaternion=False,
+        use_anim_numpy=False,
         use_anim_action_all=False,
         use_metadata=True,
         path_mode='AUTO',
         use_mesh_edges=True,
         use_rotate_workaround=True,
         use_default_take=True,
+        use_numpy=True,
+        mesh_chunk_size=0,
+        use_mesh_normals_indexed=False,
+        mesh_normals_tolerance=0.0,
+        mesh_weld_type='OFF',
+        use_mesh_triangulate=False,
+        use_mesh_tangents=False,
+        use_mesh_cache_optimize=False,
+        float_precision=None,
+        use_float_report=False,
+        use_atomic_write=True,
+        use_deterministic=False,
+        use_section_index=True,
+        use_compact_props=False,
+        use_mesh_split=False,
+        use_anim_take_files=False,
+        use_anim_only=False,
+        tmp_files=None,
     ):
 
     import bpy_extras.io_utils
 
+    # Names must not depend on what previous exports did.
+    sane_name_mappings_reset()
+
+    # Same input data must give the same bytes: fixed metadata, and only replace the file when its content changed.
+    if use_deterministic:
+        use_metadata = False
+        use_atomic_write = True
+
+    # Vectorized mode needs numpy, silently fall back to pure python otherwise.
+    use_numpy = use_numpy and numpy is not None
+    use_anim_numpy = use_anim_numpy and use_numpy
+
+    # MikkTSpace only handles triangles and quads.
+    use_mesh_triangulate = use_mesh_triangulate or use_mesh_tangents
+
+    # Only skeletons, their bind pose and their animation: no geometry, materials nor deformers.
+    if use_anim_only:
+        object_types = {'ARMATURE'}
+        use_anim = True
+
+    # Precision of each category of written floats, and (written, written with default precision) sizes of them,
+    # only measured when a report of them is asked for.
+    float_precision = dict(FLOAT_PRECISION_DEFAULTS, **(float_precision or {}))
+    for category in FLOAT_PRECISION_DEFAULTS:
+        if float_precision[category] is None and category not in FLOAT_CATEGORIES_MESH:
+            # Transforms and keys are doubles, 32 bits round-trip would lose precision.
+            float_precision[category] = FLOAT_PRECISION_DEFAULTS[category]
+    float_stats = {category: [0, 0] for category in FLOAT_PRECISION_DEFAULTS}
+
     # Only used for camera and lamp rotations
     mtx_x90 = Matrix.Rotation(math.pi / 2.0, 3, 'X')
     # Used for mesh and armature rotations
@@ -321,8 +1702,8 @@ def save_single(operator, scene, filepath="",
             else:
                 self.restMatrixLocal = self.restMatrix.copy()
         '''
-        def setPoseFrame(self, f):
-            # cache pose info here, frame must be set beforehand
+        def setPoseFrame(self, f, matrix=None):
+            # cache pose info here, frame must be set beforehand (or its pose matrix given)
 
             # Didnt end up needing head or tail, if we do - here it is.
             '''
@@ -332,7 +1713,9 @@ def save_single(operator, scene, filepath="",
                 self.__pose_bone.tail.copy() )
             '''
 
-            self.__anim_poselist[f] = self.__pose_bone.matrix.copy()
+            if matrix is None:
+                matrix = self.__pose_bone.matrix.copy()
+            self.__anim_poselist[f] = matrix
 
         def getPoseBone(self):
             return self.__pose_bone
@@ -364,6 +1747,10 @@ def save_single(operator, scene, filepath="",
         def getAnimParRelMatrixRot(self, frame):
             return self.getAnimParRelMatrix(frame)
 
+        def getAnimMatrixArray(self, frames):
+            # (frames, 4, 4) numpy array of the matrices children's animation is relative to, see anim_channels_solve()
+            return numpy.matmul(numpy.array([self.__anim_poselist[f] for f in frames]), numpy.array(mtx4_z90))
+
         def flushAnimData(self):
             self.__anim_poselist.clear()
 
@@ -375,6 +1762,10 @@ def save_single(operator, scene, filepath="",
                      "blenTextures",
                      "blenMaterials",
                      "blenMaterialList",
+                     "blenPolyMats",
+                     "blenPolyTexs",
+                     "fbxVertexMap",
+                     "blenSplitVerts",
                      "blenAction",
                      "blenActionList",
                      "fbxGroupNames",
@@ -435,20 +1826,141 @@ def save_single(operator, scene, filepath="",
 
             return matrix_rot
 
+        def getAnimMatrixArray(self, frames):
+            # (frames, 4, 4) numpy array of the matrices children's animation is relative to, see anim_channels_solve()
+            return numpy.matmul(numpy.array(global_matrix), numpy.array([self.__anim_poselist[f] for f in frames]))
+
     # ----------------------------------------------
 
     print('\nFBX export starting... %r' % filepath)
     start_time = time.process_time()
+    # Write to a temporary file next to the target one, only renamed to it once complete,
+    # so that a failed export never leaves a truncated file behind.
+    filepath_tmp = filepath + ".tmp" if use_atomic_write else filepath
     try:
-        file = open(filepath, "w", encoding="utf8", newline="\n")
+        file = open(filepath_tmp, "wb")
     except:
         import traceback
         traceback.print_exc()
-        operator.report({'ERROR'}, "Couldn't open file %r" % filepath)
+        operator.report({'ERROR'}, "Couldn't open file %r" % filepath_tmp)
         return {'CANCELLED'}
+    if use_atomic_write and tmp_files is not None:
+        tmp_files.append((file, filepath_tmp))
+
+    # Written text is gathered here, and passed on to the file in one big write per section (or per big object),
+    # instead of one per (mostly tiny) fw call.
+    fw_pending = []
+    fw = fw_pending.append
+
+    # Hash of the written content, compared with the one of the previous export in deterministic mode.
+    content_hash = hashlib.sha1() if use_deterministic else None
+
+    # (kind, name, byte offset, byte size) of top level blocks, and (section, open block, bytes written) scan state.
+    index_entries = []
+    index_state = [None, None, 0]
+
+    def index_scan(data):
+        section, block, offset = index_state
+        pos = 0
+        for m in index_re.finditer(data):
+            # Offsets are the ones of the line, after its leading newline.
+            offset += len(data[pos:m.start() + 1].encode("utf8"))
+            pos = m.start() + 1
+            sect, name, value, value_type = m.groups()
+            if sect:
+                section = sect
+            elif name:
+                if block is None and section in INDEX_SECTIONS and name in INDEX_BLOCKS:
+                    block = section_index_key(name, [value, value_type] if value_type else [value]) + (offset,)
+            elif block is not None:
+                index_entries.append(block[:2] + (block[2], offset + 2 - block[2]))
+                block = None
+        offset += len(data[pos:].encode("utf8"))
+        index_state[:] = section, block, offset
+
+    def fw_flush():
+        data = "".join(fw_pending)
+        del fw_pending[:]
+        if use_section_index:
+            index_scan(data)
+        data = data.encode("utf8")
+        file.write(data)
+        if content_hash is not None:
+            content_hash.update(data)
+
+    def write_take_files(graph, skeleton_ids, texts, takes):
+        """
+        Write each (take name, take text) of takes to its own "<file name>_<take name>" file, along with the
+        skeleton it animates (same object names as in the model file) and the text parts shared with the model file.
+        """
+        node_name = graph.node_name
+        relations = []
+        for node in sorted(skeleton_ids):
+            relations.append('\n\t%s: "%s", "%s" {\n\t}' % graph.nodes[node])
+        connections = []
+        for child, parent in graph.edges:
+            if child not in skeleton_ids:
+                continue
+            if parent != graph.SCENE and parent not in skeleton_ids:
+                if graph.nodes[parent][0] != "Model":
+                    continue  # limbs -> deformers
+                # Parent object is not part of take files.
+                parent = graph.SCENE
+            connections.append('\n\tConnect: "OO", "%s", "%s"' % (node_name(child), node_name(parent)))
+
+        skeleton_text = (texts["header"] +
+                         '''
+
+; Object definitions
+;------------------------------------------------------------------
+
+Definitions:  {
+	Version: 100
+	Count: %i
+	ObjectType: "Model" {
+		Count: %i
+	}
+	ObjectType: "GlobalSettings" {
+		Count: 1
+	}
+}
+
+; Object properties
+;------------------------------------------------------------------
+
+Objects:  {''' % (1 + len(skeleton_ids), len(skeleton_ids)) +
+                         texts["armatures"] + texts["bones"] + texts["settings"] + '''}
+
+; Object relations
+;------------------------------------------------------------------
+
+Relations:  {''' + "".join(relations) + '''
+}
+
+; Object connections
+;------------------------------------------------------------------
+
+Connections:  {''' + "".join(connections) + '''
+}
+;Takes and animation section
+;----------------------------------------------------
+
+Takes:  {''')
 
-    # convenience
-    fw = file.write
+        filepath_root, filepath_ext = os.path.splitext(filepath)
+        for take_name, take_text in takes:
+            take_filepath = "%s_%s%s" % (filepath_root, bpy.path.clean_name(take_name), filepath_ext)
+            data = ("%s\n\tCurrent: \"%s\"%s\n}%s" % (skeleton_text, take_name, take_text, texts["footer"])).encode("utf8")
+            if use_deterministic:
+                # Same sidecar as the model file, unchanged takes are kept untouched.
+                hash_line, is_unchanged = hash_sidecar_line(take_filepath, hashlib.sha1(data))
+                if is_unchanged:
+                    print('\ttake: "%s" unchanged, kept %r' % (take_name, take_filepath))
+                    continue
+            write_file(take_filepath, data, use_atomic_write)
+            if use_deterministic:
+                write_file(take_filepath + ".sha1", hash_line.encode("utf8"))
+            print('\ttake: "%s" written to %r' % (take_name, take_filepath))
 
     # scene = context.scene  # now passed as an arg instead of context
     world = scene.world
@@ -481,11 +1993,80 @@ def save_single(operator, scene, filepath="",
 }''' % (curtime))
 
     fw('\nCreationTime: "%.4i-%.2i-%.2i %.2i:%.2i:%.2i:000"' % curtime)
-    fw('\nCreator: "Blender version %s"' % bpy.app.version_string)
+    fw('\nCreator: "%s"' % ("Blender" if use_deterministic else "Blender version %s" % bpy.app.version_string))
+
+    # Parts of the document shared with the take files, see write_take_file().
+    take_files_text = {"header": "".join(fw_pending)}
+    take_files = []
 
     pose_items = []  # list of (fbxName, matrix) to write pose data for, easier to collect along the way
 
     # --------------- funcs for exporting
+    def mesh_array(seq, attr, size, dtype):
+        """
+        Typed buffer of mesh data, compact in chunked mode so that memory does not explode on big meshes.
+        """
+        return foreach_get_array(seq, attr, size, dtype, use_numpy, mesh_chunk_size > 0)
+
+    def fw_array(values, kind, chunk_size, sep, category=None, suffix=""):
+        """
+        Write an array block, floats using the precision of given category (see FLOAT_PRECISION_DEFAULTS).
+        """
+        if category is None:
+            write_array(fw, values, kind, chunk_size, sep, 6, suffix, mesh_chunk_size)
+            return
+
+        precision = float_precision[category]
+        if not use_float_report or not hasattr(values, "__len__"):
+            # Iterators can only be written once, they are left out of the report.
+            write_array(fw, values, kind, chunk_size, sep, precision, suffix, mesh_chunk_size)
+            return
+
+        size = [0]
+
+        def fw_count(data):
+            size[0] += len(data)
+            fw(data)
+
+        def count(data):
+            size[0] += len(data)
+
+        write_array(fw_count, values, kind, chunk_size, sep, precision, suffix, mesh_chunk_size)
+        stats = float_stats[category]
+        stats[0] += size[0]
+        if precision != FLOAT_PRECISION_DEFAULTS[category]:
+            size[0] = 0
+            write_array(count, values, kind, chunk_size, sep, FLOAT_PRECISION_DEFAULTS[category], suffix,
+                        mesh_chunk_size)
+        stats[1] += size[0]
+
+    def array_size(values, kind, chunk_size, sep, category, suffix=""):
+        """
+        Size of the array block fw_array() would write.
+        """
+        size = [0]
+
+        def count(data):
+            size[0] += len(data)
+
+        write_array(count, values, kind, chunk_size, sep, float_precision[category], suffix, mesh_chunk_size)
+        return size[0]
+
+    def float_str(values, category):
+        """
+        Comma separated values, using the precision of given category (see FLOAT_PRECISION_DEFAULTS).
+        """
+        precision = float_precision[category]
+        ret = floats_to_str(values, precision)
+        if not use_float_report:
+            return ret
+        stats = float_stats[category]
+        stats[0] += len(ret)
+        if precision != FLOAT_PRECISION_DEFAULTS[category]:
+            stats[1] += len(floats_to_str(values, FLOAT_PRECISION_DEFAULTS[category]))
+        else:
+            stats[1] += len(ret)
+        return ret
     def object_tx(ob, loc, matrix, matrix_mod=None):
         """
         Matrix mod is so armature objects can modify their bone matrices
@@ -546,158 +2127,74 @@ def save_single(operator, scene, filepath="",
 
         return loc, rot, scale, matrix, matrix_rot
 
-    def write_object_tx(ob, loc, matrix, matrix_mod=None):
-        """
-        We have loc to set the location if non blender objects that have a location
-
-        matrix_mod is only used for bones at the moment
-        """
-        loc, rot, scale, matrix, matrix_rot = object_tx(ob, loc, matrix, matrix_mod)
-
-        fw('\n\t\t\tProperty: "Lcl Translation", "Lcl Translation", "A+",%.15f,%.15f,%.15f' % loc)
-        fw('\n\t\t\tProperty: "Lcl Rotation", "Lcl Rotation", "A+",%.15f,%.15f,%.15f' % tuple_rad_to_deg(rot))
-        fw('\n\t\t\tProperty: "Lcl Scaling", "Lcl Scaling", "A+",%.15f,%.15f,%.15f' % scale)
-        return loc, rot, scale, matrix, matrix_rot
-
     def get_constraints(ob=None):
+        # Most objects and bones have no constraints, share the defaults (callers must not modify them).
+        if ob is None or not ob.constraints:
+            return CONSTRAINTS_DEFAULTS
+
         # Set variables to their defaults.
-        constraint_values = {"loc_min": (0.0, 0.0, 0.0),
-                             "loc_max": (0.0, 0.0, 0.0),
-                             "loc_limit": (0.0, 0.0, 0.0, 0.0, 0.0, 0.0),
-                             "rot_min": (0.0, 0.0, 0.0),
-                             "rot_max": (0.0, 0.0, 0.0),
-                             "rot_limit": (0.0, 0.0, 0.0),
-                             "sca_min": (1.0, 1.0, 1.0),
-                             "sca_max": (1.0, 1.0, 1.0),
-                             "sca_limit": (0.0, 0.0, 0.0, 0.0, 0.0, 0.0),
-                            }
+        constraint_values = dict(CONSTRAINTS_DEFAULTS)
 
         # Iterate through the list of constraints for this object to get the information in a format which is compatible with the FBX format.
-        if ob is not None:
-            for constraint in ob.constraints:
-                if constraint.type == 'LIMIT_LOCATION':
-                    constraint_values["loc_min"] = constraint.min_x, constraint.min_y, constraint.min_z
-                    constraint_values["loc_max"] = constraint.max_x, constraint.max_y, constraint.max_z
-                    constraint_values["loc_limit"] = constraint.use_min_x, constraint.use_min_y, constraint.use_min_z, constraint.use_max_x, constraint.use_max_y, constraint.use_max_z
-                elif constraint.type == 'LIMIT_ROTATION':
-                    constraint_values["rot_min"] = math.degrees(constraint.min_x), math.degrees(constraint.min_y), math.degrees(constraint.min_z)
-                    constraint_values["rot_max"] = math.degrees(constraint.max_x), math.degrees(constraint.max_y), math.degrees(constraint.max_z)
-                    constraint_values["rot_limit"] = constraint.use_limit_x, constraint.use_limit_y, constraint.use_limit_z
-                elif constraint.type == 'LIMIT_SCALE':
-                    constraint_values["sca_min"] = constraint.min_x, constraint.min_y, constraint.min_z
-                    constraint_values["sca_max"] = constraint.max_x, constraint.max_y, constraint.max_z
-                    constraint_values["sca_limit"] = constraint.use_min_x, constraint.use_min_y, constraint.use_min_z, constraint.use_max_x, constraint.use_max_y, constraint.use_max_z
+        for constraint in ob.constraints:
+            if constraint.type == 'LIMIT_LOCATION':
+                constraint_values["loc_min"] = constraint.min_x, constraint.min_y, constraint.min_z
+                constraint_values["loc_max"] = constraint.max_x, constraint.max_y, constraint.max_z
+                constraint_values["loc_limit"] = constraint.use_min_x, constraint.use_min_y, constraint.use_min_z, constraint.use_max_x, constraint.use_max_y, constraint.use_max_z
+            elif constraint.type == 'LIMIT_ROTATION':
+                constraint_values["rot_min"] = math.degrees(constraint.min_x), math.degrees(constraint.min_y), math.degrees(constraint.min_z)
+                constraint_values["rot_max"] = math.degrees(constraint.max_x), math.degrees(constraint.max_y), math.degrees(constraint.max_z)
+                constraint_values["rot_limit"] = constraint.use_limit_x, constraint.use_limit_y, constraint.use_limit_z
+            elif constraint.type == 'LIMIT_SCALE':
+                constraint_values["sca_min"] = constraint.min_x, constraint.min_y, constraint.min_z
+                constraint_values["sca_max"] = constraint.max_x, constraint.max_y, constraint.max_z
+                constraint_values["sca_limit"] = constraint.use_min_x, constraint.use_min_y, constraint.use_min_z, constraint.use_max_x, constraint.use_max_y, constraint.use_max_z
 
         # in case bad values are assigned.
         assert(len(constraint_values) == 9)
 
         return constraint_values
 
+    # Properties60 templates by (has color, has constraints), constraint limits being constant in the latter.
+    props_defaults = OBJECT_PROPS_DEFAULTS if use_compact_props else None
+    props_fixed = {"QuaternionInterpolate": (1,) if use_anim_quaternion else (0,)}
+    object_props_templates = {}
+    for has_color in (False, True):
+        props = OBJECT_PROPS + OBJECT_PROPS_EXTRA if has_color else OBJECT_PROPS
+        object_props_templates[has_color, False] = compile_props(props, dict(constraints_props(CONSTRAINTS_DEFAULTS),
+                                                                             **props_fixed), props_defaults)
+        object_props_templates[has_color, True] = compile_props(props, props_fixed, props_defaults)
+
+    def write_props(template, values):
+        for chunk in template:
+            if chunk.__class__ is str:
+                fw(chunk)
+            else:
+                name, line, default = chunk
+                value = values[name]
+                if value != default:
+                    fw(line + (float_str(value, 'matrix') if name.startswith("Lcl ") else props_values_str(value)))
+
     def write_object_props(ob=None, loc=None, matrix=None, matrix_mod=None, pose_bone=None):
         # Check if a pose exists for this object and set the constraint soruce accordingly. (Poses only exsit if the object is a bone.)
         if pose_bone:
             constraints = get_constraints(pose_bone)
         else:
             constraints = get_constraints(ob)
+        has_constraints = constraints is not CONSTRAINTS_DEFAULTS
 
-        # if the type is 0 its an empty otherwise its a mesh
-        # only difference at the moment is one has a color
-        fw('''
-		Properties60:  {
-			Property: "QuaternionInterpolate", "bool", "",0
-			Property: "Visibility", "Visibility", "A+",1''')
-
-        loc, rot, scale, matrix, matrix_rot = write_object_tx(ob, loc, matrix, matrix_mod)
-
-        # Rotation order, note, for FBX files Iv loaded normal order is 1
-        # setting to zero.
-        # eEULER_XYZ = 0
-        # eEULER_XZY
-        # eEULER_YZX
-        # eEULER_YXZ
-        # eEULER_ZXY
-        # eEULER_ZYX
-
-        fw('\n\t\t\tProperty: "RotationOffset", "Vector3D", "",0,0,0'
-           '\n\t\t\tProperty: "RotationPivot", "Vector3D", "",0,0,0'
-           '\n\t\t\tProperty: "ScalingOffset", "Vector3D", "",0,0,0'
-           '\n\t\t\tProperty: "ScalingPivot", "Vector3D", "",0,0,0'
-           '\n\t\t\tProperty: "TranslationActive", "bool", "",0'
-           )
-
-        fw('\n\t\t\tProperty: "TranslationMin", "Vector3D", "",%.15g,%.15g,%.15g' % constraints["loc_min"])
-        fw('\n\t\t\tProperty: "TranslationMax", "Vector3D", "",%.15g,%.15g,%.15g' % constraints["loc_max"])
-        fw('\n\t\t\tProperty: "TranslationMinX", "bool", "",%d' % constraints["loc_limit"][0])
-        fw('\n\t\t\tProperty: "TranslationMinY", "bool", "",%d' % constraints["loc_limit"][1])
-        fw('\n\t\t\tProperty: "TranslationMinZ", "bool", "",%d' % constraints["loc_limit"][2])
-        fw('\n\t\t\tProperty: "TranslationMaxX", "bool", "",%d' % constraints["loc_limit"][3])
-        fw('\n\t\t\tProperty: "TranslationMaxY", "bool", "",%d' % constraints["loc_limit"][4])
-        fw('\n\t\t\tProperty: "TranslationMaxZ", "bool", "",%d' % constraints["loc_limit"][5])
-
-        fw('\n\t\t\tProperty: "RotationOrder", "enum", "",0'
-           '\n\t\t\tProperty: "RotationSpaceForLimitOnly", "bool", "",0'
-           '\n\t\t\tProperty: "AxisLen", "double", "",10'
-           '\n\t\t\tProperty: "PreRotation", "Vector3D", "",0,0,0'
-           '\n\t\t\tProperty: "PostRotation", "Vector3D", "",0,0,0'
-           '\n\t\t\tProperty: "RotationActive", "bool", "",0'
-           )
+        loc, rot, scale, matrix, matrix_rot = object_tx(ob, loc, matrix, matrix_mod)
 
-        fw('\n\t\t\tProperty: "RotationMin", "Vector3D", "",%.15g,%.15g,%.15g' % constraints["rot_min"])
-        fw('\n\t\t\tProperty: "RotationMax", "Vector3D", "",%.15g,%.15g,%.15g' % constraints["rot_max"])
-        fw('\n\t\t\tProperty: "RotationMinX", "bool", "",%d' % constraints["rot_limit"][0])
-        fw('\n\t\t\tProperty: "RotationMinY", "bool", "",%d' % constraints["rot_limit"][1])
-        fw('\n\t\t\tProperty: "RotationMinZ", "bool", "",%d' % constraints["rot_limit"][2])
-        fw('\n\t\t\tProperty: "RotationMaxX", "bool", "",%d' % constraints["rot_limit"][0])
-        fw('\n\t\t\tProperty: "RotationMaxY", "bool", "",%d' % constraints["rot_limit"][1])
-        fw('\n\t\t\tProperty: "RotationMaxZ", "bool", "",%d' % constraints["rot_limit"][2])
-
-        fw('\n\t\t\tProperty: "RotationStiffnessX", "double", "",0'
-           '\n\t\t\tProperty: "RotationStiffnessY", "double", "",0'
-           '\n\t\t\tProperty: "RotationStiffnessZ", "double", "",0'
-           '\n\t\t\tProperty: "MinDampRangeX", "double", "",0'
-           '\n\t\t\tProperty: "MinDampRangeY", "double", "",0'
-           '\n\t\t\tProperty: "MinDampRangeZ", "double", "",0'
-           '\n\t\t\tProperty: "MaxDampRangeX", "double", "",0'
-           '\n\t\t\tProperty: "MaxDampRangeY", "double", "",0'
-           '\n\t\t\tProperty: "MaxDampRangeZ", "double", "",0'
-           '\n\t\t\tProperty: "MinDampStrengthX", "double", "",0'
-           '\n\t\t\tProperty: "MinDampStrengthY", "double", "",0'
-           '\n\t\t\tProperty: "MinDampStrengthZ", "double", "",0'
-           '\n\t\t\tProperty: "MaxDampStrengthX", "double", "",0'
-           '\n\t\t\tProperty: "MaxDampStrengthY", "double", "",0'
-           '\n\t\t\tProperty: "MaxDampStrengthZ", "double", "",0'
-           '\n\t\t\tProperty: "PreferedAngleX", "double", "",0'
-           '\n\t\t\tProperty: "PreferedAngleY", "double", "",0'
-           '\n\t\t\tProperty: "PreferedAngleZ", "double", "",0'
-           '\n\t\t\tProperty: "InheritType", "enum", "",0'
-           '\n\t\t\tProperty: "ScalingActive", "bool", "",0'
-           )
+        values = constraints_props(constraints) if has_constraints else {}
+        values["Lcl Translation"] = loc
+        values["Lcl Rotation"] = tuple_rad_to_deg(rot)
+        values["Lcl Scaling"] = scale
 
-        fw('\n\t\t\tProperty: "ScalingMin", "Vector3D", "",%.15g,%.15g,%.15g' % constraints["sca_min"])
-        fw('\n\t\t\tProperty: "ScalingMax", "Vector3D", "",%.15g,%.15g,%.15g' % constraints["sca_max"])
-        fw('\n\t\t\tProperty: "ScalingMinX", "bool", "",%d' % constraints["sca_limit"][0])
-        fw('\n\t\t\tProperty: "ScalingMinY", "bool", "",%d' % constraints["sca_limit"][1])
-        fw('\n\t\t\tProperty: "ScalingMinZ", "bool", "",%d' % constraints["sca_limit"][2])
-        fw('\n\t\t\tProperty: "ScalingMaxX", "bool", "",%d' % constraints["sca_limit"][3])
-        fw('\n\t\t\tProperty: "ScalingMaxY", "bool", "",%d' % constraints["sca_limit"][4])
-        fw('\n\t\t\tProperty: "ScalingMaxZ", "bool", "",%d' % constraints["sca_limit"][5])
-
-        fw('\n\t\t\tProperty: "GeometricTranslation", "Vector3D", "",0,0,0'
-           '\n\t\t\tProperty: "GeometricRotation", "Vector3D", "",0,0,0'
-           '\n\t\t\tProperty: "GeometricScaling", "Vector3D", "",1,1,1'
-           '\n\t\t\tProperty: "LookAtProperty", "object", ""'
-           '\n\t\t\tProperty: "UpVectorProperty", "object", ""'
-           '\n\t\t\tProperty: "Show", "bool", "",1'
-           '\n\t\t\tProperty: "NegativePercentShapeSupport", "bool", "",1'
-           '\n\t\t\tProperty: "DefaultAttributeIndex", "int", "",0'
-           )
+        # Only objects have color, not bones.
+        has_color = bool(ob) and not isinstance(ob, bpy.types.Bone)
 
-        if ob and not isinstance(ob, bpy.types.Bone):
-            # Only mesh objects have color
-            fw('\n\t\t\tProperty: "Color", "Color", "A",0.8,0.8,0.8'
-               '\n\t\t\tProperty: "Size", "double", "",100'
-               '\n\t\t\tProperty: "Look", "enum", "",1'
-               )
+        fw('\n\t\tProperties60:  {')
+        write_props(object_props_templates[has_color, has_constraints], values)
 
         return loc, rot, scale, matrix, matrix_rot
 
@@ -1314,13 +2811,20 @@ def save_single(operator, scene, filepath="",
 		}
 		UserData: "", ""''')
 
+        # Original vertex of each written one, in case welding split some.
+        vert_map = my_mesh.fbxVertexMap
+        if vert_map is None:
+            vert_map = range(len(my_mesh.blenData.vertices))
+        elif use_numpy:
+            vert_map = vert_map.tolist()
+
         # Support for bone parents
         if my_mesh.fbxBoneParent:
             if my_mesh.fbxBoneParent == my_bone:
                 # TODO - this is a bit lazy, we could have a simple write loop
                 # for this case because all weights are 1.0 but for now this is ok
                 # Parent Bones arent used all that much anyway.
-                vgroup_data = [(j, 1.0) for j in range(len(my_mesh.blenData.vertices))]
+                vgroup_data = [(j, 1.0) for j in range(len(vert_map))]
             else:
                 # This bone is not a parent of this mesh object, no weights
                 vgroup_data = []
@@ -1330,36 +2834,16 @@ def save_single(operator, scene, filepath="",
             if my_bone.blenName in weights[0]:
                 # Before we used normalized weight list
                 group_index = weights[0].index(my_bone.blenName)
-                vgroup_data = [(j, weight[group_index]) for j, weight in enumerate(weights[1]) if weight[group_index]]
+                vgroup_data = [(j, weights[1][v][group_index]) for j, v in enumerate(vert_map)
+                               if weights[1][v][group_index]]
             else:
                 vgroup_data = []
 
         fw('\n\t\tIndexes: ')
-
-        i = -1
-        for vg in vgroup_data:
-            if i == -1:
-                fw('%i' % vg[0])
-                i = 0
-            else:
-                if i == 23:
-                    fw('\n\t\t')
-                    i = 0
-                fw(',%i' % vg[0])
-            i += 1
+        fw_array([vg[0] for vg in vgroup_data], 'i', 23, '\n\t\t,')
 
         fw('\n\t\tWeights: ')
-        i = -1
-        for vg in vgroup_data:
-            if i == -1:
-                fw('%.8f' % vg[1])
-                i = 0
-            else:
-                if i == 38:
-                    fw('\n\t\t')
-                    i = 0
-                fw(',%.8f' % vg[1])
-            i += 1
+        fw_array([vg[1] for vg in vgroup_data], 'f', 38, '\n\t\t,', 'weight')
 
         # Set TransformLink to the global transform of the bone and Transform
         # equal to the mesh's transform in bone space.
@@ -1369,8 +2853,8 @@ def save_single(operator, scene, filepath="",
         global_mesh_matrix = my_mesh.matrixWorld
         transform_matrix = (global_bone_matrix.inverted() * global_mesh_matrix)
 
-        global_bone_matrix_string = mat4x4str(global_bone_matrix )
-        transform_matrix_string = mat4x4str(transform_matrix )
+        global_bone_matrix_string = float_str(mat4x4_values(global_bone_matrix), 'matrix')
+        transform_matrix_string = float_str(mat4x4_values(transform_matrix), 'matrix')
 
         fw('\n\t\tTransform: %s' % transform_matrix_string)
         fw('\n\t\tTransformLink: %s' % global_bone_matrix_string)
@@ -1383,9 +2867,11 @@ def save_single(operator, scene, filepath="",
         do_materials = bool([m for m in my_mesh.blenMaterials if m is not None])
         do_textures = bool([t for t in my_mesh.blenTextures if t is not None])
         do_uvs = bool(me.uv_layers)
+        # Vertex count of the whole mesh, and index in it of each vertex of this part, for split meshes.
+        split_verts = my_mesh.blenSplitVerts
         do_shapekeys = (my_mesh.blenObject.type == 'MESH' and
                         my_mesh.blenObject.data.shape_keys and
-                        len(my_mesh.blenObject.data.vertices) == len(me.vertices))
+                        len(my_mesh.blenObject.data.vertices) == (split_verts[0] if split_verts else len(me.vertices)))
         # print(len(my_mesh.blenObject.data.vertices), len(me.vertices))  # XXX does not work when org obj is no mesh!
 
         fw('\n\tModel: "Model::%s", "Mesh" {' % my_mesh.fbxName)
@@ -1417,94 +2903,258 @@ def save_single(operator, scene, filepath="",
 
 
 
+        # Gather the per loop data first, welding may have to split vertices before any of it can be written.
+        # NOTE: Here we assume that loops order matches polygons order!
+        t_vi = mesh_array(me.loops, "vertex_index", len(me.loops), "int32")
+        t_ls = mesh_array(me.polygons, "loop_start", len(me.polygons), "int32")
+
+        # Layers are [name, unique items, per loop (or per vertex) indices, mapping] lists.
+        # Without welding, nothing needs them before they are written: in chunked mode they are only fetched from the
+        # mesh then (unique items being the function fetching the layer until that), instead of all up front.
+        use_layers_deferred = mesh_weld_type == 'OFF' and mesh_chunk_size > 0
+        loop_order = None
+
+        def layer_fetcher(fetch, width, use_dedup, tolerance=0.0):
+            """
+            Function returning the (unique items, per loop indices) of the per loop data fetch() returns, or
+            (items, None) if use_dedup is not set.
+            """
+            def fetch_layer():
+                items = fetch()
+                if use_dedup:
+                    return dedup_items(items, width, use_numpy, tolerance)
+                return items, None
+            return fetch_layer
+
+        def layer_fetched(layer):
+            """
+            Fetch the data of a layer left for later, in the written loops order.
+            """
+            if callable(layer[1]):
+                layer[1:3] = layer[1]()
+                if loop_order is not None:
+                    if layer[2] is None:
+                        layer[1] = take_items(layer[1], loop_order, 3, use_numpy)
+                    else:
+                        layer[2] = take_items(layer[2], loop_order, 1, use_numpy)
+            return layer
+
+        # Tangent space is computed by Blender (MikkTSpace) for the active UV layer, along with split normals.
+        tangent_uvname = me.uv_layers.active.name if use_mesh_tangents and do_uvs else None
+
+        def fetch_tangent_space():
+            """
+            Per loop split normals, and tangents and binormals if asked for (else just the normals).
+            """
+            if tangent_uvname is None:
+                me.calc_normals_split()
+                t_vn = mesh_array(me.loops, "normal", len(me.loops) * 3, "float32")
+                me.free_normals_split()
+                return (t_vn,)
+            me.calc_tangents(tangent_uvname)
+            t_vn = mesh_array(me.loops, "normal", len(me.loops) * 3, "float32")
+            t_tn = mesh_array(me.loops, "tangent", len(me.loops) * 3, "float32")
+            t_bs = mesh_array(me.loops, "bitangent_sign", len(me.loops), "float32")
+            me.free_tangents()
+            return t_vn, t_tn, loop_binormals(t_vn, t_tn, t_bs, use_numpy)
+
+        if use_layers_deferred:
+            # Tangent space is computed once, when the first of its layers is written, each layer then taking its
+            # own part out of it.
+            tangent_space = []
+
+            def fetch_tangent_part(k):
+                if not tangent_space:
+                    tangent_space[:] = fetch_tangent_space()
+                part, tangent_space[k] = tangent_space[k], None
+                return part
+
+            fetches = [lambda k=k: fetch_tangent_part(k) for k in range(1 if tangent_uvname is None else 3)]
+        else:
+            fetches = [lambda t=t: t for t in fetch_tangent_space()]
+        # Split normals mostly repeat on hard-surface meshes, only write each one once.
+        normal_layer = ["", layer_fetcher(fetches[0], 3, use_mesh_normals_indexed or mesh_weld_type != 'OFF',
+                                          mesh_normals_tolerance), None, "ByPolygonVertex"]
+        tangent_layers = [[tangent_uvname, layer_fetcher(fetch, 3, mesh_weld_type != 'OFF'), None, "ByPolygonVertex"]
+                          for fetch in fetches[1:]]
+        del fetches
+
+        collayers = [[collayer.name,
+                      layer_fetcher(lambda collayer=collayer: mesh_array(collayer.data, "color", len(me.loops) * 3,
+                                                                         "float32"), 3, True),
+                      None, "ByPolygonVertex"]
+                     for collayer in me.vertex_colors]
+        uvlayers = []
+        if do_uvs:
+            uvlayers = [[uvlayer.name,
+                         layer_fetcher(lambda uvlayer=uvlayer: mesh_array(uvlayer.data, "uv", len(me.loops) * 2,
+                                                                          "float32"), 2, True),
+                         None, "ByPolygonVertex"]
+                        for uvlayer in me.uv_layers]
+        if not use_layers_deferred:
+            for layer in [normal_layer] + tangent_layers + collayers + uvlayers:
+                layer_fetched(layer)
+
+        # Write layers per control point when possible, splitting vertices if asked to.
+        vert_map = None
+        if mesh_weld_type != 'OFF' and len(me.loops):
+            layers = [normal_layer] + tangent_layers + collayers + uvlayers
+            vert_map, t_vi, cp_ids = weld_vertices(len(me.vertices), t_vi, [layer[2] for layer in layers],
+                                                   use_numpy, mesh_weld_type == 'SPLIT')
+            for layer, ids in zip(layers, cp_ids):
+                if ids is not None:
+                    layer[2:] = ids, "ByVertice"
+            del layers
+            del cp_ids
+
+        # Reorder polygons for post-transform vertex cache locality, then vertices by first use for fetch locality.
+        poly_order = vert_remap = None
+        if use_mesh_cache_optimize and len(me.polygons):
+            nbr_verts = len(me.vertices) if vert_map is None else len(vert_map)
+            acmr = mesh_acmr(t_vi, t_ls)
+            poly_order = cache_optimize_polygons(t_vi, t_ls, nbr_verts)
+            t_ls, loop_order = polygons_loops_order(t_ls, len(me.loops), poly_order, use_numpy)
+            t_vi = take_items(t_vi, loop_order, 1, use_numpy)
+            vert_order, vert_remap = fetch_optimize_vertices(t_vi, nbr_verts, use_numpy)
+            t_vi = take_items(vert_remap, t_vi, 1, use_numpy)
+            vert_map = vert_order if vert_map is None else take_items(vert_map, vert_order, 1, use_numpy)
+            for layer in [normal_layer] + tangent_layers + collayers + uvlayers:
+                if callable(layer[1]):
+                    # Reordered once fetched.
+                    pass
+                elif layer[2] is None:
+                    layer[1] = take_items(layer[1], loop_order, 3, use_numpy)
+                else:
+                    layer[2] = take_items(layer[2], vert_order if layer[3] == "ByVertice" else loop_order, 1, use_numpy)
+            print("\t%s: ACMR %.3f -> %.3f" % (my_mesh.fbxName, acmr, mesh_acmr(t_vi, t_ls)))
+            if not use_layers_deferred:
+                loop_order = None
+            del vert_order
+
+        # Skin clusters and shape keys need to know where the original vertices went.
+        my_mesh.fbxVertexMap = vert_map
+
         # Write the Real Mesh data here
         fw('\n\t\tVertices: ')
         _nchunk = 12  # Number of coordinates per line.
-        t_co = [None] * len(me.vertices) * 3
-        me.vertices.foreach_get("co", t_co)
-        fw(',\n\t\t          '.join(','.join('%.6f' % co for co in chunk) for chunk in grouper_exact(t_co, _nchunk)))
+        t_co = mesh_array(me.vertices, "co", len(me.vertices) * 3, "float32")
+        if vert_map is not None:
+            t_co = take_items(t_co, vert_map, 3, use_numpy)
+        fw_array(t_co, 'f', _nchunk, ',\n\t\t          ', 'position')
         del t_co
 
         fw('\n\t\tPolygonVertexIndex: ')
         _nchunk = 32  # Number of indices per line.
         # A bit more complicated, as we have to ^-1 last index of each loop.
-        # NOTE: Here we assume that loops order matches polygons order!
-        t_vi = [None] * len(me.loops)
-        me.loops.foreach_get("vertex_index", t_vi)
-        t_ls = [None] * len(me.polygons)
-        me.polygons.foreach_get("loop_start", t_ls)
-        if t_ls != sorted(t_ls):
-            print("Error: polygons and loops orders do not match!")
-        for ls in t_ls:
-            t_vi[ls - 1] ^= -1
+        if use_numpy:
+            if numpy.any(t_ls[1:] < t_ls[:-1]):
+                print("Error: polygons and loops orders do not match!")
+            t_vi[t_ls - 1] ^= -1
+        else:
+            if sorted(t_ls) != list(t_ls):
+                print("Error: polygons and loops orders do not match!")
+            for ls in t_ls:
+                t_vi[ls - 1] ^= -1
         prep = ',\n\t\t                    '
-        fw(prep.join(','.join('%i' % vi for vi in chunk) for chunk in grouper_exact(t_vi, _nchunk)))
+        fw_array(t_vi, 'i', _nchunk, prep)
         del t_vi
         del t_ls
 
         if use_mesh_edges:
-            t_vi = [None] * len(me.edges) * 2
-            me.edges.foreach_get("vertices", t_vi)
+            t_vi = mesh_array(me.edges, "vertices", len(me.edges) * 2, "int32")
+            if vert_remap is not None:
+                t_vi = take_items(vert_remap, t_vi, 1, use_numpy)
 
             # write loose edges as faces.
-            t_el = [None] * len(me.edges)
-            me.edges.foreach_get("is_loose", t_el)
-            num_lose = sum(t_el)
+            t_el = mesh_array(me.edges, "is_loose", len(me.edges), "bool")
+            num_lose = numpy.count_nonzero(t_el) if use_numpy else sum(t_el)
             if num_lose != 0:
-                it_el = ((vi ^ -1) if (idx % 2) else vi for idx, vi in enumerate(t_vi) if t_el[idx // 2])
+                if use_numpy:
+                    it_el = t_vi.reshape(-1, 2)[t_el]
+                    it_el[:, 1] ^= -1
+                else:
+                    it_el = [(vi ^ -1) if (idx % 2) else vi for idx, vi in enumerate(t_vi) if t_el[idx // 2]]
                 if (len(me.loops)):
                     fw(prep)
-                fw(prep.join(','.join('%i' % vi for vi in chunk) for chunk in grouper_exact(it_el, _nchunk)))
+                fw_array(it_el.ravel() if use_numpy else it_el, 'i', _nchunk, prep)
+                del it_el
 
             fw('\n\t\tEdges: ')
-            fw(',\n\t\t       '.join(','.join('%i' % vi for vi in chunk) for chunk in grouper_exact(t_vi, _nchunk)))
+            fw_array(t_vi, 'i', _nchunk, ',\n\t\t       ')
             del t_vi
             del t_el
 
         fw('\n\t\tGeometryVersion: 124')
 
         _nchunk = 12  # Number of coordinates per line.
-        t_vn = [None] * len(me.loops) * 3
-        me.calc_normals_split()
-        # NOTE: Here we assume that loops order matches polygons order!
-        me.loops.foreach_get("normal", t_vn)
+        _nchunk_idx = 64  # Number of normal indices per line
+        t_vn, t_vni, vn_mapping = layer_fetched(normal_layer)[1:]
         fw('\n\t\tLayerElementNormal: 0 {'
            '\n\t\t\tVersion: 101'
            '\n\t\t\tName: ""'
-           '\n\t\t\tMappingInformationType: "ByPolygonVertex"'
-           '\n\t\t\tReferenceInformationType: "Direct"'  # We could save some space with IndexToDirect here too...
-           '\n\t\t\tNormals: ')
-        fw(',\n\t\t\t         '.join(','.join('%.6f' % n for n in chunk) for chunk in grouper_exact(t_vn, _nchunk)))
+           '\n\t\t\tMappingInformationType: "%s"' % vn_mapping)
+        if use_mesh_normals_indexed:
+            fw('\n\t\t\tReferenceInformationType: "IndexToDirect"'
+               '\n\t\t\tNormals: ')
+            fw_array(t_vn, 'f', _nchunk, ',\n\t\t\t         ', 'normal')
+            fw('\n\t\t\tNormalsIndex: ')
+            fw_array(t_vni, 'i', _nchunk_idx, ',\n\t\t\t              ')
+        else:
+            if t_vni is not None:
+                t_vn = take_items(t_vn, t_vni, 3, use_numpy)
+            fw('\n\t\t\tReferenceInformationType: "Direct"'
+               '\n\t\t\tNormals: ')
+            fw_array(t_vn, 'f', _nchunk, ',\n\t\t\t         ', 'normal')
         fw('\n\t\t}')
         del t_vn
-        me.free_normals_split()
+        del t_vni
+        del normal_layer
+
+        # Write tangent space, always direct.
+        for tnindex, (elem, tag) in enumerate((("Tangent", "Tangents"), ("Binormal", "Binormals"))[:len(tangent_layers)]):
+            tname, t_tn, t_tni, tn_mapping = layer_fetched(tangent_layers[tnindex])
+            tangent_layers[tnindex] = None  # Not needed anymore, free it.
+            if t_tni is not None:
+                t_tn = take_items(t_tn, t_tni, 3, use_numpy)
+            fw('\n\t\tLayerElement%s: 0 {'
+               '\n\t\t\tVersion: 101'
+               '\n\t\t\tName: "%s"'
+               '\n\t\t\tMappingInformationType: "%s"'
+               '\n\t\t\tReferenceInformationType: "Direct"'
+               '\n\t\t\t%s: ' % (elem, tname, tn_mapping, tag))
+            fw_array(t_tn, 'f', _nchunk, ',\n\t\t\t' + ' ' * (len(tag) + 2), 'normal')
+            fw('\n\t\t}')
+            del t_tn
 
         # Write Face Smoothing
         _nchunk = 64  # Number of bool per line.
         if mesh_smooth_type == 'FACE':
-            t_ps = [None] * len(me.polygons)
-            me.polygons.foreach_get("use_smooth", t_ps)
+            t_ps = mesh_array(me.polygons, "use_smooth", len(me.polygons), "bool")
+            if poly_order is not None:
+                t_ps = take_items(t_ps, poly_order, 1, use_numpy)
             fw('\n\t\tLayerElementSmoothing: 0 {'
                '\n\t\t\tVersion: 102'
                '\n\t\t\tName: ""'
                '\n\t\t\tMappingInformationType: "ByPolygon"'
                '\n\t\t\tReferenceInformationType: "Direct"'
                '\n\t\t\tSmoothing: ')
-            fw(',\n\t\t\t           '.join(','.join('%d' % b for b in chunk) for chunk in grouper_exact(t_ps, _nchunk)))
+            fw_array(t_ps, 'b', _nchunk, ',\n\t\t\t           ')
             fw('\n\t\t}')
             del t_ps
         elif mesh_smooth_type == 'EDGE':
             # Write Edge Smoothing
-            t_es = [None] * len(me.edges)
-            me.edges.foreach_get("use_edge_sharp", t_es)
+            t_es = mesh_array(me.edges, "use_edge_sharp", len(me.edges), "bool")
+            if use_numpy:
+                t_es = ~t_es
+            else:
+                t_es = [not b for b in t_es]
             fw('\n\t\tLayerElementSmoothing: 0 {'
                '\n\t\t\tVersion: 101'
                '\n\t\t\tName: ""'
                '\n\t\t\tMappingInformationType: "ByEdge"'
                '\n\t\t\tReferenceInformationType: "Direct"'
                '\n\t\t\tSmoothing: ')
-            fw(',\n\t\t\t           '
-               ''.join(','.join('%d' % (not b) for b in chunk) for chunk in grouper_exact(t_es, _nchunk)))
+            fw_array(t_es, 'b', _nchunk, ',\n\t\t\t           ')
             fw('\n\t\t}')
             del t_es
         elif mesh_smooth_type == 'OFF':
@@ -1514,43 +3164,27 @@ def save_single(operator, scene, filepath="",
 
         # Write VertexColor Layers
         # note, no programs seem to use this info :/
-        collayers = []
-        if len(me.vertex_colors):
-            collayers = me.vertex_colors
-            t_lc = [None] * len(me.loops) * 3
-            col2idx = None
+        if collayers:
             _nchunk = 4  # Number of colors per line
             _nchunk_idx = 64  # Number of color indices per line
             for colindex, collayer in enumerate(collayers):
-                collayer.data.foreach_get("color", t_lc)
-                lc = tuple(zip(*[iter(t_lc)] * 3))
+                colname, col2idx, t_ci, col_mapping = layer_fetched(collayer)
                 fw('\n\t\tLayerElementColor: %i {'
                    '\n\t\t\tVersion: 101'
                    '\n\t\t\tName: "%s"'
-                   '\n\t\t\tMappingInformationType: "ByPolygonVertex"'
+                   '\n\t\t\tMappingInformationType: "%s"'
                    '\n\t\t\tReferenceInformationType: "IndexToDirect"'
-                   '\n\t\t\tColors: ' % (colindex, collayer.name))
-
-                col2idx = tuple(set(lc))
-                fw(',\n\t\t\t        '.join(','.join('%.6f,%.6f,%.6f,1' % c for c in chunk)
-                                            for chunk in grouper_exact(col2idx, _nchunk)))
+                   '\n\t\t\tColors: ' % (colindex, colname, col_mapping))
+                fw_array(col2idx, 'fff', _nchunk, ',\n\t\t\t        ', 'color', suffix=',1')
 
                 fw('\n\t\t\tColorIndex: ')
-                col2idx = {col: idx for idx, col in enumerate(col2idx)}
-                fw(',\n\t\t\t            '
-                   ''.join(','.join('%d' % col2idx[c] for c in chunk) for chunk in grouper_exact(lc, _nchunk_idx)))
+                fw_array(t_ci, 'i', _nchunk_idx, ',\n\t\t\t            ')
                 fw('\n\t\t}')
-            del t_lc
+                collayers[colindex] = None  # Not needed anymore, free it.
 
         # Write UV and texture layers.
-        uvlayers = []
-        uvtextures = []
         if do_uvs:
-            uvlayers = me.uv_layers
-            uvtextures = me.uv_textures
-            t_uv = [None] * len(me.loops) * 2
             t_pi = None
-            uv2idx = None
             tex2idx = None
             _nchunk = 6  # Number of UVs per line
             _nchunk_idx = 64  # Number of UV indices per line
@@ -1559,23 +3193,19 @@ def save_single(operator, scene, filepath="",
                 tex2idx = {None: -1}
                 tex2idx.update({tex: i for i, tex in enumerate(my_mesh.blenTextures)})
 
-            for uvindex, (uvlayer, uvtexture) in enumerate(zip(uvlayers, uvtextures)):
-                uvlayer.data.foreach_get("uv", t_uv)
-                uvco = tuple(zip(*[iter(t_uv)] * 2))
+            for uvindex, uvlayer in enumerate(uvlayers):
+                uvname, uv2idx, t_uvi, uv_mapping = layer_fetched(uvlayer)
                 fw('\n\t\tLayerElementUV: %d {'
                    '\n\t\t\tVersion: 101'
                    '\n\t\t\tName: "%s"'
-                   '\n\t\t\tMappingInformationType: "ByPolygonVertex"'
+                   '\n\t\t\tMappingInformationType: "%s"'
                    '\n\t\t\tReferenceInformationType: "IndexToDirect"'
-                   '\n\t\t\tUV: ' % (uvindex, uvlayer.name))
-                uv2idx = tuple(set(uvco))
-                fw(',\n\t\t\t    '
-                   ''.join(','.join('%.6f,%.6f' % uv for uv in chunk) for chunk in grouper_exact(uv2idx, _nchunk)))
+                   '\n\t\t\tUV: ' % (uvindex, uvname, uv_mapping))
+                fw_array(uv2idx, 'ff', _nchunk, ',\n\t\t\t    ', 'uv')
                 fw('\n\t\t\tUVIndex: ')
-                uv2idx = {uv: idx for idx, uv in enumerate(uv2idx)}
-                fw(',\n\t\t\t         '
-                   ''.join(','.join('%d' % uv2idx[uv] for uv in chunk) for chunk in grouper_exact(uvco, _nchunk_idx)))
+                fw_array(t_uvi, 'i', _nchunk_idx, ',\n\t\t\t         ')
                 fw('\n\t\t}')
+                uvlayers[uvindex] = None  # Not needed anymore, free it.
 
                 if do_textures:
                     fw('\n\t\tLayerElementTexture: %d {'
@@ -1586,13 +3216,19 @@ def save_single(operator, scene, filepath="",
                        '\n\t\t\tBlendMode: "Translucent"'
                        '\n\t\t\tTextureAlpha: 1'
                        '\n\t\t\tTextureId: '
-                       % (uvindex, uvlayer.name, ('AllSame' if is_tex_unique else 'ByPolygon')))
+                       % (uvindex, uvname, ('AllSame' if is_tex_unique else 'ByPolygon')))
                     if is_tex_unique:
                         fw('0')
                     else:
-                        t_pi = (d.image for d in uvtexture.data)  # Can't use foreach_get here :(
-                        fw(',\n\t\t\t           '.join(','.join('%d' % tex2idx[i] for i in chunk)
-                                                       for chunk in grouper_exact(t_pi, _nchunk_idx)))
+                        images, t_ii = my_mesh.blenPolyTexs[uvindex][:2]
+                        t_pi = [tex2idx[img] for img in images]
+                        if use_numpy:
+                            t_pi = numpy.array(t_pi, dtype=numpy.int32)[t_ii]
+                        else:
+                            t_pi = [t_pi[i] for i in t_ii]
+                        if poly_order is not None:
+                            t_pi = take_items(t_pi, poly_order, 1, use_numpy)
+                        fw_array(t_pi, 'i', _nchunk_idx, ',\n\t\t\t           ')
                     fw('\n\t\t}')
             if not do_textures:
                 fw('\n\t\tLayerElementTexture: 0 {'
@@ -1604,7 +3240,6 @@ def save_single(operator, scene, filepath="",
                    '\n\t\t\tTextureAlpha: 1'
                    '\n\t\t\tTextureId: '
                    '\n\t\t}')
-            del t_uv
             del t_pi
 
         # Done with UV/textures.
@@ -1624,14 +3259,19 @@ def save_single(operator, scene, filepath="",
                 mat2idx = {mt: i for i, mt in enumerate(my_mesh.blenMaterials)}  # (local-mat, tex) -> global index.
                 mats = my_mesh.blenMaterialList
                 if me.uv_textures.active and do_uvs:
-                    poly_tex = me.uv_textures.active.data
+                    # WARNING - MULTI UV LAYER IMAGES NOT SUPPORTED
+                    images, t_ii, pairs, t_pair = my_mesh.blenPolyTexs[me.uv_textures.active_index]
                 else:
-                    poly_tex = [None] * len(me.polygons)
-                _it_mat = (mats[p.material_index] for p in me.polygons)
-                _it_tex = (pt.image if pt else None for pt in poly_tex)  # WARNING - MULTI UV LAYER IMAGES NOT SUPPORTED
-                t_mti = (mat2idx[m, t] for m, t in zip(_it_mat, _it_tex))
-                fw(',\n\t\t\t           '
-                   ''.join(','.join('%d' % i for i in chunk) for chunk in grouper_exact(t_mti, _nchunk)))
+                    images = [None]
+                    pairs, t_pair = unique_pairs(my_mesh.blenPolyMats, None, 1, use_numpy)
+                t_mti = [mat2idx[mats[mi], images[ti]] for mi, ti in pairs]
+                if use_numpy:
+                    t_mti = numpy.array(t_mti, dtype=numpy.int32)[t_pair]
+                else:
+                    t_mti = [t_mti[i] for i in t_pair]
+                if poly_order is not None:
+                    t_mti = take_items(t_mti, poly_order, 1, use_numpy)
+                fw_array(t_mti, 'i', _nchunk, ',\n\t\t\t           ')
             fw('\n\t\t}')
 
         fw('\n\t\tLayer: 0 {'
@@ -1641,6 +3281,16 @@ def save_single(operator, scene, filepath="",
            '\n\t\t\t\tTypedIndex: 0'
            '\n\t\t\t}')
 
+        if tangent_layers:
+            fw('\n\t\t\tLayerElement:  {'
+               '\n\t\t\t\tType: "LayerElementTangent"'
+               '\n\t\t\t\tTypedIndex: 0'
+               '\n\t\t\t}'
+               '\n\t\t\tLayerElement:  {'
+               '\n\t\t\t\tType: "LayerElementBinormal"'
+               '\n\t\t\t\tTypedIndex: 0'
+               '\n\t\t\t}')
+
         # Smoothing info
         if mesh_smooth_type != 'OFF':
             fw('\n\t\t\tLayerElement:  {'
@@ -1717,32 +3367,43 @@ def save_single(operator, scene, filepath="",
             #     Aren't key's co already relative if set as such?
             #     Also, does not handle custom relative option for each key...
             # --mont29
-            import operator
             key_blocks = my_mesh.blenObject.data.shape_keys.key_blocks[:]
-            t_sk_basis = [None] * len(me.vertices) * 3
-            t_sk = [None] * len(me.vertices) * 3
-            key_blocks[0].data.foreach_get("co", t_sk_basis)
+            nbr_sk_verts = split_verts[0] if split_verts else len(me.vertices)
+            t_sk_basis = mesh_array(key_blocks[0].data, "co", nbr_sk_verts * 3, "float32")
+            if split_verts:
+                t_sk_basis = take_items(t_sk_basis, split_verts[1], 3, use_numpy)
             _nchunk = 4  # Number of delta coordinates per line
             _nchunk_idx = 32  # Number of vert indices per line
+            t_sk = None
 
             for kb in key_blocks[1:]:
-                kb.data.foreach_get("co", t_sk)
-                _dcos = tuple(zip(*[map(operator.sub, t_sk, t_sk_basis)] * 3))
-                verts = tuple(i for i, dco in enumerate(_dcos) if sum(map(operator.pow, dco, (2, 2, 2))) > 3e-12)
-                dcos = (_dcos[i] for i in verts)
+                t_sk = mesh_array(kb.data, "co", nbr_sk_verts * 3, "float32")
+                if split_verts:
+                    t_sk = take_items(t_sk, split_verts[1], 3, use_numpy)
+                if use_numpy:
+                    _dcos = numpy.asarray(t_sk, dtype=numpy.float64) - t_sk_basis
+                    if vert_map is not None:
+                        _dcos = take_items(_dcos, vert_map, 3, True)
+                    _dcos = _dcos.reshape(-1, 3)
+                    verts = numpy.flatnonzero(numpy.square(_dcos).sum(axis=1) > 3e-12)
+                    dcos = _dcos[verts].ravel()
+                else:
+                    _dcos = [a - b for a, b in zip(t_sk, t_sk_basis)]
+                    if vert_map is not None:
+                        _dcos = take_items(_dcos, vert_map, 3, False)
+                    verts = [i for i, dco in enumerate(zip(*[iter(_dcos)] * 3)) if (dco[0] ** 2 + dco[1] ** 2 + dco[2] ** 2) > 3e-12]
+                    dcos = [d for i in verts for d in _dcos[i * 3:i * 3 + 3]]
+                del _dcos
                 fw('\n\t\tShape: "%s" {'
                    '\n\t\t\tIndexes: ' % kb.name)
-                fw(',\n\t\t\t         '
-                   ''.join(','.join('%d' % i for i in chunk) for chunk in grouper_exact(verts, _nchunk_idx)))
+                fw_array(verts, 'i', _nchunk_idx, ',\n\t\t\t         ')
 
                 fw('\n\t\t\tVertices: ')
-                fw(',\n\t\t\t          '
-                   ''.join(','.join('%.6f,%.6f,%.6f' % c for c in chunk) for chunk in grouper_exact(dcos, _nchunk)))
+                fw_array(dcos, 'fff', _nchunk, ',\n\t\t\t          ', 'position')
                 # all zero, why? - campbell
                 # Would need to recompute them I guess... and I assume those are supposed to be delta as well?
                 fw('\n\t\t\tNormals: ')
-                fw(',\n\t\t\t         '
-                   ''.join(','.join('0,0,0' for c in chunk) for chunk in grouper_exact(range(len(verts)), _nchunk)))
+                fw_array([0] * (len(verts) * 3), 'iii', _nchunk, ',\n\t\t\t         ')
                 fw('\n\t\t}')
             del t_sk_basis
             del t_sk
@@ -1785,7 +3446,7 @@ def save_single(operator, scene, filepath="",
 
 ## XXX
 
-    if 'ARMATURE' in object_types:
+    if 'ARMATURE' in object_types and not use_anim_only:
         # This is needed so applying modifiers dosnt apply the armature deformation, its also needed
         # ...so mesh objects return their rest worldspace matrix when bone-parents are exported as weighted meshes.
         # set every armature to its rest, backup the original values so we done mess up the scene
@@ -1830,6 +3491,14 @@ def save_single(operator, scene, filepath="",
             elif tmp_ob_type == 'EMPTY':
                 if 'EMPTY' in object_types:
                     ob_null.append(my_object_generic(ob, mtx))
+            elif use_anim_only:
+                # Meshes are not written, but the armatures deforming them are.
+                if tmp_ob_type == 'MESH':
+                    armob = ob.find_armature()
+                    if (not armob) and ob.parent and ob.parent.type == 'ARMATURE' and ob.parent_type == 'BONE':
+                        armob = ob.parent
+                    if armob and armob not in ob_arms:
+                        ob_arms.append(armob)
             elif 'MESH' in object_types:
                 origData = True
                 if tmp_ob_type != 'MESH':
@@ -1873,81 +3542,113 @@ def save_single(operator, scene, filepath="",
 # 					if EXP_MESH_HQ_NORMALS:
 # 						BPyMesh.meshCalcNormals(me) # high quality normals nice for realtime engines.
 
+                    if use_mesh_triangulate:
+                        # Never triangulate the scene's own mesh, only a copy of it.
+                        if origData:
+                            me = me.copy()
+                            meshes_to_clear.append(me)
+                            origData = False
+                        mesh_triangulate(me)
+
                     if not mats:
                         mats = [None]
 
-                    texture_set_local = set()
-                    material_set_local = set()
-                    if me.uv_textures:
-                        for uvlayer in me.uv_textures:
-                            for p, p_uv in zip(me.polygons, uvlayer.data):
-                                tex = p_uv.image
-                                texture_set_local.add(tex)
-                                mat = mats[p.material_index]
+                    # Meshes with more (render) vertices than 16 bit indices can address are exported as several
+                    # meshes, split_verts being the (vertex count, original index of each vertex) of parts.
+                    parts = [(me, None)]
+                    if use_mesh_split:
+                        t_rv, nbr_rv = mesh_render_vertices(me, use_numpy)
+                        if nbr_rv > MESH_SPLIT_MAX_VERTS:
+                            t_ls = foreach_get_array(me.polygons, "loop_start", len(me.polygons), "int32", use_numpy)
+                            t_mi = foreach_get_array(me.polygons, "material_index", len(me.polygons), "int32", use_numpy)
+                            t_pc = foreach_get_array(me.polygons, "center", len(me.polygons) * 3, "float32", use_numpy)
+                            parts = []
+                            for polys in split_polygons(t_rv, t_ls, t_mi, t_pc, MESH_SPLIT_MAX_VERTS, use_numpy):
+                                part_me, vert_orig = mesh_extract_polygons(me, polys)
+                                meshes_to_clear.append(part_me)
+                                parts.append((part_me, (len(me.vertices), vert_orig)))
+                            origData = False
+                            print("\t%s: %d vertices, split in %d meshes" % (ob.name, nbr_rv, len(parts)))
+                            del t_ls, t_mi, t_pc
+                        del t_rv
+
+                    for me, split_verts in parts:
+                        texture_set_local = set()
+                        material_set_local = set()
+                        # Per polygon material indices, and per UV layer (images, image indices, (mat, image) index pairs,
+                        # pair indices), computed once here and reused by write_mesh.
+                        t_mi = foreach_get_array(me.polygons, "material_index", len(me.polygons), "int32", use_numpy)
+                        poly_texs = []
+                        if me.uv_textures:
+                            for uvlayer in me.uv_textures:
+                                # Can't use foreach_get for images :(
+                                images, t_ii = dedup_items([p_uv.image for p_uv in uvlayer.data], 1, False)
+                                if use_numpy:
+                                    t_ii = numpy.asarray(t_ii, dtype=numpy.int32)
+                                pairs, t_pair = unique_pairs(t_mi, t_ii, len(images), use_numpy)
+                                poly_texs.append((images, t_ii, pairs, t_pair))
+
+                                texture_set_local.update(images)
+                                material_set_local.update((mats[mi], images[ti]) for mi, ti in pairs)
 
-                                # Should not be needed anymore.
-                                #try:
-                                    #mat = mats[p.material_index]
-                                #except:
-                                    #mat = None
-
-                                material_set_local.add((mat, tex))
-
-                    else:
-                        for mat in mats:
-                            # 2.44 use mat.lib too for uniqueness
-                            material_set_local.add((mat, None))
+                        else:
+                            for mat in mats:
+                                # 2.44 use mat.lib too for uniqueness
+                                material_set_local.add((mat, None))
 
-                    textures |= texture_set_local
-                    materials |= material_set_local
+                        textures |= texture_set_local
+                        materials |= material_set_local
 
-                    if 'ARMATURE' in object_types:
-                        armob = ob.find_armature()
-                        blenParentBoneName = None
+                        if 'ARMATURE' in object_types:
+                            armob = ob.find_armature()
+                            blenParentBoneName = None
 
-                        # parent bone - special case
-                        if (not armob) and ob.parent and ob.parent.type == 'ARMATURE' and \
-                                ob.parent_type == 'BONE':
-                            armob = ob.parent
-                            blenParentBoneName = ob.parent_bone
+                            # parent bone - special case
+                            if (not armob) and ob.parent and ob.parent.type == 'ARMATURE' and \
+                                    ob.parent_type == 'BONE':
+                                armob = ob.parent
+                                blenParentBoneName = ob.parent_bone
 
-                        if armob and armob not in ob_arms:
-                            ob_arms.append(armob)
+                            if armob and armob not in ob_arms:
+                                ob_arms.append(armob)
 
-                        # Warning for scaled, mesh objects with armatures
-                        if abs(ob.scale[0] - 1.0) > 0.05 or abs(ob.scale[1] - 1.0) > 0.05 or abs(ob.scale[1] - 1.0) > 0.05:
-                            operator.report({'WARNING'}, "Object '%s' has a scale of (%.3f, %.3f, %.3f), " \
-                                                         "Armature deformation will not work as expected " \
-                                                         "(apply Scale to fix)" % ((ob.name,) + tuple(ob.scale)))
+                            # Warning for scaled, mesh objects with armatures
+                            if abs(ob.scale[0] - 1.0) > 0.05 or abs(ob.scale[1] - 1.0) > 0.05 or abs(ob.scale[1] - 1.0) > 0.05:
+                                operator.report({'WARNING'}, "Object '%s' has a scale of (%.3f, %.3f, %.3f), " \
+                                                             "Armature deformation will not work as expected " \
+                                                             "(apply Scale to fix)" % ((ob.name,) + tuple(ob.scale)))
 
-                    else:
-                        blenParentBoneName = armob = None
+                        else:
+                            blenParentBoneName = armob = None
 
-                    my_mesh = my_object_generic(ob, mtx)
-                    my_mesh.blenData = me
-                    my_mesh.origData = origData
-                    my_mesh.blenMaterials = list(material_set_local)
-                    my_mesh.blenMaterialList = mats
-                    my_mesh.blenTextures = list(texture_set_local)
+                        my_mesh = my_object_generic(ob, mtx)
+                        my_mesh.blenData = me
+                        my_mesh.origData = origData
+                        my_mesh.blenMaterials = list(material_set_local)
+                        my_mesh.blenMaterialList = mats
+                        my_mesh.blenPolyMats = t_mi
+                        my_mesh.blenPolyTexs = poly_texs
+                        my_mesh.blenTextures = list(texture_set_local)
+                        my_mesh.blenSplitVerts = split_verts
 
-                    # sort the name so we get predictable output, some items may be NULL
-                    my_mesh.blenMaterials.sort(key=lambda m: (getattr(m[0], "name", ""), getattr(m[1], "name", "")))
-                    my_mesh.blenTextures.sort(key=lambda m: getattr(m, "name", ""))
+                        # sort the name so we get predictable output, some items may be NULL
+                        my_mesh.blenMaterials.sort(key=lambda m: (getattr(m[0], "name", ""), getattr(m[1], "name", "")))
+                        my_mesh.blenTextures.sort(key=lambda m: getattr(m, "name", ""))
 
-                    # if only 1 null texture then empty the list
-                    if len(my_mesh.blenTextures) == 1 and my_mesh.blenTextures[0] is None:
-                        my_mesh.blenTextures = []
+                        # if only 1 null texture then empty the list
+                        if len(my_mesh.blenTextures) == 1 and my_mesh.blenTextures[0] is None:
+                            my_mesh.blenTextures = []
 
-                    my_mesh.fbxArm = armob  # replace with my_object_generic armature instance later
-                    my_mesh.fbxBoneParent = blenParentBoneName  # replace with my_bone instance later
+                        my_mesh.fbxArm = armob  # replace with my_object_generic armature instance later
+                        my_mesh.fbxBoneParent = blenParentBoneName  # replace with my_bone instance later
 
-                    ob_meshes.append(my_mesh)
+                        ob_meshes.append(my_mesh)
 
         # not forgetting to free dupli_list
         if ob_base.dupli_list:
             ob_base.dupli_list_clear()
 
-    if 'ARMATURE' in object_types:
+    if 'ARMATURE' in object_types and not use_anim_only:
         # now we have the meshes, restore the rest arm position
         for i, arm in enumerate(bpy.data.armatures):
             arm.pose_position = ob_arms_orig_rest[i]
@@ -2013,19 +3714,25 @@ def save_single(operator, scene, filepath="",
                     my_mesh.fbxArm = my_arm
                     break
 
+        # Parts of split meshes only get clusters for the bones weighting them.
+        split_groups = None
+        if my_mesh.fbxArm and my_mesh.blenSplitVerts and not my_mesh.fbxBoneParent:
+            vertex_groups = my_mesh.blenObject.vertex_groups
+            split_groups = {vertex_groups[g.group].name for v in my_mesh.blenData.vertices for g in v.groups
+                            if g.weight and g.group < len(vertex_groups)}
+
         for my_bone in ob_bones:
 
             # The mesh uses this bones armature!
             if my_bone.fbxArm == my_mesh.fbxArm:
-                if my_bone.blenBone.use_deform:
-                    my_bone.blenMeshes[my_mesh.fbxName] = me
+                if my_bone.blenBone.use_deform and (split_groups is None or my_bone.blenName in split_groups):
+                    my_bone.blenMeshes[my_mesh.fbxName] = my_mesh.blenData
 
                 # parent bone: replace bone names with our class instances
                 # my_mesh.fbxBoneParent is None or a blender bone name initialy, replacing if the names match.
                 if my_mesh.fbxBoneParent == my_bone.blenName:
                     my_mesh.fbxBoneParent = my_bone
 
-    bone_deformer_count = 0  # count how many bones deform a mesh
     my_bone_blenParent = None
     for my_bone in ob_bones:
         my_bone_blenParent = my_bone.blenBone.parent
@@ -2038,7 +3745,6 @@ def save_single(operator, scene, filepath="",
 
         # Not used at the moment
         # my_bone.calcRestMatrixLocal()
-        bone_deformer_count += len(my_bone.blenMeshes)
 
     del my_bone_blenParent
 
@@ -2052,7 +3758,8 @@ def save_single(operator, scene, filepath="",
     for ob_generic in ob_all_typegroups:
         for ob_base in ob_generic:
             ob_base.blenObject.tag = True
-            tmp_obmapping[ob_base.blenObject] = ob_base
+            # Split meshes give several objects for the same blender one.
+            tmp_obmapping.setdefault(ob_base.blenObject, []).append(ob_base)
 
     # Build Groups from objects we export
     for blenGroup in bpy.data.groups:
@@ -2063,7 +3770,8 @@ def save_single(operator, scene, filepath="",
                     fbxGroupName = sane_groupname(blenGroup)
                     groups.append((fbxGroupName, blenGroup))
 
-                tmp_obmapping[ob].fbxGroupNames.append(fbxGroupName)  # also adds to the objects fbxGroupNames
+                for ob_base in tmp_obmapping[ob]:
+                    ob_base.fbxGroupNames.append(fbxGroupName)  # also adds to the objects fbxGroupNames
 
     groups.sort()  # not really needed
 
@@ -2072,7 +3780,7 @@ def save_single(operator, scene, filepath="",
         for my_ob in ob_generic:
             parent = my_ob.blenObject.parent
             if parent and parent.tag:  # does it exist and is it in the mapping
-                my_ob.fbxParent = tmp_obmapping[parent]
+                my_ob.fbxParent = tmp_obmapping[parent][0]
 
     del tmp_obmapping
     # Finished finding groups we use
@@ -2080,12 +3788,137 @@ def save_single(operator, scene, filepath="",
     # == WRITE OBJECTS TO THE FILE ==
     # == From now on we are building the FBX file from the information collected above (JCB)
 
+    # Name them in a stable order, sets' one changes from one run to the other.
+    materials = sorted(materials, key=lambda m: (getattr(m[0], "name", ""), getattr(m[1], "name", "")))
+    textures = sorted((tex for tex in textures if tex), key=lambda t: t.name)
     materials = [(sane_matname(mat_tex_pair), mat_tex_pair) for mat_tex_pair in materials]
-    textures = [(sane_texname(tex), tex) for tex in textures if tex]
+    textures = [(sane_texname(tex), tex) for tex in textures]
     materials.sort(key=lambda m: m[0])  # sort by name
     textures.sort(key=lambda m: m[0])
 
-    camera_count = 8 if 'CAMERA' in object_types else 0
+    # == BUILD THE OBJECT GRAPH ==
+    # Nodes are added in Relations order, edges in Connections order.
+    graph = ObjectGraph()
+    model_ids = {}
+
+    # Nulls are likely to cause problems for XNA
+    for my_null in ob_null:
+        model_ids[my_null] = graph.add("Model", "Model::" + my_null.fbxName, "Null")
+
+    # Armature must be a Limb for XNA
+    # Note, 2.58 and previous wrote these as normal empties and it worked mostly (except for XNA)
+    for my_arm in ob_arms:
+        model_ids[my_arm] = graph.add("Model", "Model::" + my_arm.fbxName, "Limb")
+
+    for my_mesh in ob_meshes:
+        model_ids[my_mesh] = graph.add("Model", "Model::" + my_mesh.fbxName, "Mesh")
+
+    # TODO - limbs can have the same name for multiple armatures, should prefix.
+    for my_bone in ob_bones:
+        model_ids[my_bone] = graph.add("Model", "Model::" + my_bone.fbxName, "Limb")
+
+    for my_cam in ob_cameras:
+        model_ids[my_cam] = graph.add("Model", "Model::" + my_cam.fbxName, "Camera")
+
+    for my_light in ob_lights:
+        model_ids[my_light] = graph.add("Model", "Model::" + my_light.fbxName, "Light")
+
+    # Always in Relations, but only written (by write_camera_switch() and write_camera_default()) and counted
+    # in Definitions when cameras are exported.
+    for name in ("Perspective", "Top", "Bottom", "Front", "Back", "Right", "Left"):
+        graph.add("Model", "Model::Producer " + name, "Camera")
+    graph.add("Model", "Model::Camera Switcher", "CameraSwitcher")
+    model_count = graph.count("Model") - (0 if 'CAMERA' in object_types else 8)
+
+    material_ids = {}
+    for matname, (mat, tex) in materials:
+        material_ids[matname] = graph.add("Material", "Material::" + matname, "")
+
+    texture_ids = {}
+    for texname, tex in textures:
+        texture_ids[texname] = graph.add("Texture", "Texture::" + texname, "TextureVideoClip")
+    video_ids = {}
+    for texname, tex in textures:
+        video_ids[texname] = graph.add("Video", "Video::" + texname, "Clip")
+
+    # deformers - modifiers
+    skin_ids = {}
+    for my_mesh in ob_meshes:
+        if my_mesh.fbxArm:
+            skin_ids[my_mesh.fbxName] = graph.add("Deformer", "Deformer::Skin " + my_mesh.fbxName, "Skin")
+
+    cluster_ids = {}
+    for my_bone in ob_bones:
+        for fbxMeshObName in sorted(my_bone.blenMeshes):  # .keys() - fbxMeshObName
+            # is this bone effecting a mesh?
+            cluster_ids[fbxMeshObName, my_bone] = graph.add("Deformer", "SubDeformer::Cluster %s %s" % (fbxMeshObName, my_bone.fbxName), "Cluster")
+
+    group_ids = {}
+    for groupname, group in groups:
+        group_ids[groupname] = graph.add("GroupSelection", "GroupSelection::" + groupname, "Default")
+
+    # NOTE - The FBX SDK does not care about the order but some importers DO!
+    # for instance, defining the material->mesh connection
+    # before the mesh->parent crashes cinema4d
+
+    for ob_generic in ob_all_typegroups:  # all blender 'Object's we support
+        for my_ob in ob_generic:
+            # for deformed meshes, don't have any parents or they can get twice transformed.
+            if my_ob.fbxParent and (not my_ob.fbxArm):
+                graph.connect(model_ids[my_ob], model_ids[my_ob.fbxParent])
+            else:
+                graph.connect(model_ids[my_ob], graph.SCENE)
+
+    if materials:
+        for my_mesh in ob_meshes:
+            # Connect all materials to all objects, not good form but ok for now.
+            for mat, tex in my_mesh.blenMaterials:
+                mat_name = mat.name if mat else None
+                tex_name = tex.name if tex else None
+
+                graph.connect(material_ids[sane_name_mapping_mat[mat_name, tex_name]], model_ids[my_mesh])
+
+    if textures:
+        for my_mesh in ob_meshes:
+            for tex in my_mesh.blenTextures:
+                if tex:
+                    graph.connect(texture_ids[sane_name_mapping_tex[tex.name]], model_ids[my_mesh])
+
+        for texname, tex in textures:
+            graph.connect(video_ids[texname], texture_ids[texname])
+
+    if 'MESH' in object_types:
+        for my_mesh in ob_meshes:
+            if my_mesh.fbxArm:
+                graph.connect(skin_ids[my_mesh.fbxName], model_ids[my_mesh])
+
+        for my_bone in ob_bones:
+            for fbxMeshObName in sorted(my_bone.blenMeshes):
+                graph.connect(cluster_ids[fbxMeshObName, my_bone], skin_ids[fbxMeshObName])
+
+        # limbs -> deformers
+        for my_bone in ob_bones:
+            for fbxMeshObName in sorted(my_bone.blenMeshes):
+                graph.connect(model_ids[my_bone], cluster_ids[fbxMeshObName, my_bone])
+
+    for my_bone in ob_bones:
+        # Always parent to armature now
+        if my_bone.parent:
+            graph.connect(model_ids[my_bone], model_ids[my_bone.parent])
+        else:
+            # the armature object is written as an empty and all root level bones connect to it
+            graph.connect(model_ids[my_bone], model_ids[my_bone.fbxArm])
+
+    # groups
+    for ob_generic in ob_all_typegroups:
+        for ob_base in ob_generic:
+            for fbxGroupName in ob_base.fbxGroupNames:
+                graph.connect(model_ids[ob_base], group_ids[fbxGroupName])
+
+    # Armatures and bones, the only objects of take files.
+    skeleton_ids = {model_ids[my_ob] for my_ob in ob_arms + ob_bones}
+
+    del model_ids, material_ids, texture_ids, video_ids, skin_ids, cluster_ids, group_ids
 
     # sanity checks
     try:
@@ -2100,6 +3933,7 @@ def save_single(operator, scene, filepath="",
         import traceback
         traceback.print_exc()
 
+    fw_flush()
     fw('''
 
 ; Object definitions
@@ -2108,68 +3942,44 @@ def save_single(operator, scene, filepath="",
 Definitions:  {
 	Version: 100
 	Count: %i''' % (
-        1 + camera_count +
-        len(ob_meshes) +
-        len(ob_lights) +
-        len(ob_cameras) +
-        len(ob_arms) +
-        len(ob_null) +
-        len(ob_bones) +
-        bone_deformer_count +
-        len(materials) +
-        (len(textures) * 2)))  # add 1 for global settings
-
-    del bone_deformer_count
+        1 +
+        model_count +
+        graph.count("Deformer", "Cluster") +
+        graph.count("Material") +
+        graph.count("Texture") +
+        graph.count("Video")))  # add 1 for global settings
 
     fw('''
 	ObjectType: "Model" {
 		Count: %i
-	}''' % (
-        camera_count +
-        len(ob_meshes) +
-        len(ob_lights) +
-        len(ob_cameras) +
-        len(ob_arms) +
-        len(ob_null) +
-        len(ob_bones)))
+	}''' % model_count)
 
     fw('''
 	ObjectType: "Geometry" {
 		Count: %i
-	}''' % len(ob_meshes))
+	}''' % graph.count("Model", "Mesh"))
 
-    if materials:
+    if graph.count("Material"):
         fw('''
 	ObjectType: "Material" {
 		Count: %i
-	}''' % len(materials))
+	}''' % graph.count("Material"))
 
-    if textures:
+    if graph.count("Texture"):
         fw('''
 	ObjectType: "Texture" {
 		Count: %i
-	}''' % len(textures))  # add 1 for an empty tex
+	}''' % graph.count("Texture"))  # add 1 for an empty tex
         fw('''
 	ObjectType: "Video" {
 		Count: %i
-	}''' % len(textures))  # add 1 for an empty tex
-
-    tmp = 0
-    # Add deformer nodes
-    for my_mesh in ob_meshes:
-        if my_mesh.fbxArm:
-            tmp += 1
-
-    # Add subdeformers
-    for my_bone in ob_bones:
-        tmp += len(my_bone.blenMeshes)
+	}''' % graph.count("Video"))  # add 1 for an empty tex
 
-    if tmp:
+    if graph.count("Deformer"):
         fw('''
 	ObjectType: "Deformer" {
 		Count: %i
-	}''' % tmp)
-    del tmp
+	}''' % graph.count("Deformer"))
 
     # Bind pose is essential for XNA if the 'MESH' is included,
     # but could be removed now?
@@ -2178,11 +3988,11 @@ Definitions:  {
 		Count: 1
 	}''')
 
-    if groups:
+    if graph.count("GroupSelection"):
         fw('''
 	ObjectType: "GroupSelection" {
 		Count: %i
-	}''' % len(groups))
+	}''' % graph.count("GroupSelection"))
 
     fw('''
 	ObjectType: "GlobalSettings" {
@@ -2190,6 +4000,7 @@ Definitions:  {
 	}
 }''')
 
+    fw_flush()
     fw('''
 
 ; Object properties
@@ -2206,8 +4017,10 @@ Objects:  {''')
 
     # XNA requires the armature to be a Limb (JCB)
     # Note, 2.58 and previous wrote these as normal empties and it worked mostly (except for XNA)
+    fw_mark = len(fw_pending)
     for my_arm in ob_arms:
         write_null(my_arm, fbxType="Limb", fbxTypeFlags="Skeleton")
+    take_files_text["armatures"] = "".join(fw_pending[fw_mark:])
 
     for my_cam in ob_cameras:
         write_camera(my_cam)
@@ -2217,10 +4030,13 @@ Objects:  {''')
 
     for my_mesh in ob_meshes:
         write_mesh(my_mesh)
+        fw_flush()
 
     #for bonename, bone, obname, me, armob in ob_bones:
+    fw_mark = len(fw_pending)
     for my_bone in ob_bones:
         write_bone(my_bone)
+    take_files_text["bones"] = "".join(fw_pending[fw_mark:])
 
     if 'CAMERA' in object_types:
         write_camera_default()
@@ -2255,7 +4071,7 @@ Objects:  {''')
 
             #for bonename, bone, obname, bone_mesh, armob in ob_bones:
             for my_bone in ob_bones:
-                if me in iter(my_bone.blenMeshes.values()):
+                if my_mesh.fbxName in my_bone.blenMeshes:
                     write_sub_deformer_skin(my_mesh, my_bone, weights)
 
     # Write pose is really weird, only needed when an armature and mesh are used together
@@ -2274,13 +4090,14 @@ Objects:  {''')
     for fbxName, matrix in pose_items:
         fw('\n\t\tPoseNode:  {')
         fw('\n\t\t\tNode: "Model::%s"' % fbxName)
-        fw('\n\t\t\tMatrix: %s' % mat4x4str(matrix if matrix else Matrix()))
+        fw('\n\t\t\tMatrix: %s' % float_str(mat4x4_values(matrix if matrix else Matrix()), 'matrix'))
         fw('\n\t\t}')
 
     fw('\n\t}')
 
     # Finish Writing Objects
     # Write global settings
+    fw_mark = len(fw_pending)
     fw('''
 	GlobalSettings:  {
 		Version: 1000
@@ -2295,8 +4112,10 @@ Objects:  {''')
 		}
 	}
 ''')
+    take_files_text["settings"] = "".join(fw_pending[fw_mark:])
     fw('}')
 
+    fw_flush()
     fw('''
 
 ; Object relations
@@ -2304,75 +4123,11 @@ Objects:  {''')
 
 Relations:  {''')
 
-    # Nulls are likely to cause problems for XNA
-
-    for my_null in ob_null:
-        fw('\n\tModel: "Model::%s", "Null" {\n\t}' % my_null.fbxName)
-
-    # Armature must be a Limb for XNA
-    # Note, 2.58 and previous wrote these as normal empties and it worked mostly (except for XNA)
-    for my_arm in ob_arms:
-        fw('\n\tModel: "Model::%s", "Limb" {\n\t}' % my_arm.fbxName)
-
-    for my_mesh in ob_meshes:
-        fw('\n\tModel: "Model::%s", "Mesh" {\n\t}' % my_mesh.fbxName)
-
-    # TODO - limbs can have the same name for multiple armatures, should prefix.
-    #for bonename, bone, obname, me, armob in ob_bones:
-    for my_bone in ob_bones:
-        fw('\n\tModel: "Model::%s", "Limb" {\n\t}' % my_bone.fbxName)
-
-    for my_cam in ob_cameras:
-        fw('\n\tModel: "Model::%s", "Camera" {\n\t}' % my_cam.fbxName)
-
-    for my_light in ob_lights:
-        fw('\n\tModel: "Model::%s", "Light" {\n\t}' % my_light.fbxName)
-
-    fw('''
-	Model: "Model::Producer Perspective", "Camera" {
-	}
-	Model: "Model::Producer Top", "Camera" {
-	}
-	Model: "Model::Producer Bottom", "Camera" {
-	}
-	Model: "Model::Producer Front", "Camera" {
-	}
-	Model: "Model::Producer Back", "Camera" {
-	}
-	Model: "Model::Producer Right", "Camera" {
-	}
-	Model: "Model::Producer Left", "Camera" {
-	}
-	Model: "Model::Camera Switcher", "CameraSwitcher" {
-	}''')
-
-    for matname, (mat, tex) in materials:
-        fw('\n\tMaterial: "Material::%s", "" {\n\t}' % matname)
-
-    if textures:
-        for texname, tex in textures:
-            fw('\n\tTexture: "Texture::%s", "TextureVideoClip" {\n\t}' % texname)
-        for texname, tex in textures:
-            fw('\n\tVideo: "Video::%s", "Clip" {\n\t}' % texname)
-
-    # deformers - modifiers
-    for my_mesh in ob_meshes:
-        if my_mesh.fbxArm:
-            fw('\n\tDeformer: "Deformer::Skin %s", "Skin" {\n\t}' % my_mesh.fbxName)
-
-    #for bonename, bone, obname, me, armob in ob_bones:
-    for my_bone in ob_bones:
-        for fbxMeshObName in my_bone.blenMeshes:  # .keys() - fbxMeshObName
-            # is this bone effecting a mesh?
-            fw('\n\tDeformer: "SubDeformer::Cluster %s %s", "Cluster" {\n\t}' % (fbxMeshObName, my_bone.fbxName))
-
-    # This should be at the end
-    # fw('\n\tPose: "Pose::BIND_POSES", "BindPose" {\n\t}')
-
-    for groupname, group in groups:
-        fw('\n\tGroupSelection: "GroupSelection::%s", "Default" {\n\t}' % groupname)
+    for kind, name, type in graph.nodes:
+        fw('\n\t%s: "%s", "%s" {\n\t}' % (kind, name, type))
 
     fw('\n}')
+    fw_flush()
     fw('''
 
 ; Object connections
@@ -2380,73 +4135,12 @@ Relations:  {''')
 
 Connections:  {''')
 
-    # NOTE - The FBX SDK does not care about the order but some importers DO!
-    # for instance, defining the material->mesh connection
-    # before the mesh->parent crashes cinema4d
-
-    for ob_generic in ob_all_typegroups:  # all blender 'Object's we support
-        for my_ob in ob_generic:
-            # for deformed meshes, don't have any parents or they can get twice transformed.
-            if my_ob.fbxParent and (not my_ob.fbxArm):
-                fw('\n\tConnect: "OO", "Model::%s", "Model::%s"' % (my_ob.fbxName, my_ob.fbxParent.fbxName))
-            else:
-                fw('\n\tConnect: "OO", "Model::%s", "Model::Scene"' % my_ob.fbxName)
-
-    if materials:
-        for my_mesh in ob_meshes:
-            # Connect all materials to all objects, not good form but ok for now.
-            for mat, tex in my_mesh.blenMaterials:
-                mat_name = mat.name if mat else None
-                tex_name = tex.name if tex else None
-
-                fw('\n\tConnect: "OO", "Material::%s", "Model::%s"' % (sane_name_mapping_mat[mat_name, tex_name], my_mesh.fbxName))
-
-    if textures:
-        for my_mesh in ob_meshes:
-            if my_mesh.blenTextures:
-                # fw('\n\tConnect: "OO", "Texture::_empty_", "Model::%s"' % my_mesh.fbxName)
-                for tex in my_mesh.blenTextures:
-                    if tex:
-                        fw('\n\tConnect: "OO", "Texture::%s", "Model::%s"' % (sane_name_mapping_tex[tex.name], my_mesh.fbxName))
-
-        for texname, tex in textures:
-            fw('\n\tConnect: "OO", "Video::%s", "Texture::%s"' % (texname, texname))
-
-    if 'MESH' in object_types:
-        for my_mesh in ob_meshes:
-            if my_mesh.fbxArm:
-                fw('\n\tConnect: "OO", "Deformer::Skin %s", "Model::%s"' % (my_mesh.fbxName, my_mesh.fbxName))
-
-        for my_bone in ob_bones:
-            for fbxMeshObName in my_bone.blenMeshes:  # .keys()
-                fw('\n\tConnect: "OO", "SubDeformer::Cluster %s %s", "Deformer::Skin %s"' % (fbxMeshObName, my_bone.fbxName, fbxMeshObName))
-
-        # limbs -> deformers
-        for my_bone in ob_bones:
-            for fbxMeshObName in my_bone.blenMeshes:  # .keys()
-                fw('\n\tConnect: "OO", "Model::%s", "SubDeformer::Cluster %s %s"' % (my_bone.fbxName, fbxMeshObName, my_bone.fbxName))
-
-    #for bonename, bone, obname, me, armob in ob_bones:
-    for my_bone in ob_bones:
-        # Always parent to armature now
-        if my_bone.parent:
-            fw('\n\tConnect: "OO", "Model::%s", "Model::%s"' % (my_bone.fbxName, my_bone.parent.fbxName))
-        else:
-            # the armature object is written as an empty and all root level bones connect to it
-            fw('\n\tConnect: "OO", "Model::%s", "Model::%s"' % (my_bone.fbxName, my_bone.fbxArm.fbxName))
-
-    # groups
-    if groups:
-        for ob_generic in ob_all_typegroups:
-            for ob_base in ob_generic:
-                for fbxGroupName in ob_base.fbxGroupNames:
-                    fw('\n\tConnect: "OO", "Model::%s", "GroupSelection::%s"' % (ob_base.fbxName, fbxGroupName))
-
-    # I think the following always duplicates the armature connection because it is also in ob_all_typegroups above! (JCB)
-    # for my_arm in ob_arms:
-    #     fw('\n\tConnect: "OO", "Model::%s", "Model::Scene"' % my_arm.fbxName)
+    node_name = graph.node_name
+    for child, parent in graph.edges:
+        fw('\n\tConnect: "OO", "%s", "%s"' % (node_name(child), node_name(parent)))
 
     fw('\n}')
+    fw_flush()
 
     # Needed for scene footer as well as animation
     render = scene.render
@@ -2473,6 +4167,9 @@ Connections:  {''')
 
         frame_orig = scene.frame_current
 
+        # Cubic keys fitted within anim_fit_error instead of linear ones.
+        use_anim_fit = anim_fit_error > 0.0
+
         if use_anim_optimize:
             # Do we really want to keep such behavior? User could enter real value directly...
             ANIM_OPTIMIZE_PRECISSION_FLOAT = 10 ** (-anim_optimize_precision + 2)
@@ -2532,7 +4229,10 @@ Connections:  {''')
 
 Takes:  {''')
 
-        if blenActionDefault and not use_default_take:
+        if use_anim_take_files and not use_default_take:
+            # All takes go to their own files.
+            fw('\n\tCurrent: ""')
+        elif blenActionDefault and not use_default_take:
             fw('\n\tCurrent: "%s"' % sane_takename(blenActionDefault))
         else:
             fw('\n\tCurrent: "Default Take"')
@@ -2566,7 +4266,11 @@ Takes:  {''')
                     if my_arm.blenObject.animation_data and blenAction in my_arm.blenActionList:
                         my_arm.blenObject.animation_data.action = blenAction
 
+            # (linear keys, cubic keys, linear keys size, cubic keys size) of fitted channels.
+            anim_fit_stats = [0, 0, 0, 0]
+
             # Use the action name as the take name and the take filename (JCB)
+            fw_mark = len(fw_pending)
             fw('\n\tTake: "%s" {' % take_name)
             fw('\n\t\tFileName: "%s.tak"' % take_name.replace(" ", "_"))
             fw('\n\t\tLocalTime: %i,%i' % (fbx_time(act_start - 1), fbx_time(act_end - 1)))  # ??? - not sure why this is needed
@@ -2583,19 +4287,82 @@ Takes:  {''')
             for my_bone in ob_bones:
                 my_bone.flushAnimData()
             '''
-            i = act_start
-            while i <= act_end:
-                scene.frame_set(i)
-                for ob_generic in ob_anim_lists:
+            # Rigs only driven by their actions, with everything else static, need no scene update:
+            # their actions are evaluated directly. Anything else falls back to setting each frame.
+            if all(pose_direct_eval_ok(my_arm.blenObject) for my_arm in ob_arms) and \
+                    all(object_is_static(my_ob.blenObject) for ob_generic in ob_anim_lists[1:] for my_ob in ob_generic
+                        if not (ob_generic == ob_meshes and my_ob.fbxArm)):
+                frames = range(act_start, act_end + 1)
+                for my_arm in ob_arms:
+                    anim_data = my_arm.blenObject.animation_data
+                    pose_mats = action_pose_matrices(my_arm.blenObject, anim_data and anim_data.action, frames)
+                    for my_bone in my_arm.fbxBones:
+                        for frame, matrix in zip(frames, pose_mats[my_bone.blenName]):
+                            my_bone.setPoseFrame(frame, matrix)
+                for ob_generic in ob_anim_lists[1:]:
                     for my_ob in ob_generic:
-                        #Blender.Window.RedrawAll()
-                        if ob_generic == ob_meshes and my_ob.fbxArm:
-                            # We cant animate armature meshes!
-                            my_ob.setPoseFrame(i, fake=True)
-                        else:
-                            my_ob.setPoseFrame(i)
+                        for frame in frames:
+                            if ob_generic == ob_meshes and my_ob.fbxArm:
+                                my_ob.setPoseFrame(frame, fake=True)
+                            else:
+                                my_ob.setPoseFrame(frame)
+            else:
+                i = act_start
+                while i <= act_end:
+                    scene.frame_set(i)
+                    for ob_generic in ob_anim_lists:
+                        for my_ob in ob_generic:
+                            #Blender.Window.RedrawAll()
+                            if ob_generic == ob_meshes and my_ob.fbxArm:
+                                # We cant animate armature meshes!
+                                my_ob.setPoseFrame(i, fake=True)
+                            else:
+                                my_ob.setPoseFrame(i)
+
+                    i += 1
+
+            if use_anim_numpy:
+                # Solve the channels of all objects of the take at once, instead of matrix per matrix.
+                # Bones are relative to their parent bone, other objects to their parent object.
+                anim_obs = [my_ob for ob_generic in ob_anim_lists for my_ob in ob_generic]
+                anim_ob_index = {my_ob: j for j, my_ob in enumerate(anim_obs)}
+                anim_parents = [my_ob.parent if isinstance(my_ob, my_bone_class) else my_ob.fbxParent for my_ob in anim_obs]
+                anim_parents = [anim_ob_index[parent] if parent else -1 for parent in anim_parents]
+                frames = range(act_start, act_end + 1)
+                rel = anim_rel_matrices(numpy.array([my_ob.getAnimMatrixArray(frames) for my_ob in anim_obs]),
+                                        anim_parents)
+
+                # Lamps and cameras need to be rotated, see getAnimParRelMatrixRot().
+                rot = rel[..., :3, :3].copy()
+                if ob_lights:
+                    idx = [anim_ob_index[my_ob] for my_ob in ob_lights]
+                    rot[idx] = numpy.matmul(rot[idx], numpy.array(mtx_x90))
+                if ob_cameras:
+                    idx = [anim_ob_index[my_ob] for my_ob in ob_cameras]
+                    rot[idx] = numpy.matmul(matrix_array_rotation(math.pi / 2.0, rot[idx][..., :, 1]), rot[idx])
+
+                if use_anim_quaternion:
+                    if use_anim_optimize:
+                        anim_rot_kept = quat_keys_reduce_array(matrix_array_to_quats(rot), ANIM_OPTIMIZE_PRECISSION_FLOAT)
+                        anim_rot_kept = [numpy.flatnonzero(keep).tolist() for keep in anim_rot_kept]
+                    else:
+                        anim_rot_kept = [list(range(len(frames)))] * len(anim_obs)
+                    # Eulers are only solved on the kept frames, rows padded with their last one.
+                    rot_frames_count = max(len(kept) for kept in anim_rot_kept)
+                    rot_frames = numpy.array([kept + kept[-1:] * (rot_frames_count - len(kept)) for kept in anim_rot_kept])
+                else:
+                    rot_frames = None
 
-                i += 1
+                anim_chans = numpy.stack(anim_channels_solve(rel, rot, rot_frames), axis=1)  # (objects, TRS, frames, XYZ)
+                del rel, rot
+
+                if use_anim_optimize:
+                    # Reduce the keys of every channel of the take in one go.
+                    anim_keys_kept = anim_keys_reduce_array(anim_chans.transpose(0, 1, 3, 2).reshape(-1, len(frames)),
+                                                            ANIM_OPTIMIZE_PRECISSION_FLOAT)
+                    anim_keys_kept = [[[numpy.flatnonzero(keep).tolist() for keep in keep_axes] for keep_axes in keep_chans]
+                                      for keep_chans in anim_keys_kept.reshape(len(anim_obs), 3, 3, -1)]
+                anim_chans = anim_chans.tolist()
 
             #for bonename, bone, obname, me, armob in ob_bones:
             for ob_generic in (ob_bones, ob_meshes, ob_null, ob_cameras, ob_lights, ob_arms):
@@ -2611,13 +4378,26 @@ Takes:  {''')
                         fw('\n\t\t\tVersion: 1.1')
                         fw('\n\t\t\tChannel: "Transform" {')
 
-                        context_bone_anim_mats = [(my_ob.getAnimParRelMatrix(frame), my_ob.getAnimParRelMatrixRot(frame)) for frame in range(act_start, act_end + 1)]
+                        if not use_anim_numpy:
+                            context_bone_anim_mats = [(my_ob.getAnimParRelMatrix(frame), my_ob.getAnimParRelMatrixRot(frame)) for frame in range(act_start, act_end + 1)]
+
+                        if use_anim_quaternion:
+                            # Frames keyed on all rotation axes, whole rotations being interpolated.
+                            if use_anim_numpy:
+                                context_bone_anim_rot_kept = anim_rot_kept[anim_ob_index[my_ob]]
+                            elif use_anim_optimize:
+                                context_bone_anim_rot_kept = quat_keys_reduce([mtx[1].to_quaternion()[:] for mtx in context_bone_anim_mats],
+                                                                              ANIM_OPTIMIZE_PRECISSION_FLOAT)
+                            else:
+                                context_bone_anim_rot_kept = list(range(len(context_bone_anim_mats)))
 
                         # ----------------
                         # ----------------
                         for TX_LAYER, TX_CHAN in enumerate('TRS'):  # transform, rotate, scale
 
-                            if TX_CHAN == 'T':
+                            if use_anim_numpy:
+                                context_bone_anim_vecs = anim_chans[anim_ob_index[my_ob]][TX_LAYER]
+                            elif TX_CHAN == 'T':
                                 context_bone_anim_vecs = [mtx[0].to_translation() for mtx in context_bone_anim_mats]
                             elif	TX_CHAN == 'S':
                                 context_bone_anim_vecs = [mtx[0].to_scale() for mtx in context_bone_anim_mats]
@@ -2626,70 +4406,93 @@ Takes:  {''')
                                 # elif 	TX_CHAN=='R':	context_bone_anim_vecs = [mtx[1].to_euler()			for mtx in context_bone_anim_mats]
                                 #
                                 # ...but we need to use the previous euler for compatible conversion.
-                                context_bone_anim_vecs = []
                                 prev_eul = None
-                                for mtx in context_bone_anim_mats:
-                                    if prev_eul:
-                                        prev_eul = mtx[1].to_euler('XYZ', prev_eul)
-                                    else:
-                                        prev_eul = mtx[1].to_euler()
-                                    context_bone_anim_vecs.append(tuple_rad_to_deg(prev_eul))
+                                if use_anim_quaternion:
+                                    # Only the kept frames are needed.
+                                    context_bone_anim_vecs = [None] * len(context_bone_anim_mats)
+                                    for j in context_bone_anim_rot_kept:
+                                        if prev_eul:
+                                            prev_eul = context_bone_anim_mats[j][1].to_euler('XYZ', prev_eul)
+                                        else:
+                                            prev_eul = context_bone_anim_mats[j][1].to_euler()
+                                        context_bone_anim_vecs[j] = tuple_rad_to_deg(prev_eul)
+                                else:
+                                    context_bone_anim_vecs = []
+                                    for mtx in context_bone_anim_mats:
+                                        if prev_eul:
+                                            prev_eul = mtx[1].to_euler('XYZ', prev_eul)
+                                        else:
+                                            prev_eul = mtx[1].to_euler()
+                                        context_bone_anim_vecs.append(tuple_rad_to_deg(prev_eul))
+
+                            is_quat_chan = use_anim_quaternion and TX_CHAN == 'R'
 
                             fw('\n\t\t\t\tChannel: "%s" {' % TX_CHAN)  # translation
 
                             for i in range(3):
                                 # Loop on each axis of the bone
                                 fw('\n\t\t\t\t\tChannel: "%s" {' % ('XYZ'[i]))  # translation
-                                fw('\n\t\t\t\t\t\tDefault: %.15f' % context_bone_anim_vecs[0][i])
+                                fw('\n\t\t\t\t\t\tDefault: %s' % float_str((context_bone_anim_vecs[0][i],), 'key'))
                                 fw('\n\t\t\t\t\t\tKeyVer: 4005')
 
-                                if not use_anim_optimize:
-                                    # Just write all frames, simple but in-eficient
-                                    fw('\n\t\t\t\t\t\tKeyCount: %i' % (1 + act_end - act_start))
-                                    fw('\n\t\t\t\t\t\tKey: ')
-                                    frame = act_start
-                                    while frame <= act_end:
-                                        if frame != act_start:
-                                            fw(',')
-
-                                        # Curve types are 'C,n' for constant, 'L' for linear
-                                        # C,n is for bezier? - linear is best for now so we can do simple keyframe removal
-                                        fw('\n\t\t\t\t\t\t\t%i,%.15f,L' % (fbx_time(frame - 1), context_bone_anim_vecs[frame - act_start][i]))
-                                        frame += 1
-                                else:
+                                if is_quat_chan:
+                                    context_bone_anim_keys = [(context_bone_anim_vecs[j][i], j) for j in context_bone_anim_rot_kept]
+                                elif use_anim_optimize:
                                     # remove unneeded keys, j is the frame, needed when some frames are removed.
-                                    context_bone_anim_keys = [(vec[i], j) for j, vec in enumerate(context_bone_anim_vecs)]
-
-                                    # last frame to fisrt frame, missing 1 frame on either side.
-                                    # removeing in a backwards loop is faster
-                                    #for j in xrange( (act_end-act_start)-1, 0, -1 ):
-                                    # j = (act_end-act_start)-1
-                                    j = len(context_bone_anim_keys) - 2
-                                    while j > 0 and len(context_bone_anim_keys) > 2:
-                                        # print j, len(context_bone_anim_keys)
-                                        # Is this key the same as the ones next to it?
+                                    if use_anim_numpy:
+                                        context_bone_anim_kept = anim_keys_kept[anim_ob_index[my_ob]][TX_LAYER][i]
+                                    else:
+                                        context_bone_anim_kept = anim_keys_reduce([vec[i] for vec in context_bone_anim_vecs],
+                                                                                  ANIM_OPTIMIZE_PRECISSION_FLOAT)
+                                    context_bone_anim_keys = [(context_bone_anim_vecs[j][i], j) for j in context_bone_anim_kept]
 
-                                        # co-linear horizontal...
-                                        if		abs(context_bone_anim_keys[j][0] - context_bone_anim_keys[j - 1][0]) < ANIM_OPTIMIZE_PRECISSION_FLOAT and \
-                                                abs(context_bone_anim_keys[j][0] - context_bone_anim_keys[j + 1][0]) < ANIM_OPTIMIZE_PRECISSION_FLOAT:
+                                if use_anim_fit and not is_quat_chan:
+                                    context_bone_anim_fit = anim_keys_fit([vec[i] for vec in context_bone_anim_vecs],
+                                                                          anim_fit_error, use_numpy)
 
-                                            del context_bone_anim_keys[j]
+                                    if len(context_bone_anim_fit) == 2 and context_bone_anim_vecs[0][i] == context_bone_anim_vecs[-1][i] and \
+                                            not any(context_bone_anim_fit[0][1:] + context_bone_anim_fit[1][1:]):
+                                        # No motion, same single key as linear keys.
+                                        fw('\n\t\t\t\t\t\tKeyCount: 1')
+                                        fw('\n\t\t\t\t\t\tKey: ')
+                                        fw('\n\t\t\t\t\t\t\t%i,%s,L' % (fbx_time(act_start - 1), float_str((context_bone_anim_vecs[0][i],), 'key')))
+                                    else:
+                                        # 'U,s' keys are cubic ones with user slopes (per second): this key's right one
+                                        # and next key's left one.
+                                        fit_text = ',\n\t\t\t\t\t\t\t'.join(
+                                                '%i,%s,U,s,%s,n' % (fbx_time(act_start - 1 + j), float_str((context_bone_anim_vecs[j][i],), 'key'),
+                                                                    float_str((slope * fps, slope_next * fps), 'key'))
+                                                for j, slope, slope_next in context_bone_anim_fit)
+                                        fw('\n\t\t\t\t\t\tKeyCount: %i' % len(context_bone_anim_fit))
+                                        fw('\n\t\t\t\t\t\tKey: ')
+                                        fw('\n\t\t\t\t\t\t\t')
+                                        fw(fit_text)
 
+                                        # Compare with the linear keys written without fitting.
+                                        if use_anim_optimize:
+                                            linear_keys = [v for val, frame in context_bone_anim_keys for v in (fbx_time(act_start - 1 + frame), val)]
                                         else:
-                                            frame_range = float(context_bone_anim_keys[j + 1][1] - context_bone_anim_keys[j - 1][1])
-                                            frame_range_fac1 = (context_bone_anim_keys[j + 1][1] - context_bone_anim_keys[j][1]) / frame_range
-                                            frame_range_fac2 = 1.0 - frame_range_fac1
-
-                                            if abs(((context_bone_anim_keys[j - 1][0] * frame_range_fac1 + context_bone_anim_keys[j + 1][0] * frame_range_fac2)) - context_bone_anim_keys[j][0]) < ANIM_OPTIMIZE_PRECISSION_FLOAT:
-                                                del context_bone_anim_keys[j]
-                                            else:
-                                                j -= 1
-
-                                        # keep the index below the list length
-                                        if j > len(context_bone_anim_keys) - 2:
-                                            j = len(context_bone_anim_keys) - 2
-
-                                    if len(context_bone_anim_keys) == 2 and context_bone_anim_keys[0][0] == context_bone_anim_keys[1][0]:
+                                            linear_keys = [v for frame in range(act_start, act_end + 1)
+                                                             for v in (fbx_time(frame - 1), context_bone_anim_vecs[frame - act_start][i])]
+                                        anim_fit_stats[0] += len(linear_keys) // 2
+                                        anim_fit_stats[1] += len(context_bone_anim_fit)
+                                        anim_fit_stats[2] += array_size(linear_keys, 'if', 1, ',\n\t\t\t\t\t\t\t', 'key', ',L')
+                                        anim_fit_stats[3] += len(fit_text)
+
+                                elif not use_anim_optimize and not is_quat_chan:
+                                    # Just write all frames, simple but in-eficient
+                                    fw('\n\t\t\t\t\t\tKeyCount: %i' % (1 + act_end - act_start))
+                                    fw('\n\t\t\t\t\t\tKey: ')
+                                    # Curve types are 'C,n' for constant, 'L' for linear
+                                    # C,n is for bezier? - linear is best for now so we can do simple keyframe removal
+                                    fw('\n\t\t\t\t\t\t\t')
+                                    fw_array([v for frame in range(act_start, act_end + 1)
+                                                for v in (fbx_time(frame - 1), context_bone_anim_vecs[frame - act_start][i])],
+                                             'if', 1, ',\n\t\t\t\t\t\t\t', 'key', ',L')
+                                else:
+                                    # Rotation keys are on all axes or none, an axis can't have its own single key.
+                                    if not is_quat_chan and len(context_bone_anim_keys) == 2 and \
+                                            context_bone_anim_keys[0][0] == context_bone_anim_keys[1][0]:
 
                                         # This axis has no moton, its okay to skip KeyCount and Keys in this case
                                         # pass
@@ -2697,16 +4500,15 @@ Takes:  {''')
                                         # better write one, otherwise we loose poses with no animation
                                         fw('\n\t\t\t\t\t\tKeyCount: 1')
                                         fw('\n\t\t\t\t\t\tKey: ')
-                                        fw('\n\t\t\t\t\t\t\t%i,%.15f,L' % (fbx_time(start), context_bone_anim_keys[0][0]))
+                                        fw('\n\t\t\t\t\t\t\t%i,%s,L' % (fbx_time(act_start - 1), float_str((context_bone_anim_keys[0][0],), 'key')))
                                     else:
                                         # We only need to write these if there is at least one
                                         fw('\n\t\t\t\t\t\tKeyCount: %i' % len(context_bone_anim_keys))
                                         fw('\n\t\t\t\t\t\tKey: ')
-                                        for val, frame in context_bone_anim_keys:
-                                            if frame != context_bone_anim_keys[0][1]:  # not the first
-                                                fw(',')
-                                            # frame is already one less then blenders frame
-                                            fw('\n\t\t\t\t\t\t\t%i,%.15f,L' % (fbx_time(frame), val))
+                                        # frame is the index of the frame in the action
+                                        fw('\n\t\t\t\t\t\t\t')
+                                        fw_array([v for val, frame in context_bone_anim_keys for v in (fbx_time(act_start - 1 + frame), val)],
+                                                 'if', 1, ',\n\t\t\t\t\t\t\t', 'key', ',L')
 
                                 if i == 0:
                                     fw('\n\t\t\t\t\t\tColor: 1,0,0')
@@ -2726,6 +4528,14 @@ Takes:  {''')
 
             # end the take
             fw('\n\t}')
+            if use_anim_fit:
+                print('\ttake: "%s" %i linear keys -> %i cubic keys, %i bytes saved' %
+                      (take_name, anim_fit_stats[0], anim_fit_stats[1], anim_fit_stats[2] - anim_fit_stats[3]))
+            if use_anim_take_files and blenAction is not None:
+                # Moved to its own file, written once the model file is complete.
+                take_files.append((take_name, "".join(fw_pending[fw_mark:])))
+                del fw_pending[fw_mark:]
+            fw_flush()
 
             # end action loop. set original actions
             # do this after every loop in case actions effect eachother.
@@ -2766,6 +4576,8 @@ Takes:  {''')
         has_mist = mist_intense = mist_start = mist_end = 0
         world_hor = 0, 0, 0
 
+    fw_flush()
+    fw_mark = len(fw_pending)
     fw('\n;Version 5 settings')
     fw('\n;------------------------------------------------------------------')
     fw('\n')
@@ -2796,17 +4608,10 @@ Takes:  {''')
     fw('\n\t}')
     fw('\n}')
     fw('\n')
+    take_files_text["footer"] = "".join(fw_pending[fw_mark:])
 
     # XXX, shouldnt be global!
-    for mapping in (sane_name_mapping_ob,
-                    sane_name_mapping_ob_unique,
-                    sane_name_mapping_mat,
-                    sane_name_mapping_tex,
-                    sane_name_mapping_take,
-                    sane_name_mapping_group,
-                    ):
-        mapping.clear()
-    del mapping
+    sane_name_mappings_reset()
 
     del ob_arms[:]
     del ob_bones[:]
@@ -2815,11 +4620,40 @@ Takes:  {''')
     del ob_meshes[:]
     del ob_null[:]
 
+    fw_flush()
     file.close()
+    is_unchanged = False
+    if content_hash is not None:
+        # Sidecar in sha1sum format, the build can skip assets whose hash did not change.
+        hash_line, is_unchanged = hash_sidecar_line(filepath, content_hash)
+        if is_unchanged:
+            # Keep the previous file (and its timestamp) untouched.
+            os.remove(filepath_tmp)
+            print("Content unchanged, kept %r" % filepath)
+        else:
+            os.replace(filepath_tmp, filepath)
+            write_file(filepath + ".sha1", hash_line.encode("utf8"))
+    elif use_atomic_write:
+        os.replace(filepath_tmp, filepath)
+
+    # Same content gives the same index, only rewritten when the file was.
+    if use_section_index and not (is_unchanged and os.path.exists(filepath + ".idx")):
+        # One "kind name offset size" line per block, tab separated, so tools can seek straight to it.
+        write_file(filepath + ".idx", "".join("%s\t%s\t%d\t%d\n" % entry for entry in index_entries).encode("utf8"),
+                   use_atomic_write)
+
+    if take_files:
+        write_take_files(graph, skeleton_ids, take_files_text, take_files)
 
     # copy all collected files.
     bpy_extras.io_utils.path_reference_copy(copy_set)
 
+    if use_float_report:
+        print('float sizes (written / with default precision / saved bytes):')
+        for category, (size, size_default) in sorted(float_stats.items()):
+            if size_default:
+                print('\t%s: %i / %i / %i' % (category, size, size_default, size_default - size))
+
     print('export finished in %.4f sec.' % (time.process_time() - start_time))
     return {'FINISHED'}
 
@@ -2839,6 +4673,21 @@ def defaults_unity3d():
                 )
 
 
+def save_single_atomic(operator, scene, filepath, **kwargs):
+    """
+    save_single(), removing the temporary file it was writing (see use_atomic_write) if it fails half way.
+    """
+    tmp_files = []
+    try:
+        return save_single(operator, scene, filepath, tmp_files=tmp_files, **kwargs)
+    except:
+        for file, filepath_tmp in tmp_files:
+            file.close()
+            if os.path.exists(filepath_tmp):
+                os.remove(filepath_tmp)
+        raise
+
+
 def save(operator, context,
          filepath="",
          use_selection=False,
@@ -2857,7 +4706,7 @@ def save(operator, context,
         else:
             kwargs_mod["context_objects"] = context.scene.objects
 
-        return save_single(operator, context.scene, filepath, **kwargs_mod)
+        return save_single_atomic(operator, context.scene, filepath, **kwargs_mod)
     else:
         fbxpath = filepath
 
@@ -2917,7 +4766,7 @@ def save(operator, context,
 
             kwargs_batch["context_objects"] = data.objects
 
-            save_single(operator, scene, filepath, **kwargs_batch)
+            save_single_atomic(operator, scene, filepath, **kwargs_batch)
 
             if batch_mode == 'GROUP':
                 # remove temp group scene
@@ -0,0 +1,542 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Lemma native model container (.lmdl) writer.
+
+Unlike FBX, the container holds data ready for the GPU and the skinning runtime, so that the game can load it
+without any content processing: interleaved vertex buffers, 16 or 32 bits index buffers, the skeleton with its
+inverse bind matrices, and animation clips sampled once per frame.
+
+All values are little-endian. The file starts with a header and a section table:
+
+    char magic[4] = "LMDL"; uint32 version; uint32 flags; uint32 section_count;
+    section_count * { char tag[4]; uint32 offset; uint32 size; uint32 count; }
+
+Every section starts at a 16 bytes aligned file offset, so buffers can be used in place from a memory-mapped file.
+Sections are arrays of count fixed size records:
+
+    STRS  utf-8 NUL terminated strings, referenced by their offset in the section (count is 0)
+    MESH  { uint32 name; uint32 vertex_count; uint32 vertex_stride; uint32 vertex_offset (in VBUF);
+            uint32 index_count; uint32 index_size (2 or 4); uint32 index_offset (in IBUF);
+            uint32 attr_start; uint32 attr_count; uint32 part_start; uint32 part_count;
+            float bounds_min[3]; float bounds_max[3]; }
+    ATTR  { uint8 semantic; uint8 format; uint8 components; uint8 offset (in vertex); }
+    PART  { uint32 material (string); uint32 index_start; uint32 index_count; }
+    VBUF  interleaved vertices, each mesh's ones 16 bytes aligned
+    IBUF  indices, each mesh's ones 16 bytes aligned
+    BONE  { uint32 name; int32 parent; float bind_pose[16]; float inverse_bind_pose[16]; }
+    CLIP  { uint32 name; uint32 frame_count; float frame_rate; uint32 key_offset (in KEYS); }
+    KEYS  frame_count * bone_count * { float translation[3]; float rotation[4] (x, y, z, w); float scale[3]; }
+
+Matrices use the row vector convention of XNA's Matrix (translation in the last row), bind poses being relative
+to the parent bone (or to the model for root bones), and keys are parent relative bone transforms. Bones are sorted
+parents first, and blend indices refer to them (as bytes in quantized files, unless there are more than 256 bones,
+the ATTR format telling which). Texture coordinates have their origin at the top left corner.
+"""
+
+import os
+from struct import pack
+
+import bpy
+from mathutils import Matrix
+
+from .export_fbx import (foreach_get_array,
+                         dedup_items,
+                         weld_vertices,
+                         cache_optimize_polygons,
+                         fetch_optimize_vertices,
+                         mesh_triangulate,
+                         mat4x4_values,
+                         action_bone_names,
+                         )
+
+# Required, all buffers are built as numpy arrays.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+LMDL_MAGIC = b'LMDL'
+LMDL_VERSION = 1
+LMDL_ALIGN = 16
+
+# Header flags.
+FLAG_QUANTIZED = 1 << 0
+FLAG_SKINNED = 1 << 1
+
+# Vertex attribute semantics.
+ATTR_POSITION = 0
+ATTR_NORMAL = 1
+ATTR_TANGENT = 2
+ATTR_TEXCOORD = 3
+ATTR_BLENDINDICES = 4
+ATTR_BLENDWEIGHT = 5
+
+# Vertex attribute formats, FORMAT_SNORM_10_10_10_2 packing its 4 components in a single uint32.
+FORMAT_FLOAT32 = 0
+FORMAT_FLOAT16 = 1
+FORMAT_UINT8 = 2
+FORMAT_UNORM8 = 3
+FORMAT_UINT16 = 4
+FORMAT_SNORM_10_10_10_2 = 5
+
+FORMAT_DTYPES = {FORMAT_FLOAT32: '<f4',
+                 FORMAT_FLOAT16: '<f2',
+                 FORMAT_UINT8: 'u1',
+                 FORMAT_UNORM8: 'u1',
+                 FORMAT_UINT16: '<u2',
+                 }
+
+MAX_INFLUENCES = 4
+
+
+def align(offset):
+    return (offset + LMDL_ALIGN - 1) & ~(LMDL_ALIGN - 1)
+
+
+def pack_snorm_10_10_10_2(xyz, w):
+    """
+    Return the uint32 packing of (n, 3) components in [-1, 1] and (n,) w values (-1 or 1).
+    """
+    q = numpy.clip(numpy.round(xyz * 511.0), -511, 511).astype(numpy.int64) & 0x3ff
+    qw = numpy.where(w < 0, 3, 1).astype(numpy.int64)
+    return (q[:, 0] | (q[:, 1] << 10) | (q[:, 2] << 20) | (qw << 30)).astype('<u4')
+
+
+def quantize_weights(weights):
+    """
+    Return (n, 4) normalized float weights as unorm8 values, whose sum per vertex is exactly 255.
+    """
+    q = numpy.round(weights * 255.0).astype(numpy.int64)
+    used = weights.sum(axis=1) > 0.0
+    # Give the rounding error to the biggest weight.
+    q[numpy.arange(len(q)), numpy.argmax(weights, axis=1)] += numpy.where(used, 255 - q.sum(axis=1), 0)
+    return q.astype(numpy.uint8)
+
+
+def matrix_array(mat):
+    return numpy.array([tuple(row) for row in mat], dtype=numpy.float64)
+
+
+def vertex_influences(ob, me, bone_map):
+    """
+    Return the (bone indices, weights) (nbr_verts, MAX_INFLUENCES) arrays of the mesh vertices, keeping the biggest
+    influences of bones in bone_map, normalized. Vertices of meshes parented to a bone fully follow that bone.
+    """
+    nbr_verts = len(me.vertices)
+    indices = numpy.zeros((nbr_verts, MAX_INFLUENCES), dtype=numpy.int64)
+    weights = numpy.zeros((nbr_verts, MAX_INFLUENCES), dtype=numpy.float64)
+
+    if ob.parent and ob.parent_type == 'BONE' and ob.parent_bone in bone_map:
+        indices[:, 0] = bone_map[ob.parent_bone]
+        weights[:, 0] = 1.0
+        return indices, weights
+
+    group_bones = [bone_map.get(group.name, -1) for group in ob.vertex_groups]
+    if not group_bones:
+        return indices, weights
+    for v in me.vertices:
+        infl = sorted(((g.weight, group_bones[g.group]) for g in v.groups
+                       if g.group < len(group_bones) and group_bones[g.group] >= 0 and g.weight > 0.0),
+                      reverse=True)[:MAX_INFLUENCES]
+        tot = sum(w for w, b in infl)
+        for i, (w, b) in enumerate(infl):
+            indices[v.index, i] = b
+            weights[v.index, i] = w / tot
+    return indices, weights
+
+
+def mesh_buffers(ob, me, matrix, bone_map, use_tangents, use_quantize):
+    """
+    Return the (vertices, attributes, indices, parts, bounds) of a triangulated mesh, vertices being a structured
+    array of the interleaved vertex layout described by attributes ((semantic, format, components, offset) tuples),
+    indices the triangle list (uint16 when possible), and parts (material name, index start, index count) tuples.
+
+    Vertices are transformed by matrix, triangles are grouped by material and sorted for post-transform vertex cache
+    locality, and vertices are sorted by first use.
+    """
+    nbr_loops = len(me.loops)
+    nbr_verts = len(me.vertices)
+    t_vi = foreach_get_array(me.loops, "vertex_index", nbr_loops, "int32", True)
+    uv_layer = me.uv_layers.active
+
+    # Per loop attributes, deduplicated so that vertices can be welded.
+    layers = []
+    if use_tangents and uv_layer:
+        me.calc_tangents(uv_layer.name)
+        t_vn = foreach_get_array(me.loops, "normal", nbr_loops * 3, "float32", True)
+        t_tn = foreach_get_array(me.loops, "tangent", nbr_loops * 3, "float32", True)
+        t_bs = foreach_get_array(me.loops, "bitangent_sign", nbr_loops, "float32", True)
+        me.free_tangents()
+    else:
+        me.calc_normals_split()
+        t_vn = foreach_get_array(me.loops, "normal", nbr_loops * 3, "float32", True)
+        me.free_normals_split()
+        t_tn = None
+    layers.append((ATTR_NORMAL,) + dedup_items(t_vn, 3, True))
+    if t_tn is not None:
+        t_tn = numpy.concatenate((t_tn.reshape(-1, 3), t_bs.reshape(-1, 1)), axis=1)
+        layers.append((ATTR_TANGENT,) + dedup_items(t_tn, 4, True))
+    if uv_layer:
+        t_uv = foreach_get_array(uv_layer.data, "uv", nbr_loops * 2, "float32", True)
+        layers.append((ATTR_TEXCOORD,) + dedup_items(t_uv, 2, True))
+
+    vert_map, t_vi, cp_ids = weld_vertices(nbr_verts, t_vi, [ids for attr, items, ids in layers], True)
+    if vert_map is None:
+        vert_map = numpy.arange(nbr_verts)
+    nbr_welded = len(vert_map)
+
+    # Triangles in cache friendly order, then grouped by material (stable, so that each group keeps that order).
+    t_ls = numpy.arange(0, nbr_loops, 3)
+    tri_order = numpy.asarray(cache_optimize_polygons(t_vi, t_ls, nbr_welded), dtype=numpy.int64)
+    t_mi = foreach_get_array(me.polygons, "material_index", len(me.polygons), "int32", True)[tri_order]
+    mat_order = numpy.argsort(t_mi, kind='mergesort')
+    tri_order = tri_order[mat_order]
+    t_mi = t_mi[mat_order]
+    t_vi = numpy.asarray(t_vi).reshape(-1, 3)[tri_order].reshape(-1)
+
+    # Only keep used vertices, in order of first use.
+    vert_order, vert_remap = fetch_optimize_vertices(t_vi, nbr_welded, True)
+    vert_order = vert_order[:len(numpy.unique(t_vi))]
+    t_vi = vert_remap[t_vi]
+    src_verts = vert_map[vert_order]
+    nbr_out = len(vert_order)
+
+    mat = matrix_array(matrix)
+    mat3 = mat[:3, :3]
+    nor_mat = numpy.linalg.inv(mat3).T
+    flip = -1.0 if numpy.linalg.det(mat3) < 0.0 else 1.0
+
+    def normalized(v):
+        length = numpy.sqrt((v * v).sum(axis=1)).reshape(-1, 1)
+        return v / numpy.where(length > 0.0, length, 1.0)
+
+    co = foreach_get_array(me.vertices, "co", nbr_verts * 3, "float32", True).reshape(-1, 3)
+    co = co[src_verts].astype(numpy.float64).dot(mat3.T) + mat[:3, 3]
+    if nbr_out:
+        bounds = (co.min(axis=0).tolist(), co.max(axis=0).tolist())
+    else:
+        bounds = ([0.0] * 3, [0.0] * 3)
+
+    # (semantic, format, components, values) of each attribute, in vertex layout order.
+    fields = [(ATTR_POSITION, FORMAT_FLOAT32, 3, co)]
+    for (attr, items, ids), cp in zip(layers, cp_ids):
+        items = numpy.asarray(items, dtype=numpy.float64)
+        if attr == ATTR_NORMAL:
+            nor = normalized(items.reshape(-1, 3)[cp[vert_order]].dot(nor_mat.T))
+            if use_quantize:
+                fields.append((attr, FORMAT_SNORM_10_10_10_2, 4, pack_snorm_10_10_10_2(nor, numpy.ones(nbr_out))))
+            else:
+                fields.append((attr, FORMAT_FLOAT32, 3, nor))
+        elif attr == ATTR_TANGENT:
+            tan = items.reshape(-1, 4)[cp[vert_order]]
+            xyz = normalized(tan[:, :3].dot(mat3.T))
+            sign = tan[:, 3] * flip
+            if use_quantize:
+                fields.append((attr, FORMAT_SNORM_10_10_10_2, 4, pack_snorm_10_10_10_2(xyz, sign)))
+            else:
+                fields.append((attr, FORMAT_FLOAT32, 4, numpy.concatenate((xyz, sign.reshape(-1, 1)), axis=1)))
+        elif attr == ATTR_TEXCOORD:
+            uv = items.reshape(-1, 2)[cp[vert_order]]
+            uv[:, 1] = 1.0 - uv[:, 1]
+            fields.append((attr, FORMAT_FLOAT16 if use_quantize else FORMAT_FLOAT32, 2, uv))
+    if bone_map:
+        b_idx, b_w = vertex_influences(ob, me, bone_map)
+        b_idx = b_idx[src_verts]
+        b_w = b_w[src_verts]
+        if use_quantize:
+            # Byte indices only address 256 bones.
+            fields.append((ATTR_BLENDINDICES, FORMAT_UINT8 if len(bone_map) <= 0x100 else FORMAT_UINT16,
+                           MAX_INFLUENCES, b_idx))
+            fields.append((ATTR_BLENDWEIGHT, FORMAT_UNORM8, MAX_INFLUENCES, quantize_weights(b_w)))
+        else:
+            fields.append((ATTR_BLENDINDICES, FORMAT_UINT16, MAX_INFLUENCES, b_idx))
+            fields.append((ATTR_BLENDWEIGHT, FORMAT_FLOAT32, MAX_INFLUENCES, b_w))
+
+    # Interleave, every attribute being 4 bytes aligned.
+    attributes = []
+    names = []
+    formats = []
+    offsets = []
+    stride = 0
+    for i, (attr, fmt, components, values) in enumerate(fields):
+        if fmt == FORMAT_SNORM_10_10_10_2:
+            formats.append(numpy.dtype('<u4'))
+            size = 4
+        else:
+            formats.append((numpy.dtype(FORMAT_DTYPES[fmt]), (components,)))
+            size = numpy.dtype(FORMAT_DTYPES[fmt]).itemsize * components
+        names.append("a%d" % i)
+        offsets.append(stride)
+        attributes.append((attr, fmt, components, stride))
+        stride += (size + 3) & ~3
+    vertices = numpy.zeros(nbr_out, dtype=numpy.dtype({"names": names, "formats": formats,
+                                                       "offsets": offsets, "itemsize": stride}))
+    for name, (attr, fmt, components, values) in zip(names, fields):
+        vertices[name] = values
+
+    indices = t_vi.astype('<u2' if nbr_out <= 0x10000 else '<u4')
+
+    parts = []
+    mats = me.materials
+    if len(t_mi):
+        starts = numpy.flatnonzero(numpy.diff(t_mi)) + 1
+        starts = [0] + starts.tolist()
+        ends = starts[1:] + [len(t_mi)]
+        for start, end in zip(starts, ends):
+            mi = int(t_mi[start])
+            material = mats[mi] if mi < len(mats) else None
+            parts.append((material.name if material else "", start * 3, (end - start) * 3))
+
+    return vertices, attributes, indices, parts, bounds
+
+
+def armature_bones(arm_ob):
+    """
+    Return the bones of an armature object, parents first.
+    """
+    bones = []
+
+    def add_bone(bone):
+        bones.append(bone)
+        for child in bone.children:
+            add_bone(child)
+    for bone in arm_ob.data.bones:
+        if bone.parent is None:
+            add_bone(bone)
+    return bones
+
+
+def skeleton_records(arm_ob, bones, global_matrix):
+    """
+    Return the (name, parent index, bind pose, inverse bind pose) of each bone, matrices being flat XNA-like lists.
+    """
+    arm_mat = global_matrix * arm_ob.matrix_world
+    bone_index = {bone.name: i for i, bone in enumerate(bones)}
+    records = []
+    for bone in bones:
+        mat = arm_mat * bone.matrix_local
+        if bone.parent:
+            local = bone.parent.matrix_local.inverted() * bone.matrix_local
+            parent = bone_index[bone.parent.name]
+        else:
+            local = mat
+            parent = -1
+        records.append((bone.name, parent, mat4x4_values(local), mat4x4_values(mat.inverted())))
+    return records
+
+
+def animation_clips(scene, arm_ob, bones, global_matrix, use_all_actions):
+    """
+    Return the (name, frame rate, keys) of each clip, keys being a (frame_count, bone_count, 10) float32 array.
+
+    Clips are made of the actions of the armature (only its current one unless use_all_actions is set), sampled at
+    every frame of their range.
+    """
+    anim_data = arm_ob.animation_data
+    if not anim_data or not bones:
+        return []
+
+    bone_names = {bone.name for bone in bones}
+    if use_all_actions:
+        actions = [action for action in bpy.data.actions if action_bone_names(arm_ob, action) & bone_names]
+    else:
+        actions = [anim_data.action] if anim_data.action else []
+
+    fps = scene.render.fps / scene.render.fps_base
+    arm_mat = global_matrix * arm_ob.matrix_world
+    pose_bones = [arm_ob.pose.bones[bone.name] for bone in bones]
+    action_orig = anim_data.action
+    frame_orig = scene.frame_current
+    clips = []
+    try:
+        for action in actions:
+            anim_data.action = action
+            start, end = (int(f) for f in action.frame_range)
+            keys = numpy.empty((end - start + 1, len(bones), 10), dtype=numpy.float64)
+            for i, frame in enumerate(range(start, end + 1)):
+                scene.frame_set(frame)
+                for j, pose_bone in enumerate(pose_bones):
+                    if pose_bone.parent:
+                        mat = pose_bone.parent.matrix.inverted() * pose_bone.matrix
+                    else:
+                        mat = arm_mat * pose_bone.matrix
+                    loc, rot, scale = mat.decompose()
+                    keys[i, j] = loc[:] + (rot.x, rot.y, rot.z, rot.w) + scale[:]
+            # Keep successive rotations in the same hemisphere, so that they interpolate along the shortest path.
+            rot = keys[:, :, 3:7]
+            flips = (rot[1:] * rot[:-1]).sum(axis=2) < 0.0
+            signs = numpy.ones(rot.shape[:2])
+            signs[1:] = numpy.where(numpy.cumsum(flips, axis=0) % 2, -1.0, 1.0)
+            rot *= signs[:, :, None]
+            clips.append((action.name, fps, keys.astype('<f4')))
+    finally:
+        # Leave the scene on the frame and action it was on, even if sampling failed.
+        anim_data.action = action_orig
+        scene.frame_set(frame_orig)
+    return clips
+
+
+def write_container(filepath, meshes, bones, clips, flags):
+    """
+    Write the container file from mesh_buffers() results (with their names first), skeleton_records() and
+    animation_clips() ones.
+    """
+    strings = bytearray()
+    string_offsets = {}
+
+    def string(s):
+        offset = string_offsets.get(s)
+        if offset is None:
+            offset = string_offsets[s] = len(strings)
+            strings.extend(s.encode("utf8") + b'\x00')
+        return offset
+
+    mesh_data = []
+    attr_data = []
+    part_data = []
+    vbuf = bytearray()
+    ibuf = bytearray()
+    for name, vertices, attributes, indices, parts, bounds in meshes:
+        vbuf.extend(b'\x00' * (align(len(vbuf)) - len(vbuf)))
+        ibuf.extend(b'\x00' * (align(len(ibuf)) - len(ibuf)))
+        mesh_data.append(pack('<11I6f', string(name), len(vertices), vertices.dtype.itemsize, len(vbuf),
+                              len(indices), indices.dtype.itemsize, len(ibuf),
+                              len(attr_data), len(attributes), len(part_data), len(parts),
+                              *(bounds[0] + bounds[1])))
+        attr_data.extend(pack('<4B', *attr) for attr in attributes)
+        part_data.extend(pack('<3I', string(material), start, count) for material, start, count in parts)
+        vbuf.extend(vertices.tobytes())
+        ibuf.extend(indices.tobytes())
+
+    bone_data = [pack('<Ii32f', string(name), parent, *(bind + inv_bind)) for name, parent, bind, inv_bind in bones]
+
+    clip_data = []
+    keys = bytearray()
+    for name, fps, clip_keys in clips:
+        clip_data.append(pack('<2IfI', string(name), len(clip_keys), fps, len(keys)))
+        keys.extend(clip_keys.tobytes())
+
+    # (tag, data, count) of each section, strings last since all others add to them.
+    sections = [(b'MESH', b''.join(mesh_data), len(mesh_data)),
+                (b'ATTR', b''.join(attr_data), len(attr_data)),
+                (b'PART', b''.join(part_data), len(part_data)),
+                (b'VBUF', bytes(vbuf), 0),
+                (b'IBUF', bytes(ibuf), 0),
+                (b'BONE', b''.join(bone_data), len(bone_data)),
+                (b'CLIP', b''.join(clip_data), len(clip_data)),
+                (b'KEYS', bytes(keys), 0),
+                ]
+    sections.insert(0, (b'STRS', bytes(strings), 0))
+
+    offset = align(16 + 16 * len(sections))
+    table = []
+    for tag, data, count in sections:
+        table.append(pack('<4s3I', tag, offset, len(data), count))
+        offset = align(offset + len(data))
+
+    filepath_tmp = filepath + ".tmp"
+    with open(filepath_tmp, "wb") as file:
+        fw = file.write
+        fw(pack('<4s3I', LMDL_MAGIC, LMDL_VERSION, flags, len(sections)))
+        fw(b''.join(table))
+        pos = 16 + 16 * len(sections)
+        for tag, data, count in sections:
+            fw(b'\x00' * (align(pos) - pos))
+            fw(data)
+            pos = align(pos) + len(data)
+    os.replace(filepath_tmp, filepath)
+
+
+def save(operator, context, filepath="",
+         global_matrix=None,
+         use_selection=False,
+         use_mesh_modifiers=True,
+         use_tangents=True,
+         use_quantize=False,
+         use_anim=True,
+         use_anim_action_all=True,
+         ):
+
+    if numpy is None:
+        operator.report({'ERROR'}, "Lemma model export needs NumPy")
+        return {'CANCELLED'}
+
+    if global_matrix is None:
+        global_matrix = Matrix()
+
+    scene = context.scene
+    if bpy.ops.object.mode_set.poll():
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+    if use_selection:
+        objects = [ob for ob in context.selected_objects if ob.type in {'MESH', 'ARMATURE'}]
+    else:
+        objects = [ob for ob in scene.objects if ob.type in {'MESH', 'ARMATURE'}]
+    objects.sort(key=lambda ob: ob.name)
+
+    # A single skeleton per model: the first armature found, or the one deforming the first skinned mesh.
+    arm_ob = None
+    for ob in objects:
+        if ob.type == 'MESH' and ob.find_armature():
+            arm_ob = ob.find_armature()
+            break
+    if arm_ob is None:
+        arm_ob = next((ob for ob in objects if ob.type == 'ARMATURE'), None)
+
+    bones = armature_bones(arm_ob) if arm_ob else []
+    bone_map = {bone.name: i for i, bone in enumerate(bones)}
+
+    # Meshes are exported in their bind pose.
+    arms_orig_rest = [(arm, arm.pose_position) for arm in bpy.data.armatures]
+    for arm, pose_position in arms_orig_rest:
+        arm.pose_position = 'REST'
+    scene.frame_set(scene.frame_current)
+
+    meshes = []
+    for ob in objects:
+        if ob.type != 'MESH':
+            continue
+        me = ob.to_mesh(scene, use_mesh_modifiers, 'PREVIEW')
+        try:
+            if not me.polygons:
+                continue
+            mesh_triangulate(me)
+            # Deformed through an Armature modifier (or parenting), like export_fbx finds it.
+            skinned = arm_ob is not None and ob.find_armature() == arm_ob
+            meshes.append((ob.name,) + mesh_buffers(ob, me, global_matrix * ob.matrix_world,
+                                                    bone_map if skinned else None, use_tangents, use_quantize))
+        finally:
+            bpy.data.meshes.remove(me)
+
+    for arm, pose_position in arms_orig_rest:
+        arm.pose_position = pose_position
+    scene.frame_set(scene.frame_current)
+
+    records = skeleton_records(arm_ob, bones, global_matrix) if arm_ob else []
+    clips = animation_clips(scene, arm_ob, bones, global_matrix, use_anim_action_all) if use_anim and arm_ob else []
+
+    flags = (FLAG_QUANTIZED if use_quantize else 0) | (FLAG_SKINNED if bones else 0)
+    write_container(filepath, meshes, records, clips, flags)
+
+    print("Lemma model export: %d meshes, %d bones, %d clips" % (len(meshes), len(records), len(clips)))
+    return {'FINISHED'}
@@ -0,0 +1,79 @@
+"""
+Checks the key reduction of export_fbx against the list based loop it replaced.
+
+Needs Blender's python (export_fbx imports bpy), e.g. from the directory containing PipelineExtensions:
+    blender -b --python-expr "import unittest; unittest.main(module='PipelineExtensions.tests.test_anim_keys', exit=False)"
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+try:
+    from PipelineExtensions import export_fbx
+except ImportError:
+    export_fbx = None
+
+TOLERANCE = 0.0625
+
+
+def anim_keys_reduce_list(values, tolerance):
+    # The loop anim_keys_reduce() replaced, deleting keys from a list of (value, frame).
+    keys = [(val, j) for j, val in enumerate(values)]
+    j = len(keys) - 2
+    while j > 0 and len(keys) > 2:
+        if abs(keys[j][0] - keys[j - 1][0]) < tolerance and abs(keys[j][0] - keys[j + 1][0]) < tolerance:
+            del keys[j]
+        else:
+            frame_range = float(keys[j + 1][1] - keys[j - 1][1])
+            frame_range_fac1 = (keys[j + 1][1] - keys[j][1]) / frame_range
+            frame_range_fac2 = 1.0 - frame_range_fac1
+            if abs(((keys[j - 1][0] * frame_range_fac1 + keys[j + 1][0] * frame_range_fac2)) - keys[j][0]) < tolerance:
+                del keys[j]
+            else:
+                j -= 1
+        if j > len(keys) - 2:
+            j = len(keys) - 2
+    return [j for val, j in keys]
+
+
+def sample_channels():
+    rnd = random.Random(0)
+    chans = [[-0.028, 0.34, 0.048, -0.039, -0.025, -0.154, 0.047],
+             [0.0] * 10,
+             [j * 0.5 for j in range(10)],
+             [1.0, 2.0],
+             [1.0, 2.0, 3.0]]
+    for nbr_keys in (3, 4, 5, 8, 20, 50):
+        for i in range(40):
+            chans.append([rnd.uniform(-0.2, 0.2) for j in range(nbr_keys)])
+            # Steps and slopes, with a bit of noise.
+            chans.append([(j // 3) * rnd.choice((0.0, 0.1)) + j * rnd.choice((0.0, 0.05)) + rnd.uniform(-0.03, 0.03)
+                          for j in range(nbr_keys)])
+    return chans
+
+
+@unittest.skipIf(export_fbx is None, "needs Blender's python")
+class AnimKeysReduceTest(unittest.TestCase):
+
+    def test_reduce(self):
+        self.assertEqual(export_fbx.anim_keys_reduce([-0.028, 0.34, 0.048, -0.039, -0.025, -0.154, 0.047], 0.1),
+                         [0, 1, 2, 5, 6])
+        for values in sample_channels():
+            self.assertEqual(export_fbx.anim_keys_reduce(values, TOLERANCE), anim_keys_reduce_list(values, TOLERANCE))
+
+    @unittest.skipIf(export_fbx is None or export_fbx.numpy is None, "needs numpy")
+    def test_reduce_array(self):
+        numpy = export_fbx.numpy
+        for nbr_keys in (2, 3, 7, 20, 50):
+            chans = [values for values in sample_channels() if len(values) == nbr_keys]
+            keep = export_fbx.anim_keys_reduce_array(numpy.array(chans), TOLERANCE)
+            for values, keep_chan in zip(chans, keep):
+                self.assertEqual(numpy.flatnonzero(keep_chan).tolist(), anim_keys_reduce_list(values, TOLERANCE))
+
+
+if __name__ == '__main__':
+    unittest.main()
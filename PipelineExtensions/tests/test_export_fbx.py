@@ -0,0 +1,151 @@
+"""
+Exports small scenes with export_fbx and checks what got written.
+
+Needs Blender's python, e.g. from the directory containing PipelineExtensions:
+    blender -b --factory-startup --python-expr "import unittest; unittest.main(module='PipelineExtensions.tests.test_export_fbx', exit=False)"
+"""
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+try:
+    import bpy
+    from PipelineExtensions import export_fbx
+except ImportError:
+    bpy = export_fbx = None
+
+
+class Operator(object):
+    # Stands for the export operator, keeping what is reported.
+
+    def __init__(self):
+        self.reports = []
+
+    def report(self, type, message):
+        self.reports.append((type, message))
+
+
+@unittest.skipIf(export_fbx is None, "needs Blender's python")
+class ExportFbxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        scene = bpy.context.scene
+        for ob in list(scene.objects):
+            scene.objects.unlink(ob)
+        self.objects = []
+
+    def tearDown(self):
+        for ob in self.objects:
+            bpy.data.objects.remove(ob)
+        shutil.rmtree(self.tmpdir)
+
+    def add_mesh(self, name, verts, edges, faces):
+        me = bpy.data.meshes.new(name)
+        me.from_pydata(verts, edges, faces)
+        me.update(calc_edges=True)
+        ob = bpy.data.objects.new(name, me)
+        bpy.context.scene.objects.link(ob)
+        bpy.context.scene.update()
+        self.objects.append(ob)
+        return ob
+
+    def export(self, **kwargs):
+        filepath = os.path.join(self.tmpdir, "test.fbx")
+        kwargs.setdefault("object_types", {'MESH'})
+        kwargs.setdefault("use_anim", False)
+        ret = export_fbx.save(Operator(), bpy.context, filepath=filepath, **kwargs)
+        self.assertEqual(ret, {'FINISHED'})
+        with open(filepath, "rb") as f:
+            return f.read()
+
+    def add_loose_edge_mesh(self):
+        # A quad, and a loose edge between two more vertices.
+        return self.add_mesh("LooseEdges", [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0), (2, 0, 0), (2, 1, 0)],
+                             [(4, 5)], [(0, 1, 2, 3)])
+
+    def test_loose_edges(self):
+        self.add_loose_edge_mesh()
+        for use_numpy in (False, True):
+            text = self.export(use_mesh_edges=True, use_numpy=use_numpy).decode("utf8")
+            indices = text.split("PolygonVertexIndex: ", 1)[1].split("\n\t\tEdges: ", 1)[0]
+            # The quad, then the loose edge as a 2 vertices face.
+            self.assertEqual([int(i) for i in indices.replace("\n", "").split(",")], [0, 1, 2, -4, 4, -6])
+
+    def add_anim_rig(self):
+        # Parented bones, and a lamp under a camera under an empty, all keyed over frames 1 to 9.
+        scene = bpy.context.scene
+        scene.frame_start, scene.frame_end = 1, 9
+
+        arm = bpy.data.armatures.new("Rig")
+        arm_ob = bpy.data.objects.new("Rig", arm)
+        scene.objects.link(arm_ob)
+        self.objects.append(arm_ob)
+        scene.objects.active = arm_ob
+        bpy.ops.object.mode_set(mode='EDIT')
+        root = arm.edit_bones.new("Root")
+        root.head, root.tail = (0, 0, 0), (0, 0, 1)
+        child = arm.edit_bones.new("Child")
+        child.head, child.tail = (0, 0, 1), (0, 1, 1.5)
+        child.parent = root
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+        empty = bpy.data.objects.new("Empty", None)
+        cam = bpy.data.objects.new("Camera", bpy.data.cameras.new("Camera"))
+        lamp = bpy.data.objects.new("Lamp", bpy.data.lamps.new("Lamp", 'POINT'))
+        cam.parent = empty
+        lamp.parent = cam
+        for ob in (empty, cam, lamp):
+            scene.objects.link(ob)
+            self.objects.append(ob)
+
+        for frame in (1, 5, 9):
+            t = frame * 0.1
+            for pose_bone in arm_ob.pose.bones:
+                pose_bone.rotation_mode = 'XYZ'
+                pose_bone.rotation_euler = (t, 2.0 * t, -t)
+                pose_bone.location = (t, 0.0, t * t)
+                pose_bone.keyframe_insert("rotation_euler", frame=frame)
+                pose_bone.keyframe_insert("location", frame=frame)
+            for ob in (empty, cam, lamp):
+                ob.location = (t, -t, 1.0)
+                ob.rotation_euler = (-t, t, 3.0 * t)
+                ob.scale = (1.0, 1.0 + t, 1.0)
+                ob.keyframe_insert("location", frame=frame)
+                ob.keyframe_insert("rotation_euler", frame=frame)
+                ob.keyframe_insert("scale", frame=frame)
+        scene.frame_set(1)
+
+    @staticmethod
+    def take_keys(text):
+        # (times, values) of the keys of each channel of the takes.
+        keys = []
+        for chunk in text.split("\nTakes:  {", 1)[1].split("Key: ")[1:]:
+            nums = re.findall(r"[-+]?[\d.]+(?:e[-+]?\d+)?", chunk.split("Color:", 1)[0])
+            keys.append(([int(t) for t in nums[0::2]], [float(v) for v in nums[1::2]]))
+        return keys
+
+    def test_anim_numpy_parity(self):
+        self.add_anim_rig()
+        for use_anim_optimize in (False, True):
+            kwargs = dict(object_types={'ARMATURE', 'EMPTY', 'CAMERA', 'LAMP'}, use_anim=True,
+                          use_anim_optimize=use_anim_optimize)
+            keys = self.take_keys(self.export(use_anim_numpy=False, **kwargs).decode("utf8"))
+            keys_numpy = self.take_keys(self.export(use_anim_numpy=True, **kwargs).decode("utf8"))
+            self.assertTrue(keys)
+            self.assertEqual(len(keys_numpy), len(keys))
+            for (times, values), (times_numpy, values_numpy) in zip(keys, keys_numpy):
+                # Same kept keys, same values within float32 precision.
+                self.assertEqual(times_numpy, times)
+                for value, value_numpy in zip(values, values_numpy):
+                    self.assertAlmostEqual(value_numpy, value, delta=1e-4 * max(1.0, abs(value)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+"""
+Checks the export_fbx helpers that do not touch Blender data. They run with any python, e.g.:
+    python PipelineExtensions/tests/test_helpers.py
+"""
+
+import importlib.util
+import os
+import struct
+import unittest
+from unittest import mock
+
+# Loaded from its path: importing the PipelineExtensions package needs Blender, these helpers don't.
+_spec = importlib.util.spec_from_file_location(
+        "export_fbx", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "export_fbx.py"))
+export_fbx = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(export_fbx)
+
+numpy = export_fbx.numpy
+
+
+class DedupItemsTest(unittest.TestCase):
+
+    UVS = [0.5, 0.25, 0.0, 1.0, 0.5, 0.25, -0.0, 1.0, 0.75, 0.0, 0.0, 1.0]
+
+    def test_first_occurrence_order(self):
+        unique, indices = export_fbx.dedup_items(self.UVS, 2, False)
+        # -0.0 matches 0.0, the first one being kept.
+        self.assertEqual(list(unique), [0.5, 0.25, 0.0, 1.0, 0.75, 0.0])
+        self.assertEqual(list(indices), [0, 1, 0, 1, 2, 1])
+
+    def test_tolerance(self):
+        values = [0.0, 0.01, 0.3, 0.02, 0.29]
+        unique, indices = export_fbx.dedup_items(values, 1, False, 0.1)
+        self.assertEqual(list(unique), [0.0, 0.3])
+        self.assertEqual(list(indices), [0, 0, 1, 0, 1])
+
+    def test_empty(self):
+        unique, indices = export_fbx.dedup_items([], 3, False)
+        self.assertEqual((list(unique), list(indices)), ([], []))
+
+    @unittest.skipIf(numpy is None, "needs numpy")
+    def test_numpy_parity(self):
+        rng = numpy.random.RandomState(0)
+        values = rng.randint(0, 4, 3000).astype(numpy.float32) * 0.5
+        values[::7] *= -1.0
+        for width, tolerance in ((1, 0.0), (2, 0.0), (3, 0.0), (3, 0.7)):
+            unique, indices = export_fbx.dedup_items(values, width, False, tolerance)
+            unique_np, indices_np = export_fbx.dedup_items(values, width, True, tolerance)
+            self.assertEqual(unique_np.tolist(), list(unique))
+            self.assertEqual(indices_np.tolist(), list(indices))
+        unique_np, indices_np = export_fbx.dedup_items(numpy.empty(0, numpy.float32), 3, True)
+        self.assertEqual((len(unique_np), len(indices_np)), (0, 0))
+
+
+class ArrayToStrTest(unittest.TestCase):
+
+    def test_parity(self):
+        # Same string as formatting value per value.
+        sep = ',\n\t\t'
+        for values, fmt in ((list(range(17)), '%i'), ([i * 0.37 - 2.0 for i in range(23)], '%.6f'), ([], '%i')):
+            for chunk_size in (1, 4, 17, 64):
+                expected = sep.join(','.join(fmt % v for v in values[i:i + chunk_size])
+                                    for i in range(0, len(values), chunk_size))
+                self.assertEqual(export_fbx.array_to_str(values, fmt, chunk_size, sep), expected)
+
+    def test_width(self):
+        uvs = [0.5, 0.25, 1.0, 0.0, 0.125, 0.75]
+        self.assertEqual(export_fbx.array_to_str(uvs, '%.3f,%.3f', 2, '|', 2), "0.500,0.250,1.000,0.000|0.125,0.750")
+
+
+class WriteArrayTest(unittest.TestCase):
+
+    @staticmethod
+    def written(values, *args, **kwargs):
+        out = []
+        export_fbx.write_array(out.append, values, *args, **kwargs)
+        return "".join(out)
+
+    def test_slices(self):
+        # Slices give the same text as writing the array whole, whatever the kind of sequence.
+        values = [i * 0.5 - 7.0 for i in range(90)]
+        for kind, precision, suffix in (('f', 6, ""), ('ff', 3, ""), ('fff', None, ""), ('i', 6, ",L")):
+            vals = [int(v) for v in values] if kind == 'i' else values
+            whole = self.written(vals, kind, 4, ',\n', precision, suffix)
+            for slice_size in (1, 7, 24, 1000):
+                self.assertEqual(self.written(vals, kind, 4, ',\n', precision, suffix, slice_size), whole)
+                self.assertEqual(self.written(iter(vals), kind, 4, ',\n', precision, suffix, slice_size), whole)
+
+    def test_mixed_kinds(self):
+        # Time and value of animation keys.
+        self.assertEqual(self.written([0, 1.5, 10, -2.25], 'if', 1, ',', 2, ",L"), "0,1.50,L,10,-2.25,L")
+        self.assertEqual(self.written([0, 1.5, 10, -2.25], 'if', 1, ',', None, ",L"), "0,1.5,L,10,-2.25,L")
+
+    @unittest.skipIf(numpy is None, "needs numpy")
+    def test_numpy(self):
+        values = numpy.arange(30, dtype=numpy.float32) * 0.25
+        whole = self.written(values.tolist(), 'ff', 3, ',\n', 6)
+        self.assertEqual(self.written(values, 'ff', 3, ',\n', 6), whole)
+        self.assertEqual(self.written(values, 'ff', 3, ',\n', 6, slice_size=8), whole)
+
+
+def float32(v):
+    return struct.unpack('f', struct.pack('f', v))[0]
+
+
+class ShortestFloatTest(unittest.TestCase):
+
+    VALUES = [0.0, -0.0, 1.0, -2.5, 0.1, 1.0 / 3.0, 123456.789, 1e-7, 3.4e38, 2.0 ** -140, 0.30000001192092896]
+
+    def check_shortest(self, values, strs):
+        for v, s in zip(values, strs):
+            # Reads back as the same 32 bits float, and no shorter string does.
+            self.assertEqual(float32(float(s)), float32(v), s)
+            digits = len(s.lstrip('-').split('e')[0].replace('.', '').strip('0'))
+            if digits > 1:
+                self.assertNotEqual(float32(float('%.*g' % (digits - 1, float32(v)))), float32(v), s)
+
+    def test_pure_python(self):
+        with mock.patch.object(export_fbx, "numpy", None):
+            strs = export_fbx.float32_shortest_strs(self.VALUES)
+        self.check_shortest(self.VALUES, strs)
+        self.assertEqual(strs[:5], ['0.0', '-0.0', '1.0', '-2.5', '0.1'])
+
+    @unittest.skipIf(numpy is None, "needs numpy")
+    def test_numpy_parity(self):
+        with mock.patch.object(export_fbx, "numpy", None):
+            strs = export_fbx.float32_shortest_strs(self.VALUES)
+        self.assertEqual(export_fbx.float32_shortest_strs(self.VALUES), strs)
+        self.assertEqual(export_fbx.float32_shortest_strs(numpy.array(self.VALUES, dtype=numpy.float32)), strs)
+
+    def test_floats_to_str(self):
+        self.assertEqual(export_fbx.floats_to_str((0.1, -2.0), None), "0.1,-2.0")
+        self.assertEqual(export_fbx.floats_to_str((0.1, -2.0), 3), "0.100,-2.000")
+
+    def test_mixed_kinds(self):
+        # Only float values are turned into strings.
+        self.assertEqual(export_fbx.shortest_float_values([3, 0.1, 4, 2.5], 'if'), [3, '0.1', 4, '2.5'])
+
+
+class ObjectGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        graph = self.graph = export_fbx.ObjectGraph()
+        self.mesh = graph.add("Model", "Model::Cube", "Mesh")
+        self.bone = graph.add("Model", "Model::Bone", "Limb")
+        self.mat = graph.add("Material", "Material::Red", "")
+        self.skin = graph.add("Deformer", "Deformer::Skin Cube", "Skin")
+        self.cluster = graph.add("Deformer", "SubDeformer::Cluster Cube Bone", "Cluster")
+        graph.connect(self.mesh, graph.SCENE)
+        graph.connect(self.mat, self.mesh)
+        graph.connect(self.cluster, self.skin)
+
+    def test_nodes(self):
+        # Ids are indices in nodes, in the order they were added.
+        graph = self.graph
+        self.assertEqual([self.mesh, self.bone, self.mat, self.skin, self.cluster], list(range(5)))
+        self.assertEqual(graph.nodes[self.bone], ("Model", "Model::Bone", "Limb"))
+        self.assertEqual(graph.node_name(self.cluster), "SubDeformer::Cluster Cube Bone")
+        self.assertEqual(graph.node_name(graph.SCENE), "Model::Scene")
+
+    def test_counts(self):
+        graph = self.graph
+        self.assertEqual(graph.count("Model"), 2)
+        self.assertEqual(graph.count("Model", "Mesh"), 1)
+        self.assertEqual(graph.count("Deformer"), 2)
+        self.assertEqual(graph.count("Deformer", "Cluster"), 1)
+        self.assertEqual(graph.count("Texture"), 0)
+
+    def test_edges(self):
+        # Kept in the order they were connected.
+        graph = self.graph
+        self.assertEqual(graph.edges, [(self.mesh, graph.SCENE), (self.mat, self.mesh), (self.cluster, self.skin)])
+
+
+if __name__ == '__main__':
+    unittest.main()